@@ -1,10 +1,36 @@
 from quickdb.datarake.interface import Progress
-from typing import Any, Dict, NamedTuple
+from typing import Any, Dict, NamedTuple, Optional, Tuple, Union
+
+
+class Address(NamedTuple):
+    host: str
+    port: int
+
+
+class TreeNode(NamedTuple):
+    '''
+    Position of a worker in a tree reduction.
+    The worker merges partial results of `n_children` workers, which arrive at `mailbox`, into its own
+    and sends the merged one to `parent_mailbox` of `parent`, or returns it to master if `parent` is None.
+    '''
+    mailbox: str
+    n_children: int
+    parent: Optional[Address]
+    parent_mailbox: Optional[str]
+
+
+class SharedPayload(NamedTuple):
+    '''
+    Pickled `shared` whose large arrays are replaced with their `digests`
+    '''
+    data: bytes
+    digests: Tuple[str, ...]
 
 
 class WorkerRequest(NamedTuple):
     make_env: str
-    shared: Dict
+    shared: Union[Dict, SharedPayload]
+    tree: Optional[TreeNode] = None
 
 
 class WorkerResult(NamedTuple):
@@ -17,3 +43,41 @@ class Interrupt(NamedTuple):
 
 class UserError(NamedTuple):
     reason: str
+
+
+class Ping(NamedTuple):
+    ...
+
+
+class Pong(NamedTuple):
+    ...
+
+
+class Partial(NamedTuple):
+    '''
+    Partial result sent from a worker to its parent in a tree reduction
+    '''
+    mailbox: str
+    value: Any
+    error: Optional[str] = None
+
+
+class NeedShared(NamedTuple):
+    '''
+    Sent from a worker when it does not have arrays of a `SharedPayload`
+    '''
+    digests: Tuple[str, ...]
+
+
+class SharedValues(NamedTuple):
+    '''
+    Arrays by digest sent in reply to `NeedShared`
+    '''
+    values: Dict[str, Any]
+
+
+class RerunVersion(NamedTuple):
+    '''
+    Asks a worker for the version of the data of `rerun` deployed to it
+    '''
+    rerun: str
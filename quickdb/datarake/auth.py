@@ -3,7 +3,8 @@ import os
 import secrets
 import socket
 import socketserver
-from typing import IO
+import time
+from typing import IO, Dict, Set, Tuple
 
 from quickdb.utils.cached_property import cached_property
 
@@ -14,14 +15,20 @@ class AuthError(RuntimeError):
     pass
 
 
-def authenticate(handler: socketserver.StreamRequestHandler):
+def authenticate(handler: socketserver.StreamRequestHandler) -> bool:
     '''
     on worker
+
+    Returns True if the client is another worker, which may only send partial results of tree reductions.
     '''
+    peer = False
     try:
         if handler.connection.family != socket.AF_UNIX: # type: ignore
-            if config.master_addr != handler.client_address[0]:
-                raise AuthError(f'connection from {handler.client_address} is not allowed')
+            addr = handler.client_address[0]
+            if addr != config.master_addr:
+                if addr not in peer_addrs():
+                    raise AuthError(f'connection from {handler.client_address} is not allowed')
+                peer = True
         nonce = bytes(f'{secrets.randbits(512):0128x}', 'utf-8')
         handler.wfile.write(nonce + '\n'.encode())
         handler.wfile.flush()
@@ -34,6 +41,32 @@ def authenticate(handler: socketserver.StreamRequestHandler):
         raise
     handler.wfile.write('ok\n'.encode())
     handler.wfile.flush()
+    return peer
+
+
+# resolved addresses of workers are looked up again after this many seconds
+PEER_ADDR_TTL = 300.
+
+_peer_addrs: Dict[str, Tuple[str, float]] = {}  # host => (address, time of the lookup)
+
+
+def peer_addrs() -> Set[str]:
+    '''
+    Addresses of other workers, which send partial results in tree reductions.
+    Empty unless tree reductions are enabled by `config.tree_reduce_fanin`.
+    Hosts which can not be resolved are looked up again next time.
+    '''
+    if config.tree_reduce_fanin < 2:
+        return set()
+    now = time.monotonic()
+    for worker in config.workers:
+        cached = _peer_addrs.get(worker.host)
+        if cached is None or now - cached[1] > PEER_ADDR_TTL:
+            try:
+                _peer_addrs[worker.host] = (socket.gethostbyname(worker.host), now)
+            except OSError:
+                _peer_addrs.pop(worker.host, None)
+    return {addr for addr, _ in _peer_addrs.values()}
 
 
 def safe_digest(value, salt=None):
@@ -47,7 +80,10 @@ def knock(wfile: IO[bytes], rfile: IO[bytes], salt=None):
     on master
     '''
     nonce = rfile.readline().strip()
+    if nonce.startswith(b'ng:'):  # the address is not allowed
+        raise AuthError(nonce.split(b':', 1)[1].decode())
     wfile.write(safe_digest(nonce, salt) + '\n'.encode())
+    wfile.flush()
     auth_line = rfile.readline().decode()
     if auth_line.startswith('ng:'):
         reason = auth_line.split(':', 1)[1]
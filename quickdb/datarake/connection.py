@@ -0,0 +1,195 @@
+'''
+Authenticated connections to workers, shared by concurrent requests.
+Master connects to workers, and workers connect to each other in tree reductions.
+'''
+import collections
+import contextlib
+import itertools
+import queue
+import socket
+import threading
+import time
+from typing import DefaultDict, Dict, Iterator, Tuple, Union
+
+from quickdb.datarake.auth import knock
+
+from . import api, config, wire
+
+# anything with `host` and `port`
+Endpoint = Union[config.Worker, api.Address]
+
+
+class ConnectionClosed(ConnectionError):
+    pass
+
+
+class Connection:
+    '''
+    An authenticated connection to a worker.
+    Messages are sent as `(request_id, message)` pairs so that several requests share the connection.
+    '''
+
+    def __init__(self, worker: Endpoint, timeout: float = 10.):
+        self._worker = worker
+        self._sock = socket.create_connection((worker.host, worker.port), timeout=timeout)
+        self._sock.settimeout(None)
+        self._rfile = self._sock.makefile('rb')
+        self._wfile = self._sock.makefile('wb')
+        knock(self._wfile, self._rfile)
+        self._lock = threading.Lock()  # for `_queues`
+        self._write_lock = threading.Lock()
+        self._queues: Dict[int, queue.Queue] = {}
+        self._ids = itertools.count()
+        self.closed = False
+        self.last_used = time.time()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def start(self, message) -> 'Request':
+        request_id, q = self._open()
+        try:
+            self.send(request_id, message, config.wire_compress_level)
+        except BaseException:
+            self._close_request(request_id)
+            raise
+        return Request(self, request_id, q)
+
+    def ping(self, timeout: float) -> bool:
+        request_id, q = self._open()
+        try:
+            self.send(request_id, api.Ping())
+            return isinstance(q.get(timeout=timeout), api.Pong)
+        except (queue.Empty, OSError):
+            return False
+        finally:
+            self._close_request(request_id)
+
+    def send(self, request_id: int, message, compress_level=0):
+        with self._write_lock:
+            if self.closed:
+                raise ConnectionClosed(f'connection to {self._worker.host} is closed')
+            wire.dump((request_id, message), self._wfile, compress_level)
+
+    def close(self):
+        self.closed = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+    def _open(self):
+        q: queue.Queue = queue.Queue()
+        with self._lock:
+            request_id = next(self._ids)
+            self._queues[request_id] = q
+        return request_id, q
+
+    def _close_request(self, request_id: int):
+        with self._lock:
+            self._queues.pop(request_id, None)
+        self.last_used = time.time()
+
+    def _read_loop(self):
+        reason = ''
+        try:
+            while True:
+                request_id, message = wire.load(self._rfile)
+                with self._lock:
+                    q = self._queues.get(request_id)
+                if q is not None:
+                    q.put(message)
+        except (EOFError, OSError):
+            pass
+        except Exception as e:  # e.g. a message which can not be unpickled; the stream can not be read further
+            reason = f': {e!r}'
+        finally:
+            with self._lock:
+                self.close()
+                queues = list(self._queues.values())
+            for q in queues:
+                q.put(ConnectionClosed(f'connection to {self._worker.host} is closed{reason}'))
+
+
+class Request:
+    def __init__(self, connection: Connection, request_id: int, q: queue.Queue):
+        self._connection = connection
+        self._request_id = request_id
+        self._queue = q
+
+    def get(self):
+        '''
+        Returns the next message for this request from the worker
+        '''
+        message = self._queue.get()
+        if isinstance(message, ConnectionClosed):
+            raise message
+        return message
+
+    def send(self, message):
+        self._connection.send(self._request_id, message, config.wire_compress_level)
+
+    def interrupt(self):
+        try:
+            self._connection.send(self._request_id, api.Interrupt())
+        except OSError:
+            pass
+
+    def close(self):
+        self._connection._close_request(self._request_id)
+
+
+class ConnectionPool:
+    '''
+    Keeps a connection to each worker open across queries.
+
+    A connection idle for `ping_after` seconds is checked with a ping before it is used again,
+    and a closed or unresponsive connection is replaced with a new one.
+    '''
+
+    def __init__(self, ping_after: float = 30., ping_timeout: float = 5.):
+        self._ping_after = ping_after
+        self._ping_timeout = ping_timeout
+        self._connections: Dict[Tuple[str, int], Connection] = {}
+        self._locks: DefaultDict[Tuple[str, int], threading.Lock] = collections.defaultdict(threading.Lock)
+
+    @contextlib.contextmanager
+    def request(self, worker: Endpoint, message) -> Iterator[Request]:
+        conn = self.get(worker)
+        try:
+            request = conn.start(message)
+        except OSError:  # the connection was broken while it was idle
+            self.discard(worker, conn)
+            conn = self.get(worker)
+            request = conn.start(message)
+        try:
+            yield request
+        except ConnectionClosed:
+            self.discard(worker, conn)
+            raise
+        finally:
+            request.close()
+
+    def get(self, worker: Endpoint) -> Connection:
+        key = (worker.host, worker.port)
+        with self._locks[key]:
+            conn = self._connections.get(key)
+            if conn is not None and not conn.closed and time.time() - conn.last_used > self._ping_after:
+                if not conn.ping(self._ping_timeout):
+                    conn.close()
+            if conn is None or conn.closed:
+                conn = Connection(worker)
+                self._connections[key] = conn
+            return conn
+
+    def discard(self, worker: Endpoint, conn: Connection):
+        key = (worker.host, worker.port)
+        with self._locks[key]:
+            if self._connections.get(key) is conn:
+                del self._connections[key]
+        conn.close()
+
+    def close(self):
+        for conn in list(self._connections.values()):
+            conn.close()
+        self._connections.clear()
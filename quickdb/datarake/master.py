@@ -1,27 +1,32 @@
 import concurrent.futures
-import pickle
-import socket
+import hashlib
+import secrets
+import threading
 from functools import reduce
-from itertools import repeat
-from typing import Any, Callable, Dict, Iterable, Optional
+from typing import Any, Callable, Dict, List, Optional, Sequence, cast
 
-from quickdb.datarake.auth import knock
 from quickdb.datarake.interface import Progress, ProgressCB
 from quickdb.datarake.safeevent import SafeEvent, wait_for_safe_event
 from quickdb.sspcatalog.errors import UserError
 from quickdb.utils.evaluate import evaluate
 
-from . import api, config
+from . import api, config, sharedcache
+from .connection import ConnectionPool, Endpoint
 
 
 def run_make_env_with_interrupt(make_env: str, *, interrupt_notifiyer: SafeEvent, shared: Optional[Dict], progress: Optional[ProgressCB]):
     shared = {} if shared is None else shared
     env = evaluate(make_env, dict(shared))  # we need to pass a copy of `shared` because `evaluate` makes some changes on `shared`
-    mapped_values = scatter(make_env, shared, progress, interrupt_notifiyer)
     if env.get('streaming'):
+        scatter(make_env, shared, progress, interrupt_notifiyer, lambda mv: None)
         return None
     finalizer = env.get('finalizer')
-    result = reduce(env['reducer'], (mv.value for mv in mapped_values))
+    # results of workers are merged as soon as they arrive
+    accumulator = Accumulator(env['reducer'])
+    # workers accept results from each other only if tree reductions are enabled in the config
+    tree_fanin = env.get('tree_reduce_fanin', config.tree_reduce_fanin) if config.tree_reduce_fanin >= 2 else 0
+    scatter(make_env, shared, progress, interrupt_notifiyer, lambda mv: accumulator.add(mv.value), tree_fanin)
+    result = accumulator.value
     if finalizer:
         result = finalizer(result)
     return result
@@ -32,7 +37,16 @@ def run_make_env(make_env: str, shared: Dict, progress: ProgressCB = None, inter
         return run_make_env_with_interrupt(make_env, interrupt_notifiyer=interrupt_notifiyer or noop, shared=shared, progress=progress)
 
 
-def scatter(make_env: str, shared: Dict, progress: Optional[ProgressCB], interrupt_notifiyer: SafeEvent) -> Iterable[api.WorkerResult]:
+def scatter(make_env: str, shared: Dict, progress: Optional[ProgressCB], interrupt_notifiyer: SafeEvent,
+            on_result: Callable[[api.WorkerResult], None], tree_fanin: int = 0):
+    '''
+    Runs `make_env` on all workers and calls `on_result` for the result of each worker
+    in the thread waiting for the worker, as soon as the result arrives.
+
+    If `tree_fanin` >= 2, workers merge their results in a tree of that fan-in
+    and `on_result` is called only for the result of the root.
+    The other workers are interrupted when one of them fails.
+    '''
     progresses: Dict[config.Worker, Progress] = {}
 
     def progress1(worker: config.Worker, p: Progress):
@@ -40,43 +54,118 @@ def scatter(make_env: str, shared: Dict, progress: Optional[ProgressCB], interru
         if progress:
             progress(reduce(lambda a, b: Progress(done=a.done + b.done, total=a.total + b.total, data=p.data), progresses.values()))
 
+    trees = reduction_tree(config.workers, tree_fanin)
+    # large arrays in `shared` are sent only to workers which have not cached them
+    payload, arrays = sharedcache.pack(shared)
+
+    def run(worker: config.Worker, tree: Optional[api.TreeNode], abort: SafeEvent):
+        res = post_request(worker, make_env, payload, progress1, abort, tree, arrays)
+        if tree is None or tree.parent is None:
+            on_result(res)
+
+    with SafeEvent() as abort, wait_for_safe_event(interrupt_notifiyer, abort.set):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(config.workers)) as pool:
+            futures = [pool.submit(run, worker, tree, abort) for worker, tree in zip(config.workers, trees)]
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except BaseException:
+                    abort.set()
+                    raise
+
+
+def reduction_tree(workers: Sequence[Endpoint], fanin: int) -> List[Optional[api.TreeNode]]:
+    '''
+    Places `workers` in a tree where each worker has at most `fanin` children.
+    The parent of the i-th worker is the (i - 1) // fanin -th one, so neighbours in `workers` share parents.
+    '''
+    if fanin < 2 or len(workers) <= 2:
+        return [None] * len(workers)
+    reduction_id = secrets.token_hex(16)
+    parents = [None] + [(i - 1) // fanin for i in range(1, len(workers))]
+    return [
+        api.TreeNode(
+            f'{reduction_id}/{i}',
+            parents.count(i),
+            None if p is None else api.Address(workers[p].host, workers[p].port),
+            None if p is None else f'{reduction_id}/{p}',
+        )
+        for i, p in enumerate(parents)
+    ]
+
+
+def data_version(rerun: str) -> Optional[str]:
+    '''
+    Version of the data of `rerun` deployed to all workers.
+    None if a worker does not have a manifest of the rerun.
+    '''
+    def version(worker: config.Worker) -> Optional[str]:
+        with connections.request(worker, api.RerunVersion(rerun)) as request:
+            res = request.get()
+        if not isinstance(res, api.WorkerResult):
+            raise RuntimeError(f'{res}@{worker.host}')
+        return res.value
+
     with concurrent.futures.ThreadPoolExecutor(max_workers=len(config.workers)) as pool:
-        return pool.map(unpack_args(post_request), zip(
-            config.workers,
-            repeat(make_env),
-            repeat(shared),
-            repeat(progress1),
-            repeat(interrupt_notifiyer),
-        ))
-
-
-def unpack_args(f):
-    def g(args):
-        return f(*args)
-    return g
-
-
-def post_request(worker, make_env, shared, progress1: Callable[[config.Worker, float], float], interrupt_notifiyer: SafeEvent):
-    with socket.socket() as sock:
-        sock.connect((worker.host, worker.port))
-        rfile = sock.makefile('rb')
-        wfile = sock.makefile('wb', buffering=0)
-        knock(wfile, rfile)
-        request = api.WorkerRequest(make_env, shared)
-        pickle.dump(request, wfile)
-        with wait_for_safe_event(interrupt_notifiyer, lambda: pickle.dump(api.Interrupt(), wfile)):
+        versions = list(pool.map(version, config.workers))
+    if any(v is None for v in versions):
+        return None
+    return hashlib.sha1('\n'.join(cast(List[str], versions)).encode()).hexdigest()
+
+
+class Accumulator:
+    '''
+    Reduces values added from multiple threads as they are added.
+
+    A value is merged into the held one as soon as it is added, and pairs of values added at once are reduced in parallel,
+    so that at most one value per thread is kept.
+    `reducer` must be associative and commutative, because values are reduced in the order workers finish
+    (e.g. the reducer of `nonagg_env` breaks ties of rows by their ids rather than by which value comes first).
+    '''
+    _EMPTY = object()
+
+    def __init__(self, reducer: Callable[[Any, Any], Any]):
+        self._reducer = reducer
+        self._lock = threading.Lock()
+        self._value = self._EMPTY
+
+    def add(self, value):
+        while True:
+            with self._lock:
+                if self._value is self._EMPTY:
+                    self._value = value
+                    return
+                other, self._value = self._value, self._EMPTY
+            value = self._reducer(other, value)
+
+    @property
+    def value(self):
+        if self._value is self._EMPTY:
+            raise TypeError('no values were added')
+        return self._value
+
+
+def post_request(worker, make_env, shared, progress1: Callable[[config.Worker, Progress], None], interrupt_notifiyer: SafeEvent,
+                 tree: Optional[api.TreeNode] = None, arrays: Dict[str, Any] = {}):
+    with connections.request(worker, api.WorkerRequest(make_env, shared, tree)) as request:
+        with wait_for_safe_event(interrupt_notifiyer, request.interrupt):
             while True:
-                res = pickle.load(rfile)
+                res = request.get()
                 if isinstance(res, api.Progress):
                     progress1(worker, res)
+                elif isinstance(res, api.NeedShared):
+                    request.send(api.SharedValues({d: arrays[d] for d in res.digests}))
                 else:
                     break
-        if isinstance(res, api.WorkerResult):
-            return res
-        elif isinstance(res, api.UserError):
-            raise UserError(res.reason)
-        else:
-            raise RuntimeError(f'{res}@{worker.host}')
+    if isinstance(res, api.WorkerResult):
+        return res
+    elif isinstance(res, api.UserError):
+        raise UserError(res.reason)
+    else:
+        raise RuntimeError(f'{res}@{worker.host}')
+
+
+connections = ConnectionPool()
 
 
 def test():
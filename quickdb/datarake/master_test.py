@@ -2,6 +2,7 @@ import os
 import time
 import unittest
 from multiprocessing import Event
+from typing import List, cast
 
 from tqdm import tqdm
 
@@ -39,3 +40,31 @@ class TestMaster(unittest.TestCase):
 
         print(result[0])
 
+
+
+class TestAccumulator(unittest.TestCase):
+    def test_add_from_threads(self):
+        import threading
+        accumulator = master.Accumulator(lambda a, b: a + b)
+        threads = [threading.Thread(target=accumulator.add, args=(i,)) for i in range(100)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        self.assertEqual(accumulator.value, sum(range(100)))
+
+    def test_empty(self):
+        with self.assertRaises(TypeError):
+            master.Accumulator(lambda a, b: a + b).value
+
+
+class TestReductionTree(unittest.TestCase):
+    def test_reduction_tree(self):
+        from .api import Address, TreeNode
+
+        workers = [Address(f'w{i}', 2935) for i in range(6)]
+        trees = cast(List[TreeNode], master.reduction_tree(workers, 2))
+        self.assertEqual([t.n_children for t in trees], [2, 2, 1, 0, 0, 0])
+        self.assertEqual([t.parent for t in trees], [None, Address('w0', 2935), Address('w0', 2935), Address('w1', 2935), Address('w1', 2935), Address('w2', 2935)])
+        self.assertEqual(trees[3].parent_mailbox, trees[1].mailbox)
+        self.assertEqual(master.reduction_tree(workers, 0), [None] * 6)
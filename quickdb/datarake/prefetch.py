@@ -0,0 +1,64 @@
+import logging
+import threading
+from typing import Callable, Generic, Iterator, List, NamedTuple, TypeVar
+
+T = TypeVar('T')
+
+
+class PrefetchStats(NamedTuple):
+    hits: int  # tasks whose prefetch had finished when they were started
+    misses: int
+
+    def __add__(self, other: 'PrefetchStats') -> 'PrefetchStats':  # type: ignore
+        return PrefetchStats(self.hits + other.hits, self.misses + other.misses)
+
+
+class Prefetcher(Generic[T]):
+    '''
+    Calls `prefetch(task)` in a background thread up to `depth` tasks ahead of the consumer.
+
+    Example:
+        prefetcher = Prefetcher(patches, lambda patch: patch.prefetch(columns), depth=2)
+        results = [mapper(patch) for patch in prefetcher]
+        print(prefetcher.stats)
+    '''
+
+    def __init__(self, tasks: List[T], prefetch: Callable[[T], None], depth: int):
+        self._tasks = tasks
+        self._prefetch = prefetch
+        self._depth = depth
+        self.stats = PrefetchStats(0, 0)
+
+    def __iter__(self) -> Iterator[T]:
+        if self._depth <= 0:
+            yield from self._tasks
+            return
+        done = [threading.Event() for _ in self._tasks]
+        room = threading.Semaphore(self._depth + 1)  # the current task and `depth` tasks ahead
+        stop = threading.Event()
+
+        def run():
+            for task, d in zip(self._tasks, done):
+                room.acquire()
+                if stop.is_set():
+                    return
+                try:
+                    self._prefetch(task)
+                except Exception:  # prefetch is only a hint
+                    logging.exception('prefetch failed')
+                d.set()
+
+        th = threading.Thread(target=run, daemon=True)
+        th.start()
+        try:
+            for task, d in zip(self._tasks, done):
+                if d.is_set():
+                    self.stats = self.stats._replace(hits=self.stats.hits + 1)
+                else:
+                    self.stats = self.stats._replace(misses=self.stats.misses + 1)
+                yield task
+                room.release()
+        finally:
+            stop.set()
+            room.release()
+            th.join()
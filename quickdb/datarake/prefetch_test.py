@@ -0,0 +1,40 @@
+import threading
+import time
+import unittest
+
+from .prefetch import Prefetcher, PrefetchStats
+
+
+class TestPrefetcher(unittest.TestCase):
+    def test_prefetch_ahead(self):
+        prefetched = []
+        lock = threading.Lock()
+
+        def prefetch(task):
+            with lock:
+                prefetched.append(task)
+
+        prefetcher = Prefetcher(list(range(10)), prefetch, depth=2)
+        for task in prefetcher:
+            time.sleep(0.01)
+            with lock:
+                self.assertLessEqual(max(prefetched), task + 2)
+        self.assertEqual(sorted(prefetched), list(range(10)))
+        self.assertEqual(sum(prefetcher.stats), 10)
+        self.assertGreater(prefetcher.stats.hits, 0)
+
+    def test_no_prefetch(self):
+        prefetcher = Prefetcher(list(range(3)), lambda task: self.fail(), depth=0)
+        self.assertEqual(list(prefetcher), [0, 1, 2])
+        self.assertEqual(prefetcher.stats, PrefetchStats(0, 0))
+
+    def test_failure_in_prefetch(self):
+        def prefetch(task):
+            raise RuntimeError()
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(list(Prefetcher(list(range(3)), prefetch, depth=1)), [0, 1, 2])
+
+    def test_break(self):
+        for task in Prefetcher(list(range(100)), lambda task: None, depth=2):
+            if task == 3:
+                break
@@ -0,0 +1,158 @@
+import collections
+import queue
+import threading
+from functools import partial
+from typing import Any, Callable, Deque, Generator, Iterable, Iterator, List, Optional
+
+
+class FairScheduler:
+    '''
+    Runs items of concurrent jobs on a process pool.
+
+    At most `n_slots` items are put into the pool at once and a freed slot is given to the jobs in turn,
+    so that a short job does not wait for all items of a long job submitted earlier.
+
+    Example:
+        scheduler = FairScheduler(multiprocessing.Pool(4), 4)
+        for value in scheduler.imap_unordered(func, items):  # can be called from multiple threads
+            ...
+    '''
+
+    def __init__(self, pool, n_slots: int):
+        self._pool = pool
+        self._n_slots = n_slots
+        self._lock = threading.Lock()
+        self._jobs: Deque['_Job'] = collections.deque()
+        self._running = 0
+
+    def imap_unordered(self, func: Callable, items: Iterable) -> Generator:
+        '''
+        Yields `func(item)` for `items` in the order of completion.
+        `items` can be a generator; its next item is taken when a slot of the pool is given to this job.
+        '''
+        job = _Job(func, items)
+        with self._lock:
+            self._jobs.append(job)
+        self._dispatch()
+        try:
+            while True:
+                with self._lock:
+                    if not job.has_pending() and job.received == job.submitted:
+                        break
+                ok, value = job.results.get()
+                job.received += 1
+                if not ok:
+                    raise value
+                yield value
+        finally:
+            with self._lock:
+                job.cancel()  # items not started yet are cancelled
+                self._jobs.remove(job)
+
+    def _dispatch(self):
+        with self._lock:
+            while self._running < self._n_slots:
+                job = self._next_job()
+                if job is None:
+                    break
+                item = job.pop()
+                self._running += 1
+                self._pool.apply_async(job.func, (item,), callback=partial(self._done, job, True), error_callback=partial(self._done, job, False))
+
+    def _next_job(self) -> Optional['_Job']:
+        for _ in range(len(self._jobs)):
+            job = self._jobs[0]
+            self._jobs.rotate(-1)
+            if job.has_pending():
+                return job
+        return None
+
+    def _done(self, job: '_Job', ok: bool, value: Any):
+        job.results.put((ok, value))
+        with self._lock:
+            self._running -= 1
+        self._dispatch()
+
+
+class _Job:
+    _END = object()
+
+    def __init__(self, func: Callable, items: Iterable):
+        self.func = func
+        self.results: queue.Queue = queue.Queue()
+        self.submitted = 0
+        self.received = 0
+        self._items = iter(items)
+        self._next = next(self._items, self._END)  # looked ahead to know whether items remain
+
+    def has_pending(self) -> bool:
+        return self._next is not self._END
+
+    def pop(self):
+        item = self._next
+        self._next = next(self._items, self._END)
+        self.submitted += 1
+        return item
+
+    def cancel(self):
+        self._next = self._END
+
+
+class WorkUnits:
+    '''
+    Splits tasks of known sizes into units of work by guided self-scheduling.
+
+    Tasks are taken in descending order of size, and a unit gets about 1/(2 `n_procs`) of the remaining size,
+    so that units get smaller toward the end of a job and processes finish at about the same time.
+    Once the processing speed is known from `observe`, a unit takes from `min_seconds` to `max_seconds`.
+    Before that, a unit is at most 1/`max_units_per_proc` of the share of a process.
+
+    Example:
+        units = WorkUnits([task.size for task in tasks], n_procs=8)
+        for unit, elapsed in pool.imap_unordered(process, units):  # unit is a list of indices of tasks
+            units.observe(sum(sizes[i] for i in unit), elapsed)
+    '''
+
+    def __init__(self, sizes: List[int], n_procs: int, *,
+                 min_seconds=0.2, max_seconds=5., max_units_per_proc=8, max_tasks=1024):
+        self._sizes = sizes
+        self._n_procs = n_procs
+        self._min_seconds = min_seconds
+        self._max_seconds = max_seconds
+        self._max_tasks = max_tasks
+        self._remaining = sum(sizes)
+        self._initial_limit = max(self._remaining / (n_procs * max_units_per_proc), 1)
+        self._seconds_per_row: Optional[float] = None
+
+    def observe(self, size: int, seconds: float):
+        '''
+        Tells the time which a unit of `size` has taken.
+        '''
+        if size <= 0:
+            return
+        s = seconds / size
+        # moving average of recent units
+        self._seconds_per_row = s if self._seconds_per_row is None else 0.75 * self._seconds_per_row + 0.25 * s
+
+    def target_size(self) -> float:
+        target = self._remaining / (2 * self._n_procs)
+        if self._seconds_per_row is None:
+            return min(target, self._initial_limit)
+        lo = self._min_seconds / self._seconds_per_row
+        hi = self._max_seconds / self._seconds_per_row
+        return min(max(target, lo), hi)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        sizes = self._sizes
+        order = sorted(range(len(sizes)), key=lambda i: -sizes[i])
+        pos = 0
+        while pos < len(order):
+            target = self.target_size()
+            unit: List[int] = []
+            size = 0
+            while pos < len(order) and len(unit) < self._max_tasks and (len(unit) == 0 or size + sizes[order[pos]] <= target):
+                unit.append(order[pos])
+                size += sizes[order[pos]]
+                pos += 1
+            self._remaining -= size
+            yield unit
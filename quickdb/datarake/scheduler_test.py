@@ -0,0 +1,70 @@
+import multiprocessing
+import threading
+import time
+import unittest
+
+from .scheduler import FairScheduler, WorkUnits
+
+
+def sleep_and_return(x):
+    time.sleep(0.05)
+    return x
+
+
+def fail(x):
+    raise ZeroDivisionError()
+
+
+class TestFairScheduler(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = multiprocessing.Pool(2)
+        cls.scheduler = FairScheduler(cls.pool, 2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.terminate()
+
+    def test_imap_unordered(self):
+        self.assertEqual(sorted(self.scheduler.imap_unordered(sleep_and_return, list(range(5)))), list(range(5)))
+
+    def test_short_job_is_not_blocked(self):
+        finished = {}
+
+        def run(name, n):
+            list(self.scheduler.imap_unordered(sleep_and_return, list(range(n))))
+            finished[name] = time.time()
+
+        long_job = threading.Thread(target=run, args=('long', 40))
+        long_job.start()
+        time.sleep(0.1)
+        run('short', 2)
+        long_job.join()
+        self.assertLess(finished['short'], finished['long'] - 0.5)
+
+    def test_error(self):
+        with self.assertRaises(ZeroDivisionError):
+            list(self.scheduler.imap_unordered(fail, [1, 2, 3]))
+        self.assertEqual(list(self.scheduler.imap_unordered(sleep_and_return, [1])), [1])
+
+
+class TestWorkUnits(unittest.TestCase):
+    def test_all_tasks_once(self):
+        sizes = [5, 100, 0, 30, 7, 7, 60, 1]
+        units = list(WorkUnits(sizes, 2))
+        self.assertEqual(sorted(i for unit in units for i in unit), list(range(len(sizes))))
+
+    def test_largest_first_and_shrinking(self):
+        sizes = [10] * 1000 + [1000]
+        units = list(WorkUnits(sizes, 4, max_units_per_proc=1))
+        self.assertEqual(units[0][0], 1000)
+        unit_sizes = [sum(sizes[i] for i in unit) for unit in units]
+        self.assertGreater(unit_sizes[1], unit_sizes[-2])
+
+    def test_observe(self):
+        sizes = [10] * 1000
+        units = WorkUnits(sizes, 4, min_seconds=2.)
+        it = iter(units)
+        next(it)
+        units.observe(10, 0.01)  # 1000 rows per second
+        self.assertEqual(len(next(it)), 200)
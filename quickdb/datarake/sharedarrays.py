@@ -0,0 +1,71 @@
+import io
+import os
+import pickle
+import secrets
+import shutil
+import tempfile
+from typing import Any, List, Optional
+
+import numpy
+
+DEFAULT_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+class SharedArrays:
+    '''
+    Pickles objects so that large numpy arrays in them are passed to other processes without copies.
+
+    Arrays of `min_bytes` or more are written to files in `directory` (a memory filesystem by default)
+    and only their paths are pickled. `loads` memory-maps the files.
+    The files are removed on `close`; processes which have mapped them can keep using the arrays.
+
+    Example:
+        with SharedArrays() as sa:
+            b = sa.dumps({'catalog': numpy.zeros(10_000_000)})
+            pool.map(f, [b, b, b])  # f calls `loads(b)`
+    '''
+
+    def __init__(self, directory: Optional[str] = DEFAULT_DIR, min_bytes: int = 1024**2):
+        self._directory = directory
+        self._min_bytes = min_bytes
+        self._tmp_dir = None
+
+    def dumps(self, obj: Any) -> bytes:
+        f = io.BytesIO()
+        pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self._persistent_id  # type: ignore
+        pickler.dump(obj)
+        return f.getvalue()
+
+    def close(self):
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _persistent_id(self, obj: Any):
+        if isinstance(obj, numpy.ndarray) and obj.nbytes >= self._min_bytes and not obj.dtype.hasobject:
+            if self._tmp_dir is None:
+                self._tmp_dir = tempfile.mkdtemp(prefix='quickdb-shared-', dir=self._directory)
+            filename = f'{self._tmp_dir}/{secrets.token_hex(8)}.npy'
+            numpy.save(filename, obj)
+            return ('ndarray', filename)
+        return None
+
+
+def loads(b: bytes) -> Any:
+    unpickler = pickle.Unpickler(io.BytesIO(b))
+    unpickler.persistent_load = _persistent_load  # type: ignore
+    return unpickler.load()
+
+
+def _persistent_load(pid: List):
+    typename, filename = pid
+    assert typename == 'ndarray'
+    # copy-on-write so that code modifying the arrays in place works as before
+    return numpy.load(filename, mmap_mode='c')
@@ -0,0 +1,28 @@
+import os
+import pickle
+import unittest
+
+import numpy
+
+from .sharedarrays import SharedArrays, loads
+
+
+class TestSharedArrays(unittest.TestCase):
+    def test_large_arrays_are_memory_mapped(self):
+        large = numpy.arange(1024**2 // 8 * 2, dtype=numpy.float64)
+        small = numpy.arange(10)
+        with SharedArrays() as sa:
+            b = sa.dumps({'shared': {'large': large, 'small': small}})
+            self.assertLess(len(b), large.nbytes)
+            obj = loads(b)
+            self.assertIsInstance(obj['shared']['large'], numpy.memmap)
+            self.assertTrue((obj['shared']['large'] == large).all())
+            self.assertTrue((obj['shared']['small'] == small).all())
+            filename = obj['shared']['large'].filename
+            obj['shared']['large'][0] = -1  # copy on write
+            self.assertTrue((loads(b)['shared']['large'] == large).all())
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(obj['shared']['large'][1], 1)  # still readable after close
+
+    def test_plain_pickle(self):
+        self.assertEqual(loads(pickle.dumps({'a': 1})), {'a': 1})
@@ -0,0 +1,87 @@
+import collections
+import hashlib
+import io
+import pickle
+import threading
+from typing import Any, Callable, Dict, Sequence, Tuple
+
+import numpy
+
+from . import api
+
+# arrays smaller than this are sent with each request
+MIN_BYTES = 1024**2
+
+
+def pack(shared: Dict, min_bytes: int = MIN_BYTES) -> Tuple[api.SharedPayload, Dict[str, numpy.ndarray]]:
+    '''
+    Pickles `shared` replacing its large arrays with their digests.
+    Returns the payload and the arrays by digest, which are sent to workers which do not have them yet.
+    '''
+    arrays: Dict[str, numpy.ndarray] = {}
+
+    def persistent_id(obj: Any):
+        if isinstance(obj, numpy.ndarray) and obj.nbytes >= min_bytes and not obj.dtype.hasobject:
+            d = digest(obj)
+            arrays[d] = obj
+            return ('shared', d)
+        return None
+
+    f = io.BytesIO()
+    pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id  # type: ignore
+    pickler.dump(shared)
+    return api.SharedPayload(f.getvalue(), tuple(arrays)), arrays
+
+
+def digest(a: numpy.ndarray) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    h.update(repr((a.dtype.str, a.shape)).encode())
+    h.update(memoryview(numpy.ascontiguousarray(a)).cast('B'))
+    return h.hexdigest()
+
+
+class SharedCache:
+    '''
+    Keeps arrays of `shared` on a worker so that repeated queries with the same arrays do not send them again.
+    Least recently used arrays are dropped when the arrays exceed `max_bytes` in total.
+    '''
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._arrays: 'collections.OrderedDict[str, numpy.ndarray]' = collections.OrderedDict()
+        self._bytes = 0
+
+    def unpack(self, payload: api.SharedPayload, fetch: Callable[[Sequence[str]], Dict[str, numpy.ndarray]]) -> Dict:
+        '''
+        Unpickles `payload`. Arrays not in the cache are got with `fetch(digests)`.
+        '''
+        arrays: Dict[str, numpy.ndarray] = {}
+        with self._lock:
+            for d in payload.digests:
+                if d in self._arrays:
+                    self._arrays.move_to_end(d)
+                    arrays[d] = self._arrays[d]
+        missing = [d for d in payload.digests if d not in arrays]
+        if len(missing) > 0:
+            fetched = fetch(missing)
+            for d in missing:
+                arrays[d] = fetched[d]
+                self.put(d, fetched[d])
+        unpickler = pickle.Unpickler(io.BytesIO(payload.data))
+        unpickler.persistent_load = lambda pid: arrays[pid[1]]  # type: ignore
+        return unpickler.load()
+
+    def put(self, d: str, a: numpy.ndarray):
+        if a.nbytes > self._max_bytes:
+            return
+        with self._lock:
+            if d in self._arrays:
+                return
+            a.flags.writeable = False  # shared by jobs
+            self._arrays[d] = a
+            self._bytes += a.nbytes
+            while self._bytes > self._max_bytes:
+                _, dropped = self._arrays.popitem(last=False)
+                self._bytes -= dropped.nbytes
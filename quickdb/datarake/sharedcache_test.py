@@ -0,0 +1,44 @@
+import unittest
+
+import numpy
+
+from . import sharedcache
+
+
+class TestSharedCache(unittest.TestCase):
+    def test_pack_and_unpack(self):
+        big = numpy.arange(1_000_000)
+        small = numpy.arange(10)
+        payload, arrays = sharedcache.pack({'shared': {'big': big, 'small': small}})
+        self.assertEqual(list(arrays), [sharedcache.digest(big)])
+        self.assertLess(len(payload.data), 1000)
+
+        cache = sharedcache.SharedCache(max_bytes=100 * 1024**2)
+        fetched = []
+
+        def fetch(digests):
+            fetched.append(digests)
+            return {d: arrays[d] for d in digests}
+
+        for _ in range(2):
+            shared = cache.unpack(payload, fetch)
+            self.assertTrue(numpy.array_equal(shared['shared']['big'], big))
+            self.assertTrue(numpy.array_equal(shared['shared']['small'], small))
+        self.assertEqual(len(fetched), 1)
+
+    def test_digest(self):
+        a = numpy.arange(10)
+        self.assertEqual(sharedcache.digest(a), sharedcache.digest(a.copy()))
+        self.assertNotEqual(sharedcache.digest(a), sharedcache.digest(a.reshape((2, 5))))
+        self.assertNotEqual(sharedcache.digest(a), sharedcache.digest(a.astype(numpy.int32)))
+
+    def test_lru(self):
+        cache = sharedcache.SharedCache(max_bytes=2 * 8 * 100)
+        a, b, c = (numpy.full(100, i) for i in range(3))
+        da, db, dc = (sharedcache.digest(x) for x in (a, b, c))
+        cache.put(da, a)
+        cache.put(db, b)
+        payload, _ = sharedcache.pack(a, min_bytes=0)  # type: ignore
+        cache.unpack(payload, None)  # type: ignore # `a` is used
+        cache.put(dc, c)
+        self.assertEqual(list(cache._arrays), [da, dc])
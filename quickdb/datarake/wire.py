@@ -0,0 +1,82 @@
+'''
+Messages between master and workers.
+
+A message is a pickle (protocol 5) followed by its out-of-band buffers,
+so that data of numpy arrays is written to and read from sockets without being copied into the pickle.
+
+    header: pickle length, number of buffers
+    pickle
+    for each buffer:
+        flags (compressed or not), length of the data
+        data
+'''
+import pickle
+import struct
+import zlib
+from typing import Any, List, Optional, Protocol
+
+HEADER = struct.Struct('!QI')
+BUFFER_HEADER = struct.Struct('!BQ')
+COMPRESSED = 1
+
+# buffers smaller than this are not compressed
+MIN_COMPRESS_BYTES = 64 * 1024
+
+
+class Writable(Protocol):
+    def write(self, __data: Any) -> Optional[int]: ...
+    def flush(self) -> None: ...
+
+
+class Readable(Protocol):
+    def readinto(self, __buffer: Any) -> Optional[int]: ...
+
+
+def dump(obj: Any, wfile: Writable, compress_level: int = 0):
+    '''
+    Writes `obj` to `wfile`.
+    Buffers are compressed with zlib if `compress_level` > 0 and they get smaller.
+    '''
+    buffers: List[pickle.PickleBuffer] = []
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    wfile.write(HEADER.pack(len(data), len(buffers)) + data)
+    for buffer in buffers:
+        raw = buffer.raw()  # 1-dimensional contiguous view of the buffer
+        if compress_level > 0 and raw.nbytes >= MIN_COMPRESS_BYTES:
+            compressed = zlib.compress(raw, compress_level)
+            if len(compressed) < raw.nbytes:
+                wfile.write(BUFFER_HEADER.pack(COMPRESSED, len(compressed)))
+                wfile.write(compressed)
+                continue
+        wfile.write(BUFFER_HEADER.pack(0, raw.nbytes))
+        wfile.write(raw)
+    wfile.flush()
+
+
+def load(rfile: Readable) -> Any:
+    '''
+    Reads an object written by `dump` from `rfile`.
+    Arrays in the object are backed by the buffers read from `rfile`.
+    '''
+    data_size, n_buffers = HEADER.unpack(_read(rfile, HEADER.size))
+    data = _read(rfile, data_size)
+    buffers = []
+    for _ in range(n_buffers):
+        flags, size = BUFFER_HEADER.unpack(_read(rfile, BUFFER_HEADER.size))
+        buffer = _read(rfile, size)
+        if flags & COMPRESSED:
+            buffer = bytearray(zlib.decompress(buffer))
+        buffers.append(buffer)
+    return pickle.loads(data, buffers=buffers)
+
+
+def _read(rfile: Readable, size: int) -> bytearray:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    pos = 0
+    while pos < size:
+        n = rfile.readinto(view[pos:])
+        if not n:
+            raise EOFError(f'connection closed while reading {size} bytes')
+        pos += n
+    return buffer
@@ -0,0 +1,45 @@
+import io
+import unittest
+
+import numpy
+
+from . import api, wire
+
+
+class TestWire(unittest.TestCase):
+    def roundtrip(self, obj, **kwargs):
+        f = io.BytesIO()
+        wire.dump(obj, f, **kwargs)
+        f.seek(0)
+        return wire.load(f), f.getbuffer().nbytes
+
+    def test_arrays(self):
+        a = numpy.arange(1_000_000, dtype=numpy.float64)
+        b = numpy.array(['x', 'yy'])
+        res, _ = self.roundtrip(api.WorkerResult({'a': a, 'b': b, 'n': 1}))
+        self.assertIsInstance(res, api.WorkerResult)
+        self.assertTrue(numpy.array_equal(res.value['a'], a))
+        self.assertTrue(numpy.array_equal(res.value['b'], b))
+        self.assertEqual(res.value['n'], 1)
+        res.value['a'][0] = 1  # arrays are writable
+
+    def test_compression(self):
+        a = numpy.zeros(1_000_000)
+        res, size = self.roundtrip(a, compress_level=1)
+        self.assertTrue(numpy.array_equal(res, a))
+        self.assertLess(size, a.nbytes // 10)
+
+    def test_non_contiguous(self):
+        a = numpy.arange(100).reshape((10, 10)).T
+        res, _ = self.roundtrip(a)
+        self.assertTrue(numpy.array_equal(res, a))
+
+    def test_sequence(self):
+        f = io.BytesIO()
+        wire.dump(api.Progress(done=1, total=2), f)
+        wire.dump(api.Interrupt(), f)
+        f.seek(0)
+        self.assertEqual(wire.load(f)._asdict(), {'done': 1, 'total': 2, 'data': None})
+        self.assertEqual(wire.load(f), api.Interrupt())
+        with self.assertRaises(EOFError):
+            wire.load(f)
@@ -1,28 +1,41 @@
 import argparse
+import collections
 import contextlib
+import gc
 import logging
 import multiprocessing
 import os
-import pickle
+import queue
+import secrets
 import socketserver
 import subprocess
 import threading
-from typing import Callable, Dict, Tuple
+import time
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Optional, OrderedDict, Sequence, Tuple
 
 from quickdb.datarake.api import WorkerRequest
 from quickdb.datarake.auth import AuthError, authenticate
 from quickdb.datarake.interface import Progress, ProgressCB
+from quickdb.datarake.connection import ConnectionPool
+from quickdb.datarake.prefetch import Prefetcher, PrefetchStats
+from quickdb.datarake.scheduler import FairScheduler, WorkUnits
+from quickdb.datarake.sharedarrays import SharedArrays
+from quickdb.datarake.sharedcache import SharedCache
 from quickdb.sql2mapreduce.sqlast.sqlast import SqlError
+from quickdb.sspcatalog import manifest
 from quickdb.sspcatalog.errors import UserError
 from quickdb.utils.evaluate import evaluate
-from quickdb.utils.interruptableselect import (InterruptableSelect,
-                                               SelectInterrupted)
 
-from . import api, config
+from . import api, config, sharedarrays, wire
 
 
-class WorkerServer(socketserver.TCPServer):
-    pass
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    '''
+    Handles each connection from master in its own thread
+    so that multiple queries run at once.
+    '''
+    daemon_threads = True
 
 
 WorkerServer.allow_reuse_address = True
@@ -49,108 +62,432 @@ def main():
 
 
 class Handler(socketserver.StreamRequestHandler):
+    '''
+    Serves a connection from master.
+
+    Master keeps the connection open and sends `(request_id, message)` pairs over it.
+    Each `WorkerRequest` runs in its own thread and its progress and result are sent back with the same `request_id`,
+    so several requests run at once on a connection.
+    Jobs still running when the connection is closed are interrupted.
+    '''
+
     def handle(self):
         try:
-            authenticate(self)
+            peer = authenticate(self)
         except AuthError:
             return
 
-        def progress(p: Progress):
-            pickle.dump(p,  self.wfile)
-            self.wfile.flush()
+        write_lock = threading.Lock()
+        jobs: Dict[int, Job] = {}
+        threads: List[threading.Thread] = []
+
+        def send(request_id: int, message, compress_level=0):
+            with write_lock:
+                wire.dump((request_id, message), self.wfile, compress_level)
 
-        request: api.WorkerRequest = pickle.load(self.rfile)
-        job = Job(request)
-        with InterruptableSelect([self.rfile], [], []) as select:
-            def wait_for_interrupt():
+        try:
+            while True:
                 try:
-                    select.wait()
-                except SelectInterrupted:
-                    pass
-                else:  # got interrupt message
-                    job.interrupt()
-            wait_for_interrupt_th = threading.Thread(target=wait_for_interrupt)
-            wait_for_interrupt_th.start()
-            try:
-                result = job.run(progress)
-            except (UserError, SqlError) as e:
-                pickle.dump(api.UserError(str(e)), self.wfile)
-            except Exception as e:
-                pickle.dump(e, self.wfile)
-            else:
-                select.interrupt()
-                pickle.dump(api.WorkerResult(result), self.wfile)
-            finally:
-                select.interrupt()
-                wait_for_interrupt_th.join()
+                    request_id, message = wire.load(self.rfile)
+                except (EOFError, OSError):
+                    break
+                if peer and not isinstance(message, (api.Partial, api.Ping)):
+                    send(request_id, AuthError(f'{type(message).__name__} is not allowed from other workers'))
+                    break
+                if isinstance(message, api.WorkerRequest):
+                    job = Job(message, lambda digests, request_id=request_id: send(request_id, api.NeedShared(tuple(digests))))
+                    jobs[request_id] = job
+                    th = threading.Thread(target=self._run_job, args=(job, request_id, send, jobs), daemon=True)
+                    th.start()
+                    threads.append(th)
+                elif isinstance(message, api.Interrupt):
+                    if request_id in jobs:
+                        jobs[request_id].interrupt()
+                elif isinstance(message, api.SharedValues):
+                    if request_id in jobs:
+                        jobs[request_id].receive_shared(message.values)
+                elif isinstance(message, api.Partial):  # from a child in a tree reduction
+                    mailboxes.put(message)
+                    send(request_id, api.WorkerResult(None))
+                elif isinstance(message, api.RerunVersion):
+                    try:
+                        response = api.WorkerResult(rerun_version(message.rerun))
+                    except Exception as e:
+                        response = e
+                    send(request_id, response)
+                elif isinstance(message, api.Ping):
+                    send(request_id, api.Pong())
+                threads = [th for th in threads if th.is_alive()]
+        finally:
+            for job in list(jobs.values()):
+                job.interrupt()
+            for th in threads:
+                th.join()
+
+    @staticmethod
+    def _run_job(job: 'Job', request_id: int, send: Callable, jobs: Dict[int, 'Job']):
+        try:
+            result = job.run(lambda p: send(request_id, p, config.wire_compress_level))
+        except (UserError, SqlError) as e:
+            response = api.UserError(str(e))
+        except Exception as e:
+            response = e
+        else:
+            response = api.WorkerResult(result)
+        finally:
+            jobs.pop(request_id, None)
+        try:
+            send(request_id, response, config.wire_compress_level)
+        except OSError:  # connection closed
+            pass
+        except Exception as e:  # e.g. the result can not be pickled; nothing has been written then
+            with contextlib.suppress(OSError):
+                send(request_id, RuntimeError(repr(e)))
 
 
 class GetPool:
     def __init__(self):
         self._pool = None
+        self._scheduler = None
 
     def __call__(self, n_procs=None):
         if self._pool is None:
-            self._pool = multiprocessing.Pool(n_procs)
+            self._pool = multiprocessing.Pool(n_procs, initializer=_init_pool_process, initargs=(finished_jobs,))
+            self._scheduler = FairScheduler(self._pool, n_procs or os.cpu_count() or 1)
         return self._pool
 
+    @property
+    def scheduler(self) -> FairScheduler:
+        '''
+        Shares the pool among jobs running at once
+        '''
+        self()
+        assert self._scheduler is not None
+        return self._scheduler
+
 
 get_pool = GetPool()
 
+# until the speed of a job is known, each process of the pool gets at least this many chunks of the job,
+# so that chunks of concurrent jobs are interleaved finely
+CHUNKS_PER_PROCESS = 8
+
 
 class Job:
-    def __init__(self, request: api.WorkerRequest):
+    def __init__(self, request: api.WorkerRequest, ask_shared: Optional[Callable[[Sequence[str]], None]] = None):
+        '''
+        `ask_shared(digests)` asks master for arrays of `request.shared` which are not in `shared_cache`.
+        They are given to `receive_shared`.
+        '''
         self._request = request
+        self._ask_shared = ask_shared
+        self._shared_values: queue.Queue = queue.Queue()
         self._interrupted = False
+        self._id = secrets.token_hex(16)
+        self._reducer: Callable = None  # type: ignore
+
+    def run(self, progress: Optional[ProgressCB] = None):
+        tree = self._request.tree
+        if tree is None:
+            return self._run(progress)
+        try:
+            try:
+                result = self._run(progress)
+            except Exception as e:
+                if tree.parent is not None:  # the parent should not wait for this worker
+                    with contextlib.suppress(OSError):
+                        send_partial(tree, None, f'{e}@{config.hostname}')
+                raise
+            return self._reduce_tree(tree, result)
+        finally:
+            mailboxes.discard(tree.mailbox)
+
+    def _reduce_tree(self, tree: api.TreeNode, result):
+        '''
+        Merges partial results of children into `result` and sends it to the parent.
+        '''
+        reducer = self._reducer
+        box = mailboxes.get(tree.mailbox)
+        error = None
+        for _ in range(tree.n_children):
+            while True:
+                if self._interrupted:
+                    raise UserError('Cancelled')
+                try:
+                    partial: api.Partial = box.get(timeout=1.)
+                    break
+                except queue.Empty:
+                    pass
+            if partial.error is not None:
+                error = error or partial.error
+            elif partial.value is not None:
+                result = partial.value if result is None else reducer(result, partial.value)
+        if tree.parent is not None:
+            send_partial(tree, result, error)
+            return None
+        if error is not None:
+            raise RuntimeError(error)
+        return result
 
-    def run(self, progress: ProgressCB = None):
+    def _run(self, progress: Optional[ProgressCB] = None):
         make_env = self._request.make_env
         shared = self._request.shared
+        if isinstance(shared, api.SharedPayload):
+            shared = shared_cache.unpack(shared, self._fetch_shared)
         env = evaluate(make_env, dict(shared))  # pass a copy of `shared` because `evaluate` affects passed `shared` object.
-        reducer = env['reducer']
+        reducer = self._reducer = env['reducer']
         streaming = env.get('streaming', False)
         tasks = config.tasks(env)
-        pool = get_pool()
-        chunksize = env.get('chunksize') or min(len(tasks) // multiprocessing.cpu_count() + 1, 1024)
-        items = [(self, make_env, shared, slice(start, start + chunksize)) for start in range(0, len(tasks), chunksize)]
+        scheduler = get_pool.scheduler
+        sizes = task_sizes(tasks)
+        units = WorkUnits(sizes, multiprocessing.cpu_count(), max_units_per_proc=CHUNKS_PER_PROCESS)
+        chunksize = env.get('chunksize')
+        if chunksize:  # fixed chunks in the order of tasks
+            chunks: Iterable[List[int]] = (list(range(start, min(start + chunksize, len(tasks)))) for start in range(0, len(tasks), chunksize))
+        else:  # largest tasks first, smaller chunks toward the end
+            chunks = units
+        total = sum(sizes)
+        done = 0
+        prefetch_stats = PrefetchStats(0, 0)
         result = None
-        for i, value in enumerate(pool.imap_unordered(Job._process_partial_tasks, items)):
-            if self._interrupted:
-                raise UserError('Cancelled')
-            if streaming:
-                progress and progress(Progress(done=i+1, total=len(items), data=value))
-            else:
-                result = value if i == 0 else reducer(result, value)
-                progress and progress(Progress(done=i + 1, total=len(items)))
+        with SharedArrays() as shared_arrays, finishing(self._id):
+            # `shared` is pickled once here instead of once for each chunk
+            # and its large arrays are memory-mapped by pool processes
+            shared_pickle = shared_arrays.dumps(shared)
+            # chunks are made lazily so that their sizes follow the speed observed so far
+            items = ((self._id, make_env, shared_pickle, part) for part in chunks)
+            values = scheduler.imap_unordered(Job._process_partial_tasks, items)
+            with contextlib.closing(values):  # chunks not started yet are cancelled on errors
+                for i, (part, value, stats, elapsed) in enumerate(values):
+                    if self._interrupted:
+                        raise UserError('Cancelled')
+                    rows = sum(sizes[j] for j in part)
+                    units.observe(rows, elapsed)
+                    done += rows
+                    prefetch_stats += stats
+                    if streaming:
+                        progress and progress(Progress(done=done, total=total, data=value))
+                    else:
+                        result = value if i == 0 else reducer(result, value)
+                        progress and progress(Progress(done=done, total=total))
+        if config.column_cache:
+            logging.info(f'column cache: {config.column_cache.stats._asdict()}')
+        if 'prefetch' in env:
+            logging.info(f'prefetch: {prefetch_stats._asdict()}')
         return result
 
     def interrupt(self):
         self._interrupted = True
 
+    def receive_shared(self, values: Dict[str, Any]):
+        self._shared_values.put(values)
+
+    def _fetch_shared(self, digests: Sequence[str]) -> Dict[str, Any]:
+        assert self._ask_shared is not None
+        self._ask_shared(digests)
+        while True:
+            if self._interrupted:
+                raise UserError('Cancelled')
+            try:
+                return self._shared_values.get(timeout=1.)
+            except queue.Empty:
+                pass
+
     @staticmethod
-    def _process_partial_tasks(args: Tuple['Job', str, Dict, slice]):
-        job, make_env, shared, part = args
+    def _process_partial_tasks(args: Tuple[str, str, bytes, List[int]]):
+        job_id, make_env, shared_pickle, part = args
         from functools import reduce
-        env = cached_evaluate(job, make_env, shared)
-        tasks = config.tasks(env)
+        start = time.time()
+        env = job_envs(job_id, make_env, shared_pickle)
+        all_tasks = config.tasks(env)
+        tasks = [all_tasks[j] for j in part]
         mapper = config.mapper_wrapper(env['mapper'])
         reducer = env['reducer']
-        return reduce(reducer, map(mapper, tasks[part]))
-
+        if 'prefetch' in env:
+            # columns of next patches are read ahead while the mapper is working on the current one
+            prefetcher = Prefetcher(tasks, lambda task: task.prefetch(env['prefetch']), config.prefetch_depth)
+        else:
+            prefetcher = Prefetcher(tasks, lambda task: None, 0)
+        value = reduce(reducer, map(mapper, prefetcher))
+        return part, value, prefetcher.stats, time.time() - start
+
+
+class JobEnvs:
+    '''
+    Keeps environments of jobs in a pool process,
+    so that `make_env` is evaluated once per job instead of once per chunk.
+    '''
+
+    def __init__(self, maxsize=8):
+        self._envs: 'collections.OrderedDict[str, Dict]' = collections.OrderedDict()
+        self._maxsize = maxsize
+        self._lock = threading.Lock()  # `drop` is called from another thread
+
+    def __call__(self, job_id: str, make_env: str, shared_pickle: bytes) -> Dict:
+        with self._lock:
+            if job_id in self._envs:
+                self._envs.move_to_end(job_id)
+                return self._envs[job_id]
+        env = evaluate(make_env, sharedarrays.loads(shared_pickle))
+        with self._lock:
+            self._envs[job_id] = env
+            while len(self._envs) > self._maxsize:
+                self._envs.popitem(last=False)
+        return env
+
+    def drop(self, job_id: str):
+        with self._lock:
+            env = self._envs.pop(job_id, None)
+        if env is not None:
+            del env
+            gc.collect()  # functions in `env` refer to `env` itself; its arrays are unmapped only when it is collected
+
+
+job_envs = JobEnvs()
+
+
+class FinishedJobs:
+    '''
+    Tells pool processes the ids of finished jobs as soon as the jobs end,
+    so that the processes drop the environments of the jobs and unmap their shared arrays even when no other job comes.
+    The last `size` ids are kept in shared memory which pool processes poll without locks,
+    so that a process killed while reading them blocks nobody.
+    A process which falls further behind misses the older ids, whose environments are eventually dropped by `JobEnvs` anyway.
+    '''
+
+    ID_BYTES = 32  # length of `Job._id`
+
+    def __init__(self, size: int = 64):
+        self._size = size
+        self._lock = threading.Lock()
+        self._count = multiprocessing.Value('q', 0, lock=False)
+        self._ids = multiprocessing.Array('c', size * self.ID_BYTES, lock=False)
+
+    def add(self, job_id: str):
+        n = self.ID_BYTES
+        with self._lock:
+            i = self._count.value % self._size
+            # the slot is written before the count is incremented, and readers skip the slot written next
+            self._ids[i * n:(i + 1) * n] = job_id.encode().ljust(n)[:n]
+            self._count.value += 1
+
+    def listen(self, on_finished: Callable[[str], None], interval: float = 1.):
+        '''
+        Calls `on_finished(job_id)` for jobs finished from now on, checking for them every `interval` seconds. Never returns.
+        '''
+        n = self.ID_BYTES
+        seen = self._count.value
+        while True:
+            time.sleep(interval)
+            count = self._count.value
+            for k in range(max(seen, count - self._size + 1), count):
+                i = k % self._size
+                on_finished(self._ids[i * n:(i + 1) * n].decode().strip())
+            seen = count
+
+
+finished_jobs = FinishedJobs()
+
+
+def _init_pool_process(finished: FinishedJobs):
+    threading.Thread(target=finished.listen, args=(job_envs.drop,), daemon=True).start()
+
+
+class Mailboxes:
+    '''
+    Keeps partial results sent from children in tree reductions until the job of the reduction takes them.
+    A partial result can arrive before the request for the reduction does.
+    A partial result arriving after the job has ended (e.g. failed) is dropped.
+    '''
+
+    def __init__(self, max_discarded: int = 1024):
+        self._lock = threading.Lock()
+        self._boxes: Dict[str, queue.Queue] = {}
+        # recently discarded mailboxes, oldest first
+        self._discarded: OrderedDict[str, None] = collections.OrderedDict()
+        self._max_discarded = max_discarded
+
+    def get(self, mailbox: str) -> queue.Queue:
+        with self._lock:
+            return self._get(mailbox)
+
+    def put(self, partial: api.Partial):
+        with self._lock:
+            if partial.mailbox in self._discarded:
+                return
+            self._get(partial.mailbox).put(partial)
+
+    def discard(self, mailbox: str):
+        with self._lock:
+            self._boxes.pop(mailbox, None)
+            self._discarded[mailbox] = None
+            if len(self._discarded) > self._max_discarded:
+                self._discarded.popitem(last=False)
+
+    def _get(self, mailbox: str) -> queue.Queue:
+        if mailbox not in self._boxes:
+            self._boxes[mailbox] = queue.Queue()
+        return self._boxes[mailbox]
+
+
+mailboxes = Mailboxes()
+
+# arrays of `shared` sent from master, which are reused by later queries with the same arrays
+shared_cache = SharedCache(config.shared_cache_bytes)
+
+# connections to other workers for tree reductions
+peer_connections = ConnectionPool()
+
+
+def task_sizes(tasks: Sequence) -> List[int]:
+    '''
+    Sizes of `tasks` to balance chunks with.
+    Rows are used only if all tasks are patches listed in the manifest (they have versions then),
+    because reading `meta.pickle` of every patch here would take longer than balancing saves.
+    Otherwise each task counts as 1.
+    '''
+    if all(getattr(task, 'version', None) is not None for task in tasks):
+        return [task.size for task in tasks]
+    return [1] * len(tasks)
+
+
+def send_partial(tree: api.TreeNode, value, error: Optional[str]):
+    '''
+    Sends a partial result to `parent_mailbox` of the parent of `tree`.
+    '''
+    assert tree.parent is not None and tree.parent_mailbox is not None
+    with peer_connections.request(tree.parent, api.Partial(tree.parent_mailbox, value, error)) as request:
+        res = request.get()  # wait for the parent to receive it
+    if isinstance(res, Exception):
+        raise res
+
+
+def rerun_version(rerun: str) -> Optional[str]:
+    '''
+    Version of the data of `rerun` on this worker, which changes when the rerun is deployed again.
+    None if the rerun has no manifest.
+    '''
+    if '/' in rerun:
+        return None
+    filename = f'{config.rerun_dir(rerun)}/{manifest.MANIFEST_FILE}'
+    try:
+        mtime = os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return _manifest_version(filename, mtime)
 
-class CachedEvaluate:
-    def __init__(self):
-        self._job = None
-        self._cache = None
 
-    def __call__(self, job: Job, make_env: str, shared: Dict):
-        if self._job is not job:
-            self._job = job
-            self._cache = evaluate(make_env, shared)
-        return self._cache
+@lru_cache(maxsize=64)
+def _manifest_version(filename: str, mtime: int) -> str:
+    return manifest.read_manifest(filename).version
 
 
-cached_evaluate = CachedEvaluate()
+@contextlib.contextmanager
+def finishing(job_id: str):
+    try:
+        yield
+    finally:
+        finished_jobs.add(job_id)
 
 
 @contextlib.contextmanager
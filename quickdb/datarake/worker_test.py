@@ -1,21 +1,27 @@
 from contextlib import contextmanager
 from functools import lru_cache, reduce
+import multiprocessing
 import os
 import pickle
+import queue
+import secrets
 from quickdb.utils.evaluate import evaluate
 from typing import Dict
 from quickdb.datarake.interface import Progress, ProgressCB
 import socket
 import socketserver
 import threading
+import time
 import unittest
 
-from quickdb.datarake.auth import AuthError, knock
+from quickdb.datarake.auth import AuthError, authenticate, knock
 from quickdb.sspcatalog.errors import UserError
 from quickdb.test_config import REPO_DIR
 
 from . import api
 from . import config
+from . import connection
+from . import wire
 from . import worker
 
 SOCK_FILE = './test.sock'
@@ -58,6 +64,28 @@ class TestWorker(ConfigSetting):
             all(history[i + 1] - history[i] > 0 for i in range(len(history) - 1))
         )
 
+    def test_concurrent_jobs(self):
+        make_env = '''
+        def mapper(patch):
+            return patch.size
+
+        def reducer(a, b):
+            return a + b
+
+        chunksize = 1
+        '''
+        results = []
+
+        def run():
+            results.append(worker.Job(api.WorkerRequest(make_env, {})).run())
+
+        threads = [threading.Thread(target=run) for _ in range(3)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        self.assertEqual(results, [process_request_simple(make_env, {})] * 3)
+
     def test_process_request_exception(self):
         make_env = '''
         def mapper(patch):
@@ -71,6 +99,62 @@ class TestWorker(ConfigSetting):
             worker.Job(api.WorkerRequest(make_env, {})).run()
 
 
+class TestJobEnvs(unittest.TestCase):
+    def test_evaluated_once_per_job(self):
+        job_envs = worker.JobEnvs(maxsize=2)
+        make_env = '''
+        evaluated.append(1)
+        '''
+        evaluated = []
+        shared_pickle = pickle.dumps({'evaluated': evaluated})
+        env = job_envs('a', make_env, shared_pickle)
+        self.assertIs(job_envs('a', make_env, shared_pickle), env)
+        self.assertEqual(env['evaluated'], [1])
+        self.assertIsNot(job_envs('b', make_env, shared_pickle), env)
+        job_envs.drop('a')
+        self.assertIsNot(job_envs('a', make_env, shared_pickle), env)
+
+    def test_maxsize(self):
+        job_envs = worker.JobEnvs(maxsize=2)
+        shared_pickle = pickle.dumps({})
+        env = job_envs('a', '', shared_pickle)
+        job_envs('b', '', shared_pickle)
+        job_envs('c', '', shared_pickle)
+        self.assertIsNot(job_envs('a', '', shared_pickle), env)
+
+
+class TestFinishedJobs(unittest.TestCase):
+    def test_listen(self):
+        finished = worker.FinishedJobs(size=2)
+        finished.add(secrets.token_hex(16))  # finished before listening
+        received: queue.Queue = queue.Queue()
+        threading.Thread(target=finished.listen, args=(received.put, 0.01), daemon=True).start()
+        time.sleep(0.1)
+        for _ in range(3):
+            job_id = secrets.token_hex(16)
+            finished.add(job_id)
+            self.assertEqual(received.get(timeout=5.), job_id)
+        self.assertTrue(received.empty())
+
+    def test_pool_process_drops_env(self):
+        pool = multiprocessing.Pool(1, initializer=worker._init_pool_process, initargs=(worker.finished_jobs,))
+        try:
+            args = ('job-a', 'x = 1', pickle.dumps({}))
+            self.assertEqual(pool.apply(_env_count, args), 1)
+            worker.finished_jobs.add('job-a')
+            time.sleep(2.)
+            self.assertEqual(pool.apply(_env_count, ()), 0)
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def _env_count(*args):
+    if args:
+        worker.job_envs(*args)
+    return len(worker.job_envs._envs)
+
+
 class ServerTest(unittest.TestCase):
     def _cleanup(self):
         try:
@@ -103,15 +187,40 @@ class ServerTest(unittest.TestCase):
         th.start()
         th.ready.wait()
 
-        with socket.socket(socket.AF_UNIX) as sock:
-            sock.connect(SOCK_FILE)
-            try:
-                wfile = sock.makefile('wb', buffering=0)
-                rfile = sock.makefile('rb')
-                yield wfile, rfile
-            finally:
-                th.server.shutdown()
-                th.join()
+        try:
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.connect(SOCK_FILE)
+                with sock.makefile('wb', buffering=0) as wfile, sock.makefile('rb') as rfile:
+                    yield wfile, rfile
+        finally:
+            # the handler returns when the connection is closed
+            th.server.shutdown()
+            th.join()
+
+
+class TestMailboxes(unittest.TestCase):
+    def test_late_partial(self):
+        boxes = worker.Mailboxes(max_discarded=2)
+        boxes.put(api.Partial('a', 1, None))
+        self.assertEqual(boxes.get('a').get_nowait().value, 1)
+        boxes.discard('a')
+        boxes.put(api.Partial('a', 2, None))  # dropped
+        self.assertEqual(boxes._boxes, {})
+        boxes.discard('b')
+        boxes.discard('c')
+        self.assertEqual(list(boxes._discarded), ['b', 'c'])
+
+
+class TestTaskSizes(unittest.TestCase):
+    def test_task_sizes(self):
+        class Task:
+            def __init__(self, size, version):
+                self.size = size
+                self.version = version
+
+        self.assertEqual(worker.task_sizes([Task(3, 'a'), Task(5, 'b')]), [3, 5])
+        self.assertEqual(worker.task_sizes([Task(3, 'a'), Task(5, None)]), [1, 1])
+        self.assertEqual(worker.task_sizes([object(), object()]), [1, 1])
 
 
 class TestServer(ServerTest, ConfigSetting):
@@ -126,10 +235,10 @@ class TestServer(ServerTest, ConfigSetting):
                 return a + b
             '''
 
-            pickle.dump(api.WorkerRequest(make_env, {}), wfile)
+            wire.dump((0, api.WorkerRequest(make_env, {})), wfile)
             wfile.close()
             while True:
-                res = pickle.load(rfile)
+                request_id, res = wire.load(rfile)
                 if not isinstance(res, api.Progress):
                     break
             res: api.WorkerResult = res
@@ -155,14 +264,37 @@ class TestServer(ServerTest, ConfigSetting):
                 return a + b
             '''
 
-            pickle.dump(api.WorkerRequest(make_env, {}), wfile)
+            wire.dump((0, api.WorkerRequest(make_env, {})), wfile)
             wfile.close()
             while True:
-                res = pickle.load(rfile)
+                request_id, res = wire.load(rfile)
                 if not isinstance(res, api.Progress):
                     break
             self.assertIsInstance(res, ZeroDivisionError)
 
+    def test_unpicklable_result(self):
+        with self.server() as (wfile, rfile):
+            knock(wfile, rfile)
+            make_env = '''
+            import threading
+
+            def mapper(patch):
+                return patch.size
+
+            def reducer(a, b):
+                return threading.Lock()
+
+            chunksize = 1
+            '''
+
+            wire.dump((0, api.WorkerRequest(make_env, {})), wfile)
+            wfile.close()
+            while True:
+                request_id, res = wire.load(rfile)
+                if not isinstance(res, api.Progress):
+                    break
+            self.assertIsInstance(res, RuntimeError)
+
     def test_interrupt(self):
         with self.server() as (wfile, rfile):
             import time
@@ -181,17 +313,203 @@ class TestServer(ServerTest, ConfigSetting):
             chunksize = 1
             '''
 
-            pickle.dump(api.WorkerRequest(make_env, {}), wfile)
+            wire.dump((0, api.WorkerRequest(make_env, {})), wfile)
             time.sleep(0.1)
-            pickle.dump(api.Interrupt(), wfile)
+            wire.dump((0, api.Interrupt()), wfile)
             wfile.close()
             while True:
-                res = pickle.load(rfile)
+                request_id, res = wire.load(rfile)
                 if not isinstance(res, api.Progress):
                     break
             self.assertIsInstance(res, api.UserError)
 
 
+class TestConnectionPool(ConfigSetting):
+    make_env = '''
+    def mapper(patch):
+        return patch.size
+
+    def reducer(a, b):
+        return a + b
+    '''
+
+    @contextmanager
+    def server(self):
+        server = worker.WorkerServer(('127.0.0.1', 0), worker.Handler)
+        th = threading.Thread(target=server.serve_forever)
+        th.start()
+        try:
+            yield api.Address('127.0.0.1', server.server_address[1])
+        finally:
+            server.shutdown()
+            server.server_close()
+            th.join()
+
+    def request(self, pool, w):
+        with pool.request(w, api.WorkerRequest(self.make_env, {})) as request:
+            while True:
+                res = request.get()
+                if not isinstance(res, api.Progress):
+                    return res
+
+    def test_concurrent_requests(self):
+        pool = connection.ConnectionPool()
+        with self.server() as w:
+            expected = process_request_simple(self.make_env, {})
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(self.request(pool, w).value)) for _ in range(4)]
+            for th in threads:
+                th.start()
+            for th in threads:
+                th.join()
+            self.assertEqual(results, [expected] * 4)
+            conn = pool.get(w)
+            self.assertTrue(conn.ping(5.))
+            self.assertIs(pool.get(w), conn)
+            pool.close()
+
+    def test_reconnect(self):
+        pool = connection.ConnectionPool(ping_after=0.)
+        with self.server() as w:
+            conn = pool.get(w)
+            conn.close()
+            self.assertIsNot(pool.get(w), conn)
+            self.assertIsInstance(self.request(pool, w), api.WorkerResult)
+            pool.close()
+
+    def test_peer_may_only_send_partials(self):
+        with self.server() as w:
+            # connections from 127.0.0.1 come from another worker
+            saved = config.master_addr, config.workers, config.tree_reduce_fanin
+            config.master_addr, config.workers, config.tree_reduce_fanin = '192.0.2.1', [w], 0
+            pool = connection.ConnectionPool()
+            try:
+                with self.assertRaises(AuthError):  # tree reductions are disabled
+                    pool.get(w)
+                config.tree_reduce_fanin = 2
+                with pool.request(w, api.Partial('peer-test', 1, None)) as request:
+                    self.assertIsInstance(request.get(), api.WorkerResult)
+                with pool.request(w, api.WorkerRequest(self.make_env, {})) as request:
+                    self.assertIsInstance(request.get(), AuthError)
+            finally:
+                pool.close()
+                worker.mailboxes.discard('peer-test')
+                config.master_addr, config.workers, config.tree_reduce_fanin = saved
+
+    def test_broken_message(self):
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                authenticate(self)
+                wire.load(self.rfile)
+                data = b'cno_such_module\nX\n.'  # a pickle which can not be loaded
+                self.wfile.write(wire.HEADER.pack(len(data), 0) + data)
+                self.rfile.read()  # until master closes the connection
+
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        th = threading.Thread(target=server.serve_forever)
+        th.start()
+        try:
+            conn = connection.Connection(api.Address('127.0.0.1', server.server_address[1]))
+            request = conn.start(api.Ping())
+            with self.assertRaisesRegex(connection.ConnectionClosed, 'no_such_module'):
+                request.get()
+            self.assertTrue(conn.closed)
+        finally:
+            server.shutdown()
+            server.server_close()
+            th.join()
+
+
+class TestLocalWorkers(ConfigSetting):
+    def setUp(self):
+        super().setUp()
+        self._servers = [worker.WorkerServer(('127.0.0.1', 0), worker.Handler) for _ in range(5)]
+        for server in self._servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        config.workers, self._workers = [api.Address('127.0.0.1', server.server_address[1]) for server in self._servers], config.workers
+        config.tree_reduce_fanin, self._tree_reduce_fanin = 2, config.tree_reduce_fanin
+
+    def tearDown(self):
+        from . import master
+        master.connections.close()
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        config.workers = self._workers
+        config.tree_reduce_fanin = self._tree_reduce_fanin
+        super().tearDown()
+
+    def test_tree_reduce(self):
+        from . import master
+        make_env = '''
+        def mapper(patch):
+            return patch.size
+
+        def reducer(a, b):
+            return a + b
+
+        tree_reduce_fanin = 2
+        '''
+        self.assertEqual(master.run_make_env(make_env, {}), 5 * process_request_simple(make_env, {}))
+
+    def test_error(self):
+        from . import master
+        make_env = '''
+        def mapper(patch):
+            0 / 0
+
+        def reducer(a, b):
+            return a + b
+
+        tree_reduce_fanin = 2
+        '''
+        with self.assertRaises(RuntimeError):
+            master.run_make_env(make_env, {})
+
+
+    def test_shared_arrays_are_cached(self):
+        import numpy
+        from . import master
+        make_env = '''
+        def mapper(patch):
+            return float(a.sum())
+
+        def reducer(a, b):
+            return a + b
+        '''
+        a = numpy.random.random(1_000_000)
+        asked = []
+        receive_shared = worker.Job.receive_shared
+
+        def receive_shared_spy(job, values):
+            asked.append(values)
+            receive_shared(job, values)
+
+        worker.Job.receive_shared = receive_shared_spy  # type: ignore
+        try:
+            for _ in range(2):
+                self.assertAlmostEqual(master.run_make_env(make_env, {'a': a}), 5 * len(patches('pdr2_dud')) * a.sum())
+        finally:
+            worker.Job.receive_shared = receive_shared  # type: ignore
+        self.assertGreater(len(asked), 0)
+        self.assertLessEqual(len(asked), 5)  # only in the first run
+
+
+    def test_data_version(self):
+        from quickdb.sspcatalog.patch import Rerun
+        from . import master
+        config.rerun_dir, rerun_dir = (lambda rerun: f'{REPO_DIR}/{rerun}'), config.rerun_dir
+        try:
+            version = master.data_version('pdr2_dud')
+            self.assertIsNone(master.data_version('no_such_rerun'))
+        finally:
+            config.rerun_dir = rerun_dir
+        if Rerun(f'{REPO_DIR}/pdr2_dud').version is None:
+            self.assertIsNone(version)
+        else:
+            self.assertIsInstance(version, str)
+
+
 def get_tasks(env):
     return patches('pdr2_dud')
 
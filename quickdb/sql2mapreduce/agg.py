@@ -1,16 +1,24 @@
 import abc
+import glob
+import hashlib
+import os
+import pickle
+from functools import lru_cache
+from quickdb.datarake import sharedcache
 from quickdb.datarake.safeevent import SafeEvent
 from typing import (
-    Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Type, Union, cast)
+    Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Type, Union, cast)
 
 import numpy
 
 from quickdb.datarake.interface import Progress, ProgressCB, RunMakeEnv
 from quickdb.sql2mapreduce.numpy_context import NumpyContext
+from quickdb.sql2mapreduce.pruning import may_match
 from quickdb.sql2mapreduce.sqlast.sqlast import (
     ColumnRefExpression, Context, Expression, FuncCallExpression, Select,
     SqlError)
 from quickdb.sspcatalog.patch import Patch
+from quickdb.utils.cached_property import cached_property
 
 
 class AggCall(metaclass=abc.ABCMeta):  # pragma: no cover
@@ -30,6 +38,26 @@ class AggCall(metaclass=abc.ABCMeta):  # pragma: no cover
     def finalizer(self, a):
         ...
 
+    def grouped_mapper(self, context: 'GroupedAggContext', codes: numpy.ndarray, ngroups: int) -> Union[None, Sequence, numpy.ndarray]:
+        '''
+        Returns the values of `mapper` for all groups computed in a single pass over `context`,
+        where `codes[j]` is the index of the group of the j-th row.
+        Aggregations returning None are mapped for each group with `mapper`.
+        '''
+        return None
+
+    def to_column(self, values: Union[Sequence, numpy.ndarray]) -> numpy.ndarray:
+        '''
+        Holds mapped values of groups in an array (see `GroupedPartial`).
+        '''
+        return object_array(values)
+
+    def reduce_columns(self, a: numpy.ndarray, b: numpy.ndarray) -> numpy.ndarray:
+        '''
+        Reduces arrays made by `to_column` elementwise.
+        '''
+        return object_array([self.reducer(x, y) for x, y in zip(a, b)])
+
     @property
     def subaggrs(self) -> List['AggCall']:
         return []
@@ -37,6 +65,9 @@ class AggCall(metaclass=abc.ABCMeta):  # pragma: no cover
     def result(self, context: 'AggContext'):
         return context._agg_results[self][context._group_value]
 
+    def grouped_result(self, context: 'GroupedAggContext') -> List:
+        return [context._agg_results[self][gv] for gv in context.group_values]
+
 
 class AggContext(NumpyContext):
     def __init__(self, patch: Patch, agg_results: Dict, group_value, shared: Dict = None):
@@ -57,6 +88,27 @@ class AggContext(NumpyContext):
         return self._patch.size
 
 
+class GroupedAggContext(AggContext):
+    '''
+    Context of all groups of a patch.
+    Results of the previous stages are evaluated to arrays of the values for the groups of the rows.
+    '''
+
+    def __init__(self, patch: Patch, agg_results: Dict, keys: List[numpy.ndarray], codes: numpy.ndarray, shared: Dict = None):
+        super().__init__(patch, agg_results, group_value=None, shared=shared)
+        self._keys = keys
+        self._codes = codes
+
+    @cached_property
+    def group_values(self) -> List[Tuple]:
+        return list(zip(*self._keys))
+
+    def evaluate_FuncCallExpression(self, e: FuncCallExpression):
+        if e in self._agg_results:
+            return numpy.asarray([self._agg_results[e][gv] for gv in self.group_values])[self._codes]
+        return NumpyContext.evaluate_FuncCallExpression(self, e)
+
+
 class FinalizeContext(AggContext):
     def __init__(self, agg_results: Dict, group_value, shared: Dict = None):
         super().__init__(None, agg_results, group_value, shared=shared)  # type: ignore
@@ -91,7 +143,9 @@ def run_agg_query(select: Select, run_make_env: RunMakeEnv, shared: Dict = None,
 
     make_env = '''
     from quickdb.sql2mapreduce.agg import agg1_env
-    rerun, mapper, reducer, finalizer = agg1_env(agg, select, agg_results, shared)
+    from quickdb.sql2mapreduce.numpy_context import referenced_columns
+    rerun, mapper, reducer, finalizer = agg1_env(aggs, select, agg_results, shared, plan_hash)
+    prefetch = referenced_columns(select)
     '''
 
     check_select(select)
@@ -114,16 +168,23 @@ def run_agg_query(select: Select, run_make_env: RunMakeEnv, shared: Dict = None,
         raise SqlError(f'No aggregation operation')
 
     # run aggregation queries
+    # aggregations that do not depend on each other are computed in a single scan
     agg_results: Dict[Union[Expression, AggCall], Any] = {}
-    for i, (e, agg) in enumerate(aggs):
+    stages = plan_stages([a for e, a in aggs])
+    for i, stage in enumerate(stages):
         def progress1(p1: Progress):
             if progress:
-                progress(Progress(done=p1.done + i * p1.total, total=p1.total * len(aggs)))
-        env_context = {'agg': agg, 'select': select, 'agg_results': agg_results, 'shared': shared}
-        result = run_make_env(make_env, env_context, progress1, interrupt_notifiyer)
-        agg_results[agg] = result
+                progress(Progress(done=p1.done + i * p1.total, total=p1.total * len(stages)))
+        env_context = {
+            'aggs': stage, 'select': select, 'agg_results': agg_results, 'shared': shared,
+            'plan_hash': plan_hash(select, i, [[agg_results[a] for a in s] for s in stages[:i]], shared),
+        }
+        results = run_make_env(make_env, env_context, progress1, interrupt_notifiyer)
+        for agg, result in zip(stage, results):
+            agg_results[agg] = result
+    for e, agg in aggs:
         if e:
-            agg_results[e] = result
+            agg_results[e] = agg_results[agg]
 
     group_values = next(iter(agg_results.values())).keys()
 
@@ -167,63 +228,221 @@ def check_select(select: Select):  # pragma: no cover
 
 
 def walk_subaggrs(a: AggCall, f: Callable[[AggCall], None]):
-    q = a.subaggrs
+    q = list(a.subaggrs)
     while len(q) > 0:
         a = q.pop(0)
         f(a)
         q += a.subaggrs
 
 
-MapperResult = Dict
+def plan_stages(aggs: List[AggCall]) -> List[List[AggCall]]:
+    '''
+    Splits `aggs` into stages.
+    Aggregations in a stage depend only on results of the preceding stages,
+    so each stage can be computed in one scan.
+    '''
+    def depth(a: AggCall) -> int:
+        return max((depth(sa) + 1 for sa in a.subaggrs), default=0)
+
+    stages: List[List[AggCall]] = []
+    for a in aggs:
+        d = depth(a)
+        while len(stages) <= d:
+            stages.append([])
+        stages[d].append(a)
+    return [stage for stage in stages if len(stage) > 0]
+
+
+class GroupedPartial:
+    '''
+    Mapped values of groups held in arrays.
+    `keys[k][i]` is the k-th group value of the i-th group and `columns[j][i]` is the mapped value of the j-th aggregation for the group.
+    Groups are sorted by their keys so that partials are merged with a sort-merge of the arrays.
+    '''
+
+    def __init__(self, keys: List[numpy.ndarray], columns: List[numpy.ndarray]):
+        order = numpy.lexsort(keys[::-1])
+        self.keys = [k[order] for k in keys]
+        self.columns = [c[order] for c in columns]
+
+    def __len__(self):
+        return len(self.keys[0])
+
+    def items(self) -> Iterator[Tuple[Tuple, Tuple]]:
+        return zip(zip(*self.keys), zip(*self.columns))
+
+    def merge(self, other: 'GroupedPartial', aggs: List[AggCall]) -> 'GroupedPartial':
+        keys = [numpy.concatenate([a, b]) for a, b in zip(self.keys, other.keys)]
+        order = numpy.lexsort(keys[::-1])
+        keys = [k[order] for k in keys]
+        # each side has a group at most once, so a group appears at `first` and `first + 1` if it is in both
+        same = numpy.ones(len(order) - 1, dtype=bool)
+        for k in keys:
+            same &= adjacent_equal(k)
+        first = numpy.flatnonzero(same)
+        keep = numpy.ones(len(order), dtype=bool)
+        keep[first + 1] = False
+        columns = []
+        for agg, a, b in zip(aggs, self.columns, other.columns):
+            c = numpy.concatenate([a, b])[order]
+            if len(first) > 0:
+                c[first] = agg.reduce_columns(c[first], c[first + 1])
+            columns.append(c[keep])
+        merged = GroupedPartial.__new__(GroupedPartial)  # already sorted
+        merged.keys = [k[keep] for k in keys]
+        merged.columns = columns
+        return merged
 
 
-def agg1_env(agg: AggCall, select: Select, agg_results: Dict, shared: Dict):
+def adjacent_equal(a: numpy.ndarray) -> numpy.ndarray:
+    eq = a[1:] == a[:-1]
+    if a.dtype.kind in 'fc':  # NaNs are grouped together as in numpy.unique
+        eq |= numpy.isnan(a[1:]) & numpy.isnan(a[:-1])
+    return eq
+
+
+def object_array(values: Union[Sequence, numpy.ndarray]) -> numpy.ndarray:
+    return numpy.fromiter(values, dtype=object, count=len(values))
+
+
+MapperResult = Union[Dict[Any, List], GroupedPartial]
+
+
+def agg1_env(aggs: List[AggCall], select: Select, agg_results: Dict, shared: Dict, plan_hash: Optional[str] = None):
+    '''
+    If `plan_hash` is given, results of the mapper are cached for each patch (see `Patch.cached_partial`).
+    '''
     rerun = select.from_clause.relname
 
+    def map_aggs(context: AggContext):
+        return [agg.mapper(context) for agg in aggs]
+
     def mapper(patch: Patch) -> MapperResult:
+        if plan_hash is None:
+            return map_patch(patch)
+        return patch.cached_partial(plan_hash, lambda: map_patch(patch))
+
+    def map_patch(patch: Patch) -> MapperResult:
+        if select.where_clause and not may_match(select.where_clause, patch, shared):
+            return {}
         context = AggContext(patch, agg_results, group_value=None, shared=shared)
         if select.where_clause:
             context = context.sliced_context(select.where_clause(context), None)
         if select.group_clause:
-            mapped_values = {}
             group_values = [gc(context) for gc in select.group_clause]
-            gvs, gi = multi_column_unique(group_values)
-            for i, gv in enumerate(gvs):
-                mapped_values[gv] = agg.mapper(context.sliced_context(gi == i, gv))
-            return mapped_values
+            keys, gi = multi_column_unique(group_values)
+            ngroups = len(keys[0])
+            if ngroups == 0:
+                return {}
+            grouped_context = GroupedAggContext(context._patch, agg_results, keys, gi, shared)
+            columns = [agg.grouped_mapper(grouped_context, gi, ngroups) for agg in aggs]
+            fallback = [j for j, c in enumerate(columns) if c is None]
+            if len(fallback) > 0:
+                for j in fallback:
+                    columns[j] = []
+                for i, gv in enumerate(grouped_context.group_values):
+                    sliced = context.sliced_context(gi == i, gv)
+                    for j in fallback:
+                        columns[j].append(aggs[j].mapper(sliced))  # type: ignore
+            return GroupedPartial(keys, [agg.to_column(c) for agg, c in zip(aggs, columns)])  # type: ignore
         else:
             if context.size > 0:
-                return {None: agg.mapper(context)}
+                return {None: map_aggs(context)}
             else:
                 return {}
 
     def reducer(a: MapperResult, b: MapperResult):
+        if len(b) == 0:
+            return a
+        if len(a) == 0:
+            return b
+        if isinstance(a, GroupedPartial):
+            return a.merge(b, aggs)  # type: ignore
+        a = cast(Dict[Any, List], a)
         for k, v in b.items():
             if k in a:
-                a[k] = agg.reducer(a[k], v)
+                a[k] = [agg.reducer(x, y) for agg, x, y in zip(aggs, a[k], v)]
             else:
-                a[k] = v
+                a[k] = list(v)
         return a
 
-    def finalizer(a):
-        return {k: agg.finalizer(v) for k, v in a.items()}
+    def finalizer(a: MapperResult) -> List[Dict]:
+        '''
+        Returns a list of {group value: result} for each of `aggs`
+        '''
+        results: List[Dict] = [{} for agg in aggs]
+        for k, v in a.items():
+            for r, agg, x in zip(results, aggs, v):
+                r[k] = agg.finalizer(x)
+        return results
 
     return rerun, mapper, reducer, finalizer
 
 
-def multi_column_unique(arr: List[numpy.ndarray]) -> Tuple[List[Tuple], numpy.ndarray]:
+def plan_hash(select: Select, stage: int, previous_results: List, shared: Optional[Dict]) -> str:
+    '''
+    Identifies the mapper of `stage` of `select`,
+    which depends also on the results of the previous stages, `shared` and the code of this package.
+    '''
+    payload, _ = sharedcache.pack(shared or {})
+    h = hashlib.sha256()
+    h.update(code_version().encode())
+    h.update(select.normalized.encode())
+    h.update(str(stage).encode())
+    h.update(pickle.dumps(previous_results, pickle.HIGHEST_PROTOCOL))
+    h.update(payload.data)
+    return h.hexdigest()
+
+
+@lru_cache()
+def code_version() -> str:
+    '''
+    Hash of the source files of `quickdb`, so that cached results are not used after its code changes.
+    Results depend not only on this package but on how columns are read (`sspcatalog`) and run (`datarake`).
+    '''
+    h = hashlib.sha256()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for filename in sorted(glob.glob(f'{root}/**/*.py', recursive=True)):
+        if not filename.endswith('_test.py'):
+            with open(filename, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def group_reduce(ufunc: numpy.ufunc, values: numpy.ndarray, codes: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    '''
+    Reduces `values` for each group given by `codes` with `ufunc`.
+    Returns the indices of groups which have values and the reduced values for them.
+    '''
+    order = numpy.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    starts = numpy.flatnonzero(numpy.r_[True, sorted_codes[1:] != sorted_codes[:-1]]) if len(codes) > 0 else numpy.array([], dtype=int)
+    dtype = ufunc.reduce(values[:0]).dtype if ufunc.identity is not None else values.dtype  # e.g. int32 is summed in int64
+    if len(starts) == 0:
+        return starts, numpy.array([], dtype=dtype)
+    return sorted_codes[starts], ufunc.reduceat(values[order], starts, dtype=dtype)
+
+
+def multi_column_unique(arr: List[numpy.ndarray]) -> Tuple[List[numpy.ndarray], numpy.ndarray]:
     '''
-    Returns V, I
-        V: list of group values
+    Returns K, I
+        K: arrays of group values; K[k][i] is the value of the k-th column of the i-th group
         I: group index
+    Groups are sorted lexicographically.
     '''
     if len(arr) == 1:  # just for performance
         V, I = numpy.unique(arr[0], return_inverse=True)
-        V = [(v,) for v in V]
-    else:
-        u = [numpy.unique(a, return_inverse=True) for a in arr]
-        ii = numpy.array([i for v, i in u]).T
-        vv = [v for v, i in u]
-        II, I = numpy.unique(ii, axis=0, return_inverse=True)
-        V = [tuple(vv[k][l] for k, l in enumerate(j)) for j in II]
-    return V, I  # type: ignore
+        return [V], I
+    # codes of the columns are packed into an int64 key as numpy.ravel_multi_index does
+    packed = numpy.zeros(len(arr[0]), dtype=numpy.int64)
+    size = 1
+    for a in arr:
+        v, i = numpy.unique(a, return_inverse=True)
+        if size * len(v) > numpy.iinfo(numpy.int64).max:
+            # renumbers the groups of the preceding columns so that the key does not overflow
+            u, packed = numpy.unique(packed, return_inverse=True)
+            size = len(u)
+        packed = packed * len(v) + i
+        size *= len(v)
+    _, first, I = numpy.unique(packed, return_index=True, return_inverse=True)
+    return [a[first] for a in arr], I
@@ -1,5 +1,7 @@
 from typing import Dict, List
 
+import numpy
+
 from quickdb.sql2mapreduce.agg import AggCall, AggContext
 from quickdb.sql2mapreduce.sqlast.sqlast import Expression, SqlError
 
@@ -12,6 +14,15 @@ class CountAggCall(AggCall):
     def mapper(self, context: AggContext):
         return context._patch.size
 
+    def grouped_mapper(self, context: AggContext, codes: numpy.ndarray, ngroups: int):
+        return numpy.bincount(codes, minlength=ngroups)
+
+    def to_column(self, values):
+        return numpy.asarray(values)
+
+    def reduce_columns(self, a: numpy.ndarray, b: numpy.ndarray):
+        return a + b
+
     def reducer(self, a, b):
         return a + b
 
@@ -4,7 +4,7 @@ from typing import Dict, List, Optional
 
 import numpy
 
-from quickdb.sql2mapreduce.agg import AggCall, AggContext
+from quickdb.sql2mapreduce.agg import AggCall, AggContext, GroupedAggContext
 from quickdb.sql2mapreduce.sqlast.sqlast import Expression, SqlError
 
 
@@ -37,8 +37,61 @@ class HistogramAggCall(AggCall):
             range = self._minmax.result(context)
         return numpy.histogram(self._array(context), bins=bins, range=range)
 
+    def grouped_mapper(self, context: GroupedAggContext, codes: numpy.ndarray, ngroups: int):
+        bins = 50 if self._bins is None else self._bins.evaluate(context)
+        if self._range is not None:
+            row = self._range(context)
+            if not isinstance(row, list):
+                raise SqlError(f'range must be a list: {row}')
+            if any(numpy.ndim(v) != 0 for v in row):  # depends on groups
+                return None
+            ranges = [row] * ngroups
+        else:
+            ranges = self._minmax.grouped_result(context)
+        return grouped_histogram(self._array(context), codes, bins, ranges)
+
     def reducer(self, a, b):
         return a[0] + b[0], a[1]
 
     def finalizer(self, a):
         return a
+
+
+def grouped_histogram(a: numpy.ndarray, codes: numpy.ndarray, bins: int, ranges: List) -> Optional[List]:
+    '''
+    Returns [numpy.histogram(a[codes == g], bins=bins, range=ranges[g]) for g in range(len(ranges))]
+    with a single pass over `a`.
+    Returns None for arguments with which numpy.histogram raises an error.
+    '''
+    if not isinstance(bins, (int, numpy.integer)) or bins < 1:
+        return None
+    edges = []
+    for first, last in ranges:
+        if not (numpy.isfinite(first) and numpy.isfinite(last)) or first > last:
+            return None
+        if first == last:
+            first, last = first - 0.5, last + 0.5
+        # edges are computed in the same way as numpy.histogram
+        bin_type = numpy.result_type(first, last, a)
+        if numpy.issubdtype(bin_type, numpy.integer):
+            bin_type = numpy.result_type(bin_type, float)
+        e = numpy.linspace(first, last, bins + 1, endpoint=True, dtype=bin_type)
+        if numpy.any(e[:-1] >= e[1:]):
+            return None
+        edges.append(e)
+    ngroups = len(ranges)
+    if ngroups == 0:
+        return []
+    all_edges = numpy.array(edges)
+    first_edges, last_edges = all_edges[codes, 0], all_edges[codes, -1]
+    keep = (a >= first_edges) & (a <= last_edges)
+    x = a[keep].astype(all_edges.dtype, copy=False)
+    codes = codes[keep]
+    first_edges, last_edges = first_edges[keep], last_edges[keep]
+    indices = ((x - first_edges) / (last_edges - first_edges) * bins).astype(numpy.intp)
+    indices[indices == bins] -= 1
+    # corrects errors of ~1 ULP around edges as numpy.histogram does
+    indices[x < all_edges[codes, indices]] -= 1
+    indices[(x >= all_edges[codes, indices + 1]) & (indices != bins - 1)] += 1
+    counts = numpy.bincount(codes * bins + indices, minlength=ngroups * bins).reshape(ngroups, bins)
+    return [(counts[g], edges[g]) for g in range(ngroups)]
@@ -1,6 +1,7 @@
 from quickdb.test_config import REPO_DIR
 import numpy
 from quickdb.sql2mapreduce.agg_test import run_test_agg_sql, patches
+from quickdb.sql2mapreduce.agg_functions.histogram import grouped_histogram
 import unittest
 
 
@@ -21,3 +22,35 @@ class TestHistogramAggCall(unittest.TestCase):
         result = run_test_agg_sql(sql)
         hist, bins = result.group_by[None][0]
         self.assertEqual(len(hist), len(bins) - 1)
+
+    def test_group(self):
+        sql = '''
+        SELECT histogram(forced.i.psfflux_flux, bins => 10) FROM pdr2_dud GROUP BY object_id % 3
+        '''
+        result = run_test_agg_sql(sql)
+        for m in [0, 1, 2]:
+            a = numpy.concatenate([p('forced.i.psfflux_flux')[p('object_id') % 3 == m] for p in patches('pdr2_dud')])
+            a = a[numpy.isfinite(a)]
+            hist, bins = numpy.histogram(a, bins=10, range=(a.min(), a.max()))
+            numpy.testing.assert_array_equal(result.group_by[(m,)][0][0], hist)
+            numpy.testing.assert_array_equal(result.group_by[(m,)][0][1], bins)
+
+
+class TestGroupedHistogram(unittest.TestCase):
+    def test_same_as_numpy(self):
+        rng = numpy.random.default_rng(0)
+        for dtype in [numpy.float32, numpy.float64, numpy.int32]:
+            a = (100 * rng.normal(size=10000)).astype(dtype)
+            codes = rng.integers(0, 10, size=len(a))
+            ranges = [(a[codes == g].min(), a[codes == g].max()) for g in range(10)]
+            ranges[0] = (0.1, 0.1)
+            histograms = grouped_histogram(a, codes, 7, ranges)
+            assert histograms is not None
+            for g, (hist, bins) in enumerate(histograms):
+                hist1, bins1 = numpy.histogram(a[codes == g], bins=7, range=ranges[g])
+                numpy.testing.assert_array_equal(hist, hist1)
+                numpy.testing.assert_array_equal(bins, bins1)
+                self.assertEqual(bins.dtype, bins1.dtype)
+
+    def test_invalid_range(self):
+        self.assertIsNone(grouped_histogram(numpy.arange(3.), numpy.zeros(3, dtype=int), 5, [(numpy.nan, numpy.nan)]))
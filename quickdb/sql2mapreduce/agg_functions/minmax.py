@@ -2,7 +2,7 @@ from typing import Any, Dict, List, NamedTuple, Optional
 
 import numpy
 
-from quickdb.sql2mapreduce.agg import AggCall, AggContext
+from quickdb.sql2mapreduce.agg import AggCall, AggContext, group_reduce
 from quickdb.sql2mapreduce.sqlast.sqlast import Expression, SqlError
 
 
@@ -23,6 +23,17 @@ class MinMaxAggCall(AggCall):
         if len(fea) > 0:
             return MinMax(min=numpy.min(fea), max=numpy.max(fea))
 
+    def grouped_mapper(self, context: AggContext, codes: numpy.ndarray, ngroups: int):
+        ea = self._array(context)
+        finite = numpy.isfinite(ea)
+        fea, fcodes = ea[finite], codes[finite]
+        groups, mins = group_reduce(numpy.minimum, fea, fcodes)
+        _, maxs = group_reduce(numpy.maximum, fea, fcodes)
+        mapped: List[Optional[MinMax]] = [None] * ngroups
+        for g, lo, hi in zip(groups, mins, maxs):
+            mapped[g] = MinMax(min=lo, max=hi)
+        return mapped
+
     def reducer(self, a: Optional[MinMax], b: Optional[MinMax]):
         if a and b:
             return MinMax(min=min(a.min, b.min), max=max(a.max, b.max))
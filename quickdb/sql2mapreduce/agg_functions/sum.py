@@ -1,6 +1,8 @@
 from typing import Dict, List
 
-from quickdb.sql2mapreduce.agg import AggCall, AggContext
+import numpy
+
+from quickdb.sql2mapreduce.agg import AggCall, AggContext, group_reduce
 from quickdb.sql2mapreduce.sqlast.sqlast import Expression, SqlError
 
 
@@ -13,6 +15,16 @@ class SumAggCall(AggCall):
     def mapper(self, context: AggContext):
         return self.arg(context).sum()
 
+    def grouped_mapper(self, context: AggContext, codes: numpy.ndarray, ngroups: int):
+        _, sums = group_reduce(numpy.add, self.arg(context), codes)  # every group has rows
+        return sums
+
+    def to_column(self, values):
+        return numpy.asarray(values)
+
+    def reduce_columns(self, a: numpy.ndarray, b: numpy.ndarray):
+        return a + b
+
     def reducer(self, a, b):
         return a + b
 
@@ -6,7 +6,9 @@ import unittest
 
 import numpy
 
-from quickdb.sql2mapreduce.agg import run_agg_query
+from quickdb.sql2mapreduce.agg import GroupedPartial, multi_column_unique, run_agg_query
+from quickdb.sql2mapreduce.agg_functions.count import CountAggCall
+from quickdb.sql2mapreduce.agg_functions.minmax import MinMax, MinMaxAggCall
 from quickdb.sql2mapreduce.sqlast.sqlast import Select
 from quickdb.test_config import REPO_DIR
 
@@ -97,6 +99,27 @@ class TestRunAggQuery(unittest.TestCase):
         self.assertEqual(result.group_by[(0,)], [2])
         self.assertEqual(result.group_by[(1,)], [4])
 
+    def test_multiple_aggregations_in_one_scan(self):
+        sql = '''
+            SELECT
+                COUNT(*), sum(object_id), min(object_id), max(object_id)
+            FROM
+                pdr2_dud
+            GROUP BY
+                object_id % 2
+        '''
+        calls = []
+
+        def run_make_env1(make_env: str, shared: Dict, progress: ProgressCB = None, interrupt_notifiyer: SafeEvent = None):
+            calls.append(make_env)
+            return run_make_env(make_env, shared, progress, interrupt_notifiyer)
+
+        result = run_agg_query(Select(sql), run_make_env1)
+        self.assertEqual(len(calls), 1)
+        for m in [0, 1]:
+            object_id = numpy.concatenate([p('object_id')[p('object_id') % 2 == m] for p in patches('pdr2_dud')])
+            self.assertEqual(result.group_by[(m,)], [len(object_id), object_id.sum(), object_id.min(), object_id.max()])
+
     def test_shared(self):
         sql = '''
             SELECT
@@ -108,6 +131,41 @@ class TestRunAggQuery(unittest.TestCase):
         self.assertEqual(result.group_by[None][1], 'Hello world')
 
 
+class TestGroupedPartial(unittest.TestCase):
+    def test_merge(self):
+        aggs = [CountAggCall([], {}, True), MinMaxAggCall([None], {}, False)]  # type: ignore
+
+        def partial(groups: Dict):
+            keys = [numpy.array([k[0] for k in groups]), numpy.array([k[1] for k in groups])]
+            counts = numpy.array([v[0] for v in groups.values()])
+            minmaxes = aggs[1].to_column([v[1] for v in groups.values()])
+            return GroupedPartial(keys, [counts, minmaxes])
+
+        a = {(1., 'b'): (1, MinMax(0, 1)), (numpy.nan, 'a'): (2, None), (0., 'b'): (3, MinMax(2, 3))}
+        b = {(0., 'b'): (4, MinMax(-1, 2)), (numpy.nan, 'a'): (5, MinMax(1, 1)), (0., 'a'): (6, None)}
+        merged = dict(partial(a).merge(partial(b), aggs).items())
+        self.assertEqual(len(merged), 4)
+        self.assertEqual(merged[(1., 'b')], (1, MinMax(0, 1)))
+        self.assertEqual(merged[(0., 'b')], (7, MinMax(-1, 3)))
+        self.assertEqual(merged[(0., 'a')], (6, None))
+        nan_group = [v for k, v in merged.items() if numpy.isnan(k[0])]
+        self.assertEqual(nan_group, [(7, MinMax(1, 1))])
+        self.assertEqual(list(merged), sorted(merged, key=lambda k: (numpy.isnan(k[0]), k)))
+
+
+class TestMultiColumnUnique(unittest.TestCase):
+    def test_multi_column_unique(self):
+        rng = numpy.random.default_rng(0)
+        for n_columns, n_values in [(1, 10), (2, 10), (6, 10000)]:  # the packed key of 6 columns overflows int64
+            arr = [rng.integers(0, n_values, size=10000) for _ in range(n_columns)]
+            arr[0] = arr[0].astype(float)
+            keys, I = multi_column_unique(arr)
+            rows = list(zip(*arr))
+            groups = list(zip(*keys))
+            self.assertEqual(groups, sorted(set(rows)))
+            self.assertEqual([groups[i] for i in I], rows)
+
+
 def run_test_agg_sql(sql: str, shared: Dict = None):
     select = Select(sql)
     return run_agg_query(select, run_make_env, shared=shared)
@@ -8,6 +8,7 @@ from quickdb.sql2mapreduce.sqlast.sqlast import Select, SqlError
 
 from ..sspcatalog.patch import Patch
 from .numpy_context import NumpyContext
+from .pruning import may_match
 
 
 class NonAggQueryResult(NamedTuple):
@@ -30,7 +31,9 @@ def run_nonagg_query(select: Select, run_make_env: RunMakeEnv, shared: Dict = No
     check_select(select, streaming=True)
     make_env = '''
         from quickdb.sql2mapreduce.nonagg import nonagg_env
+        from quickdb.sql2mapreduce.numpy_context import referenced_columns
         rerun, mapper, reducer, finalizer = nonagg_env(select, shared)
+        prefetch = referenced_columns(select)
     '''
     env_context = {'select': select, 'shared': shared, 'streaming': streaming}
     target_list = run_make_env(make_env, env_context, progress, interrupt_notifiyer)
@@ -46,37 +49,56 @@ def nonagg_env(select: Select, shared: Dict):
 
     def mapper(patch: Patch):
         context = NumpyContext(patch, shared=shared)
+        rows = numpy.arange(patch.size)  # positions of the rows of `context` in `patch`
         sort_values: Optional[List[numpy.ndarray]]
         if select.where_clause:
-            context = context.sliced_context(select.where_clause(context)[:select.limit_count])
+            if may_match(select.where_clause, patch, shared):
+                where = select.where_clause(context)
+                if select.sort_clause:
+                    selected = where
+                else:
+                    selected = numpy.flatnonzero(where)[:select.limit_count]
+            else:
+                selected = numpy.empty(0, dtype=numpy.int64)
+            context = context.sliced_context(selected)
+            rows = rows[selected]
         if select.sort_clause:
-            # TODO: use numpy.partition when len(sort_clause) == 1
             sort_values = [(-1 if sc.reverse else +1) * sc.node(context) for sc in select.sort_clause]
-            sort_indices = numpy.lexsort(sort_values[::-1])[:select.limit_count]
+            sort_indices = top_k(sort_values, select.limit_count)
             sort_values = [sv[sort_indices] for sv in sort_values]
             context = context.sliced_context(sort_indices)
+            rows = rows[sort_indices]
         else:
             sort_values = None
+            if select.limit_count is not None and not select.where_clause:
+                context = context.sliced_context(slice(0, select.limit_count))
+                rows = rows[:select.limit_count]
         target_list: List[numpy.ndarray] = [t.val(context) for t in select.target_list]
         return MapperResult(
             target_list,
             sort_values,
+            row_ids(patch, rows),
         )
 
     def reducer(a: MapperResult, b: MapperResult) -> MapperResult:
+        '''
+        Rows are ordered by the sort keys and then by their ids, so that the result does not depend on
+        the order in which partial results are reduced, which follows the timing of workers and pool processes.
+        '''
         if a.sort_values is None:
-            target_list = [numpy.concatenate((a, v))[:select.limit_count] for a, v in zip(a.target_list, b.target_list)]
+            # without ORDER BY, LIMIT takes the rows with the smallest ids
+            sort_indices = merge_sorted([a.row_ids], [b.row_ids], select.limit_count)
             sort_values = None
         else:
             a_sort_values = cast(List[numpy .ndarray], a.sort_values)
             b_sort_values = cast(List[numpy .ndarray], b.sort_values)
-            sort_values = [numpy.concatenate((a, v)) for a, v in zip(a_sort_values, b_sort_values)]
-            sort_indices = numpy.lexsort(sort_values[::-1])[:select.limit_count]
-            target_list = [numpy.concatenate((a, v))[sort_indices] for a, v in zip(a.target_list, b.target_list)]
-            sort_values = [sv[sort_indices] for sv in sort_values]
+            sort_indices = merge_sorted(a_sort_values + [a.row_ids], b_sort_values + [b.row_ids], select.limit_count)
+            sort_values = [numpy.concatenate((a, v))[sort_indices] for a, v in zip(a_sort_values, b_sort_values)]
+        target_list = [numpy.concatenate((a, v))[sort_indices] for a, v in zip(a.target_list, b.target_list)]
         return MapperResult(
             target_list,
             sort_values,
+            numpy.concatenate((a.row_ids, b.row_ids))[sort_indices],
         )
 
     def finalizer(a: MapperResult):
@@ -85,9 +107,56 @@ def nonagg_env(select: Select, shared: Dict):
     return rerun, mapper, reducer, finalizer
 
 
+def top_k(sort_values: List[numpy.ndarray], k: Optional[int]) -> numpy.ndarray:
+    '''
+    Returns the indices of the first `k` rows in the order of `numpy.lexsort(sort_values[::-1])`.
+    Only rows whose first key is not after the k-th smallest one are sorted.
+    '''
+    primary = sort_values[0]
+    if k is None or k >= len(primary):
+        return numpy.lexsort(sort_values[::-1])
+    if k <= 0:
+        return numpy.empty(0, dtype=numpy.intp)
+    kth = primary[numpy.argpartition(primary, k - 1)[k - 1]]
+    if kth != kth:  # NaN is placed last, so no row can be left out
+        return numpy.lexsort(sort_values[::-1])[:k]
+    # rows tied at the k-th value are kept so that they are ordered by the other keys and their positions as lexsort does
+    candidates = numpy.flatnonzero(primary <= kth)
+    order = numpy.lexsort([sv[candidates] for sv in sort_values[::-1]])[:k]
+    return candidates[order]
+
+
+def merge_sorted(a: List[numpy.ndarray], b: List[numpy.ndarray], k: Optional[int]) -> numpy.ndarray:
+    '''
+    Merges rows sorted by keys `a` and rows sorted by keys `b`.
+    Returns the indices of the first `k` rows of the merged ones in the concatenation of `a` and `b`.
+    Rows of `a` precede rows of `b` with the same keys.
+    '''
+    na, nb = len(a[0]), len(b[0])
+    if len(a) == 1:
+        # position of each row of `b` in the merged rows
+        b_dest = numpy.searchsorted(a[0], b[0], side='right') + numpy.arange(nb)
+        merged = numpy.empty(na + nb, dtype=numpy.intp)
+        is_b = numpy.zeros(na + nb, dtype=bool)
+        is_b[b_dest] = True
+        merged[b_dest] = numpy.arange(na, na + nb)
+        merged[~is_b] = numpy.arange(na)
+        return merged[:k]
+    # at most 2k rows are sorted
+    return numpy.lexsort([numpy.concatenate((x, y)) for x, y in zip(a[::-1], b[::-1])])[:k]
+
+
 class MapperResult(NamedTuple):
     target_list: List[numpy.ndarray]
     sort_values: Optional[List[numpy.ndarray]]
+    row_ids: numpy.ndarray  # see `row_ids`
+
+
+def row_ids(patch: Patch, rows: numpy.ndarray) -> numpy.ndarray:
+    '''
+    Ids of `rows` of `patch` unique in the rerun, which increase with the rows in a patch.
+    '''
+    return (numpy.int64(patch.skymap_id) << 32) | rows.astype(numpy.int64)
 
 
 def check_select(select: Select, streaming: bool):
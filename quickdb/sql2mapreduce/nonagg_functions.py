@@ -2,13 +2,29 @@ from typing import Callable, Dict, Tuple
 
 import numpy
 
+from quickdb.sspcatalog.skyindex import coord2xyz, radec2xyz
+
 
 def flux2mag(a: numpy.ndarray):
     # m_{\text{AB}}\approx -2.5\log _{10}\left({\frac {f_{\nu }}{\text{Jy}}}\right)+8.90
     # Jy = 3631 jansky
     return -2.5 * numpy.log10(a * (10**-9) / 3631.)
 
+
+def cone(coord: numpy.ndarray, ra: float, dec: float, radius: float):
+    '''
+    True for objects within `radius` from (`ra`, `dec`). Angles are in radian.
+
+    Example:
+        SELECT object_id FROM pdr2_wide WHERE cone(forced.coord, 150 / degree, 2 / degree, 1 / arcmin)
+    '''
+    x, y, z = coord2xyz(coord)
+    cx, cy, cz = radec2xyz(ra, dec)
+    return cx * x + cy * y + cz * z >= numpy.cos(radius)
+
+
 nonagg_functions: Dict[Tuple[str, ...], Callable[..., numpy.ndarray]] = {
     ('flux2mag', ): flux2mag,
     ('isnan', ): numpy.isnan,
+    ('cone', ): cone,
 }
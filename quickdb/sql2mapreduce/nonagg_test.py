@@ -1,10 +1,12 @@
-from functools import lru_cache
+from functools import lru_cache, partial
 from quickdb.test_config import REPO_DIR
 from quickdb.sql2mapreduce.sqlast.sqlast import Select
-from quickdb.sql2mapreduce.nonagg import run_nonagg_query
+from quickdb.sql2mapreduce.nonagg import merge_sorted, run_nonagg_query, top_k
 from typing import Dict
 import unittest
 
+import numpy
+
 
 @unittest.skipUnless(REPO_DIR, 'REPO_DIR is not set')
 class TestNonagg(unittest.TestCase):
@@ -64,6 +66,24 @@ class TestNonagg(unittest.TestCase):
         a = result.target_list[0]
         self.assertTrue(((a[1:] - a[:-1]) <= 0).all())
 
+    def test_sql_where_and_order_by_multiple_keys(self):
+        sql = '''
+            SELECT
+                object_id % 3, object_id
+            FROM
+                pdr2_dud
+            WHERE
+                forced.i.extendedness_value > 0.5
+            ORDER BY
+                object_id % 3, object_id DESC
+            LIMIT 100
+        '''
+        result = run_test_nonagg_sql(sql)
+        ps = cached_rerun('pdr2_dud').patches[:10]
+        object_id = numpy.concatenate([p('object_id')[p('forced.i.extendedness_value') > 0.5] for p in ps])
+        expected = object_id[numpy.lexsort([-object_id, object_id % 3])][:100]
+        self.assertTrue((result.target_list[1] == expected).all())
+
     def test_shared_value(self):
         sql = '''
             SELECT
@@ -75,6 +95,41 @@ class TestNonagg(unittest.TestCase):
         result = run_test_nonagg_sql(sql, shared={'the_answer': 42})
         self.assertEqual(result.target_list[0][0], 42)
 
+    def test_independent_of_reduction_order(self):
+        for sql in [
+            '''
+                SELECT object_id FROM pdr2_dud WHERE forced.i.extendedness_value > 0.5 LIMIT 100
+            ''',
+            '''
+                SELECT object_id FROM pdr2_dud ORDER BY object_id % 3 LIMIT 100
+            ''',
+        ]:
+            select = Select(sql)
+            forward = run_nonagg_query(select, run_make_env)
+            backward = run_nonagg_query(select, partial(run_make_env, reverse=True))
+            self.assertEqual(forward.target_list[0].tolist(), backward.target_list[0].tolist())
+
+
+class TestTopK(unittest.TestCase):
+    def test_same_as_lexsort(self):
+        rng = numpy.random.default_rng(0)
+        for n_keys in [1, 2]:
+            for k in [0, 1, 10, 100, 1000]:
+                sort_values = [rng.integers(0, 10, size=500).astype(float) for _ in range(n_keys)]
+                sort_values[0][rng.random(500) < 0.1] = numpy.nan
+                self.assertEqual(top_k(sort_values, k).tolist(), numpy.lexsort(sort_values[::-1])[:k].tolist())
+
+    def test_merge_sorted(self):
+        rng = numpy.random.default_rng(0)
+        for n_keys in [1, 2]:
+            a = [rng.integers(0, 10, size=50).astype(float) for _ in range(n_keys)]
+            b = [rng.integers(0, 10, size=30).astype(float) for _ in range(n_keys)]
+            a[0][:5] = numpy.nan
+            a = [x[numpy.lexsort(a[::-1])] for x in a]
+            b = [x[numpy.lexsort(b[::-1])] for x in b]
+            expected = numpy.lexsort([numpy.concatenate((x, y)) for x, y in zip(a[::-1], b[::-1])])[:60]
+            self.assertEqual(merge_sorted(a, b, 60).tolist(), expected.tolist())
+
 
 @lru_cache()
 def cached_rerun(rerun_name: str):
@@ -87,13 +142,15 @@ def run_test_nonagg_sql(sql: str, shared: Dict = None):
     return run_nonagg_query(select, run_make_env, shared=shared)
 
 
-def run_make_env(make_env: str, shared: Dict, progress=None, interrupt_notifiyer=None):
+def run_make_env(make_env: str, shared: Dict, progress=None, interrupt_notifiyer=None, reverse=False):
     from quickdb.utils import evaluate
     from functools import reduce
     shared = through_serialization(shared)
     env = evaluate(make_env, shared)
     rerun = cached_rerun(env['rerun'])
     patches = rerun.patches[:10]
+    if reverse:  # as if workers finished in the other order
+        patches = patches[::-1]
     return env['finalizer'](reduce(env['reducer'], map(env['mapper'], patches)))
 
 
@@ -1,5 +1,5 @@
-from quickdb.sql2mapreduce.sqlast.sqlast import BetweenExpression, BinaryOperationExpression, BoolExpression, ConstExpression, Context, ColumnRefExpression, FuncCallExpression, IndirectionExpression, RowExpression, SharedValueRefExpression, SqlError, UnaryOperationExpression
-from typing import Dict, List, Tuple, Union
+from quickdb.sql2mapreduce.sqlast.sqlast import BetweenExpression, BinaryOperationExpression, BoolExpression, ConstExpression, Context, ColumnRefExpression, Expression, FuncCallExpression, IndirectionExpression, RowExpression, Select, SharedValueRefExpression, SqlError, UnaryOperationExpression
+from typing import Dict, List, Tuple, Union, cast
 
 import numpy
 
@@ -30,7 +30,7 @@ class NumpyContext(Context):
         self._shared = shared or {}
 
     def sliced_context(self, slice: Union[numpy.ndarray, slice]):
-        return self.__class__(self._patch[slice])
+        return self.__class__(self._patch[slice], shared=self._shared)
 
     def evaluate_ConstExpression(self, e: ConstExpression):
         return e.value
@@ -67,13 +67,36 @@ class NumpyContext(Context):
 
     def evaluate_BoolExpression(self, e: BoolExpression):
         if e.name == 'AND':
-            return numpy.logical_and.reduce([a(self) for a in e.args])
+            return numpy.logical_and.reduce(self._evaluate_bool_args(e))
         if e.name == 'OR':
-            return numpy.logical_or.reduce([a(self) for a in e.args])
+            return numpy.logical_or.reduce(self._evaluate_bool_args(e))
         else:
             assert e.name == 'NOT' and len(e.args) == 1
             return numpy.logical_not(e.args[0](self))
 
+    def _evaluate_bool_args(self, e: BoolExpression) -> List[numpy.ndarray]:
+        '''
+        Evaluates args of AND / OR.
+        Flags and negated flags in the args are evaluated on their packed words
+        with one masked comparison per word instead of being unpacked one by one.
+        '''
+        words: Dict[str, Tuple[int, int]] = {}  # filename => (bits to be set, bits to be unset)
+        values = []
+        for a in e.args:
+            negate = isinstance(a, BoolExpression) and a.name == 'NOT'
+            ref = cast(BoolExpression, a).args[0] if negate else a
+            bit = self._patch.flag_bit(ref.fields) if isinstance(ref, ColumnRefExpression) else None
+            if bit is None:
+                values.append(a(self))
+                continue
+            filename, j = bit
+            set_bits, unset_bits = words.get(filename, (0, 0))
+            words[filename] = (set_bits, unset_bits | 1 << j) if negate else (set_bits | 1 << j, unset_bits)
+        for filename, (set_bits, unset_bits) in words.items():
+            w = self._patch.flag_word(filename)
+            values.append(packed_flags(w, set_bits, unset_bits, e.name))
+        return values
+
     def evaluate_FuncCallExpression(self, e: FuncCallExpression):
         if e.name in nonagg_functions:
             return nonagg_functions[e.name](*[a(self) for a in e.args], **{k: a(self) for k, a in e.named_args.items()})
@@ -84,3 +107,43 @@ class NumpyContext(Context):
 
     def evaluate_IndirectionExpression(self, e: IndirectionExpression):
         return e.arg(self)[e.index]
+
+
+def packed_flags(w: numpy.ndarray, set_bits: int, unset_bits: int, op: str) -> numpy.ndarray:
+    '''
+    For op == 'AND', returns whether all of `set_bits` are set and all of `unset_bits` are unset in `w`.
+    For op == 'OR', returns whether any of `set_bits` is set or any of `unset_bits` is unset in `w`.
+    '''
+    if set_bits & unset_bits:  # `flag AND NOT flag` or `flag OR NOT flag`
+        return numpy.full(len(w), op == 'OR')
+    mask = word(set_bits | unset_bits, w.dtype)
+    if op == 'AND':
+        return w & mask == word(set_bits, w.dtype)
+    assert op == 'OR'
+    return w & mask != word(unset_bits, w.dtype)
+
+
+def word(bits: int, dtype: numpy.dtype):
+    # bit 63 does not fit in int64 without wrapping around
+    return numpy.array(bits, dtype=numpy.uint64).astype(dtype)
+
+
+def referenced_columns(select: Select) -> List[Tuple[str, ...]]:
+    '''
+    Returns column paths referenced in `select`, those in WHERE clause first.
+    '''
+    expressions: List[Expression] = []
+    if select.where_clause:
+        expressions.append(select.where_clause)
+    expressions += [t.val for t in select.target_list]
+    expressions += select.group_clause or []
+    expressions += [sc.node for sc in select.sort_clause or []]
+    colpaths: List[Tuple[str, ...]] = []
+
+    def probe(e: Expression):
+        if isinstance(e, ColumnRefExpression) and e.fields not in colpaths:
+            colpaths.append(e.fields)
+
+    for e in expressions:
+        e.walk(probe)
+    return colpaths
@@ -10,7 +10,7 @@ import numpy
 from quickdb.sql2mapreduce.sqlast.sqlast import ColumnRefExpression, Select
 
 from quickdb.sspcatalog.patch import Rerun
-from .numpy_context import NumpyContext
+from .numpy_context import NumpyContext, packed_flags
 
 
 @unittest.skipUnless(REPO_DIR, 'REPO_DIR is not set')
@@ -101,6 +101,19 @@ class TestNumpyContext(unittest.TestCase):
         e = sql2expression('NOT (mod3 = 0) AND NOT (mod3 = 1) AND NOT (mod3 = 2)')
         self.assertTrue((e(context) == numpy.array([b == 't' for b in 'ffffffffff'])).all())
 
+    def test_packed_flags(self):
+        context = NumpyContext(self.patch[self.patch('object_id') % 3 != 0])
+        edge = context._patch('forced.i.pixelflags_edge')
+        saturated = context._patch('forced.i.pixelflags_saturated')
+        centroid = context._patch('forced.i.sdsscentroid_flag')
+        g_edge = context._patch('forced.g.pixelflags_edge')
+        e = sql2expression('forced.i.pixelflags_edge AND NOT forced.i.pixelflags_saturated AND forced.i.sdsscentroid_flag AND forced.g.pixelflags_edge')
+        self.assertTrue((e(context) == (edge & ~saturated & centroid & g_edge)).all())
+        e = sql2expression('forced.i.pixelflags_edge OR NOT forced.i.pixelflags_saturated OR object_id % 2 = 0')
+        self.assertTrue((e(context) == (edge | ~saturated | (context._patch('object_id') % 2 == 0))).all())
+        e = sql2expression('forced.i.pixelflags_edge AND NOT forced.i.pixelflags_edge')
+        self.assertFalse(e(context).any())
+
     def test_funccall(self):
         e = sql2expression(''' flux2mag(forced.i.psfflux_flux) ''')
         context = NumpyContext(self.patch)
@@ -127,6 +140,19 @@ class TestNumpyContext(unittest.TestCase):
         return find_patch_by_dirname(cached_rerun('pdr2_dud'), '9813-4,6')
 
 
+class TestPackedFlags(unittest.TestCase):
+    def test_packed_flags(self):
+        w = numpy.array([0b000, 0b001, 0b011, 0b101, 0b111])
+        self.assertEqual(packed_flags(w, 0b011, 0, 'AND').tolist(), [False, False, True, False, True])
+        self.assertEqual(packed_flags(w, 0b001, 0b100, 'AND').tolist(), [False, True, True, False, False])
+        self.assertEqual(packed_flags(w, 0b010, 0b001, 'OR').tolist(), [True, False, True, False, True])
+        self.assertEqual(packed_flags(w, 0b001, 0b001, 'OR').tolist(), [True] * 5)
+
+    def test_bit_63(self):
+        w = numpy.array([-1, 0, 1], dtype=numpy.int64)
+        self.assertEqual(packed_flags(w, 1 << 63, 0, 'AND').tolist(), [True, False, False])
+
+
 def sql2expression(subsql: str):
     sql = f'''SELECT {subsql} FROM t'''
     select = Select(sql)
@@ -0,0 +1,196 @@
+'''
+Skips patches that cannot match a WHERE clause.
+
+The WHERE clause is evaluated against the zone map of a patch (see `quickdb.sspcatalog.zonemap`)
+instead of its columns. Whenever a sub expression cannot be bounded with the zone map,
+it is regarded as possibly true, so a patch is skipped only if it is proved to have no matching row.
+'''
+from typing import Any, Dict, List, NamedTuple, Optional, cast
+
+import numpy
+
+from quickdb.sql2mapreduce.numpy_context import NumpyContext
+from quickdb.sql2mapreduce.sqlast.sqlast import (
+    BetweenExpression, BinaryOperationExpression, BoolExpression,
+    ColumnRefExpression, Expression, FuncCallExpression,
+    UnaryOperationExpression)
+from quickdb.sspcatalog.errors import UserError
+from quickdb.sspcatalog.patch import Patch
+from quickdb.sspcatalog.skyindex import SKYINDEX_COLUMN, radec2xyz
+
+
+class Range(NamedTuple):
+    min: Any  # None if all values are NaN
+    max: Any
+    has_nan: bool
+
+
+class Truth(NamedTuple):
+    may_be_true: bool
+    may_be_false: bool
+
+
+UNKNOWN = Truth(True, True)
+
+EPSILON = 1.e-9  # margin in radian for rounding errors
+
+
+def may_match(e: Expression, patch: Patch, shared: Optional[Dict] = None) -> bool:
+    '''
+    Returns False if the zone map of `patch` proves that `e` is false for all rows of `patch`.
+    '''
+    return ZoneMapEvaluator(patch, shared).truth(e).may_be_true
+
+
+class ZoneMapEvaluator:
+    def __init__(self, patch: Patch, shared: Optional[Dict] = None):
+        self._patch = patch
+        self._shared = shared
+
+    def truth(self, e: Expression) -> Truth:
+        if isinstance(e, BoolExpression):
+            args = [self.truth(a) for a in e.args]
+            if e.name == 'AND':
+                return Truth(all(a.may_be_true for a in args), any(a.may_be_false for a in args))
+            if e.name == 'OR':
+                return Truth(any(a.may_be_true for a in args), all(a.may_be_false for a in args))
+            assert e.name == 'NOT' and len(args) == 1
+            return Truth(args[0].may_be_false, args[0].may_be_true)
+        if isinstance(e, BinaryOperationExpression) and e.name in COMPARISONS:
+            a = self.range(e.a)
+            b = self.range(e.b)
+            if a is None or b is None:
+                return UNKNOWN
+            return COMPARISONS[e.name](a, b)
+        if isinstance(e, BetweenExpression):
+            a = self.range(e.a)
+            b = self.range(e.b)
+            c = self.range(e.c)
+            if a is None or b is None or c is None:
+                return UNKNOWN
+            if e.negate:  # a < b OR a > c
+                below = compare_lt(a, b)
+                above = compare_lt(c, a)
+                return Truth(below.may_be_true or above.may_be_true, below.may_be_false and above.may_be_false)
+            lower = compare_le(b, a)
+            upper = compare_le(a, c)
+            return Truth(lower.may_be_true and upper.may_be_true, lower.may_be_false or upper.may_be_false)
+        if isinstance(e, FuncCallExpression) and e.name == ('isnan',) and len(e.args) == 1:
+            a = self.range(e.args[0])
+            if a is None:
+                return UNKNOWN
+            return Truth(a.has_nan, a.min is not None)
+        if isinstance(e, FuncCallExpression) and e.name == ('cone',) and len(e.args) == 4:
+            return self.cone(*e.args)
+        if isinstance(e, ColumnRefExpression):
+            a = self.range(e)
+            if a is None or not isinstance(a.min, bool):
+                return UNKNOWN
+            return Truth(a.max, not a.min)
+        return UNKNOWN
+
+    def cone(self, coord: Expression, *args: Expression) -> Truth:
+        if not (isinstance(coord, ColumnRefExpression) and coord.fields == SKYINDEX_COLUMN):
+            return UNKNOWN
+        region = self._patch.sky_region
+        values = [self.constant(a) for a in args]
+        if region is None or any(v is None for v in values):
+            return UNKNOWN
+        if region.radius < 0:  # no valid coord in the patch
+            return Truth(False, True)
+        ra, dec, radius = cast(List[float], values)
+        d = region.separation(*radec2xyz(ra, dec))
+        # rows with non-finite coords (whose number is unknown for an old index) are never in the cone
+        return Truth(d <= region.radius + radius + EPSILON, region.nonfinite != 0 or d + region.radius >= radius - EPSILON)
+
+    def constant(self, e: Expression):
+        '''
+        Returns the value of a numeric constant expression or None.
+        '''
+        if not is_constant(e):
+            return None
+        try:
+            value = e(NumpyContext(None, shared=self._shared))  # type: ignore
+        except Exception:
+            return None
+        if isinstance(value, (int, float, numpy.number)) and not isinstance(value, (bool, numpy.bool_)):
+            return value
+        return None
+
+    def range(self, e: Expression) -> Optional[Range]:
+        if is_constant(e):
+            value = self.constant(e)
+            if value is None:
+                return None
+            if numpy.isnan(value):
+                return Range(None, None, True)
+            return Range(value, value, False)
+        if isinstance(e, ColumnRefExpression):
+            try:
+                stats = self._patch.column_stats(e.fields)
+            except UserError:
+                return None  # let the evaluation on columns report the error
+            if stats is None:
+                return None
+            return Range(stats.min, stats.max, stats.nan_count > 0)
+        if isinstance(e, UnaryOperationExpression) and e.name in {'+', '-'}:
+            a = self.range(e.a)
+            if a is None or e.name == '+' or a.min is None:
+                return a
+            return Range(-a.max, -a.min, a.has_nan)
+        if isinstance(e, BinaryOperationExpression) and e.name in {'+', '-'}:
+            a = self.range(e.a)
+            b = self.range(e.b)
+            if a is None or b is None:
+                return None
+            if a.min is None or b.min is None:
+                return Range(None, None, True)
+            if e.name == '+':
+                return Range(a.min + b.min, a.max + b.max, a.has_nan or b.has_nan)
+            return Range(a.min - b.max, a.max - b.min, a.has_nan or b.has_nan)
+        return None
+
+
+def is_constant(e: Expression):
+    refs = []
+
+    def probe(e1: Expression):
+        if isinstance(e1, ColumnRefExpression):
+            refs.append(e1)
+
+    e.walk(probe)
+    return len(refs) == 0
+
+
+def compare_lt(a: Range, b: Range):
+    if a.min is None or b.min is None:
+        return Truth(False, True)
+    return Truth(a.min < b.max, a.has_nan or b.has_nan or a.max >= b.min)
+
+
+def compare_le(a: Range, b: Range):
+    if a.min is None or b.min is None:
+        return Truth(False, True)
+    return Truth(a.min <= b.max, a.has_nan or b.has_nan or a.max > b.min)
+
+
+def compare_eq(a: Range, b: Range):
+    if a.min is None or b.min is None:
+        return Truth(False, True)
+    single = a.min == a.max == b.min == b.max
+    return Truth(a.min <= b.max and b.min <= a.max, a.has_nan or b.has_nan or not single)
+
+
+def compare_ne(a: Range, b: Range):
+    eq = compare_eq(a, b)
+    return Truth(eq.may_be_false, eq.may_be_true)
+
+
+COMPARISONS = {
+    '<': compare_lt,
+    '>': lambda a, b: compare_lt(b, a),
+    '<=': compare_le,
+    '>=': lambda a, b: compare_le(b, a),
+    '=': compare_eq,
+    '<>': compare_ne,
+}
@@ -0,0 +1,98 @@
+import unittest
+from typing import cast
+
+from quickdb.sql2mapreduce.sqlast.sqlast import Select
+from quickdb.sspcatalog.patch import Patch
+from quickdb.sspcatalog.skyindex import SkyRegion, radec2xyz
+from quickdb.sspcatalog.zonemap import ColumnStats
+
+from .pruning import may_match
+
+
+class StatsPatch:
+    stats = {
+        ('object_id',): ColumnStats(size=5, nan_count=0, min=10, max=20),
+        ('flux',): ColumnStats(size=5, nan_count=5, min=None, max=None),
+        ('never_set',): ColumnStats(size=5, nan_count=0, min=False, max=False),
+        ('always_set',): ColumnStats(size=5, nan_count=0, min=True, max=True),
+    }
+
+    sky_region = SkyRegion(*radec2xyz(0., 0.), radius=0.01, nonfinite=0)
+
+    def column_stats(self, colpath):
+        return self.stats.get(colpath)
+
+
+class SingleValuePatch(StatsPatch):
+    stats = {
+        ('object_id',): ColumnStats(size=5, nan_count=0, min=10, max=10),
+    }
+
+
+class NanCoordPatch(StatsPatch):
+    sky_region = SkyRegion(*radec2xyz(0., 0.), radius=0.01, nonfinite=1)
+
+
+class OldSkyIndexPatch(StatsPatch):
+    sky_region = SkyRegion(*radec2xyz(0., 0.), radius=0.01)  # nonfinite is unknown
+
+
+class TestMayMatch(unittest.TestCase):
+    def test_comparison(self):
+        self.assertTrue(may_match(sql2expression('object_id > 15'), self.patch))
+        self.assertFalse(may_match(sql2expression('object_id > 20'), self.patch))
+        self.assertFalse(may_match(sql2expression('object_id < 10'), self.patch))
+        self.assertTrue(may_match(sql2expression('object_id = 10'), self.patch))
+        self.assertFalse(may_match(sql2expression('object_id <> 10'), cast(Patch, SingleValuePatch())))
+        self.assertTrue(may_match(sql2expression('unknown > 0'), self.patch))
+
+    def test_between(self):
+        self.assertTrue(may_match(sql2expression('object_id BETWEEN 0 AND 10'), self.patch))
+        self.assertFalse(may_match(sql2expression('object_id BETWEEN 21 AND 30'), self.patch))
+        self.assertFalse(may_match(sql2expression('object_id NOT BETWEEN 0 AND 30'), self.patch))
+
+    def test_nan(self):
+        self.assertFalse(may_match(sql2expression('flux > 0'), self.patch))
+        self.assertTrue(may_match(sql2expression('NOT flux > 0'), self.patch))
+        self.assertTrue(may_match(sql2expression('isnan(flux)'), self.patch))
+        self.assertFalse(may_match(sql2expression('NOT isnan(flux)'), self.patch))
+
+    def test_bool_expression(self):
+        self.assertFalse(may_match(sql2expression('object_id > 15 AND object_id < 5'), self.patch))
+        self.assertTrue(may_match(sql2expression('object_id > 30 OR object_id < 12'), self.patch))
+        self.assertFalse(may_match(sql2expression('NOT (object_id >= 10)'), self.patch))
+
+    def test_flag(self):
+        self.assertFalse(may_match(sql2expression('never_set'), self.patch))
+        self.assertTrue(may_match(sql2expression('NOT never_set'), self.patch))
+        self.assertFalse(may_match(sql2expression('NOT always_set'), self.patch))
+
+    def test_cone(self):
+        self.assertTrue(may_match(sql2expression('cone(forced.coord, 0, 0, 0.001)'), self.patch))
+        self.assertTrue(may_match(sql2expression('cone(forced.coord, 0.015, 0, 0.01)'), self.patch))
+        self.assertFalse(may_match(sql2expression('cone(forced.coord, 0.025, 0, 0.01)'), self.patch))
+        self.assertFalse(may_match(sql2expression('NOT cone(forced.coord, 0, 0, 0.02)'), self.patch))
+        self.assertTrue(may_match(sql2expression('cone(meas.i_coord, 0.025, 0, 0.01)'), self.patch))
+
+    def test_cone_with_nan_coord(self):
+        patch = cast(Patch, NanCoordPatch())
+        self.assertTrue(may_match(sql2expression('cone(forced.coord, 0, 0, 0.02)'), patch))
+        self.assertTrue(may_match(sql2expression('NOT cone(forced.coord, 0, 0, 0.02)'), patch))
+
+    def test_cone_with_old_skyindex(self):
+        patch = cast(Patch, OldSkyIndexPatch())
+        self.assertFalse(may_match(sql2expression('cone(forced.coord, 0.025, 0, 0.01)'), patch))
+        self.assertTrue(may_match(sql2expression('NOT cone(forced.coord, 0, 0, 0.02)'), patch))
+
+    def test_arithmetic(self):
+        self.assertFalse(may_match(sql2expression('object_id - 10 > 10'), self.patch))
+        self.assertTrue(may_match(sql2expression('- object_id < -15'), self.patch))
+        self.assertTrue(may_match(sql2expression('2 * object_id > 30'), self.patch))
+
+    patch = cast(Patch, StatsPatch())  # only zone maps are looked up
+
+
+def sql2expression(subsql: str):
+    sql = f'''SELECT {subsql} FROM t'''
+    select = Select(sql)
+    return select.target_list[0].val
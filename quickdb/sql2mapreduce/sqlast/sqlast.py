@@ -1,4 +1,5 @@
 # See https://github.com/postgres/postgres/blob/master/src/include/nodes/parsenodes.h
+import json
 from abc import ABCMeta, abstractmethod
 from itertools import chain
 from pprint import pprint
@@ -18,6 +19,22 @@ def parse_sql(sql: str):
         raise SqlError(str(error))
 
 
+def normalize_sql(sql: str) -> str:
+    '''
+    Returns the parse tree of `sql` in JSON
+    so that queries which differ only in spaces, comments or cases of keywords get the same string.
+    '''
+    return json.dumps(_strip_locations(parse_sql(sql)), sort_keys=True)
+
+
+def _strip_locations(node):
+    if isinstance(node, dict):
+        return {k: _strip_locations(v) for k, v in node.items() if k not in ('location', 'stmt_location', 'stmt_len')}
+    if isinstance(node, (list, tuple)):
+        return [_strip_locations(v) for v in node]
+    return node
+
+
 class SqlError(RuntimeError):
     pass
 
@@ -49,6 +66,10 @@ class Select:
         if len(meta.a) > 0:
             raise SqlError(f'Unknown syntax: {meta.a}')  # pragma: no cover
 
+    @cached_property
+    def normalized(self) -> str:
+        return normalize_sql(self._sql)
+
     @cached_property
     def target_list(self):
         if 'targetList' not in self._meta.a:
@@ -0,0 +1,55 @@
+import hashlib
+import threading
+from typing import Callable, Dict, Optional, TypeVar
+
+from quickdb.datarake import sharedcache
+from quickdb.sql2mapreduce.agg import code_version
+from quickdb.sql2mapreduce.sqlast.sqlast import Select, normalize_sql
+from quickdb.utils.diskcache import DiskCache
+
+T = TypeVar('T')
+
+
+class ResultCache:
+    '''
+    Keeps results of queries in `cache`.
+
+    A result is keyed by the normalized SQL, the contents of `shared`, the version of the data of the rerun
+    and the version of the code of `sql2mapreduce`,
+    so a redeployed rerun or an update of the code invalidates the results of the queries.
+    Queries on reruns whose version is None are not cached.
+
+    Example:
+        result_cache = ResultCache(DiskCache(directory, max_bytes=1024**3), master.data_version)
+        result = result_cache.run(sql, shared, lambda: run_sql(sql, run_make_env, shared))
+    '''
+
+    def __init__(self, cache: DiskCache, data_version: Callable[[str], Optional[str]]):
+        self._cache = cache
+        self._data_version = data_version
+        self._lock = threading.Lock()
+        self.uncached = 0
+
+    def run(self, sql: str, shared: Dict, run: Callable[[], T]) -> T:
+        select = Select(sql)
+        version = self._data_version(select.from_clause.relname)
+        if version is None:
+            with self._lock:
+                self.uncached += 1
+            return run()
+        return self._cache.load_pickle(cache_key(sql, shared, version), run)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {**self._cache.stats._asdict(), 'uncached': self.uncached}
+
+
+def cache_key(sql: str, shared: Dict, version: str) -> str:
+    payload, _ = sharedcache.pack(shared)  # large arrays are represented by their digests
+    h = hashlib.sha256()
+    h.update(normalize_sql(sql).encode())
+    h.update(hashlib.sha256(payload.data).digest())
+    h.update(version.encode())
+    h.update(code_version().encode())
+    return h.hexdigest()
+
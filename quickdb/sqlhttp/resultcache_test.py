@@ -0,0 +1,70 @@
+import tempfile
+import unittest
+
+import numpy
+
+from quickdb.utils.diskcache import DiskCache
+
+from .resultcache import ResultCache, cache_key, normalize_sql
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.version = 'v1'
+        self.cache = ResultCache(DiskCache(self._tmp_dir.name, max_bytes=1024**2), lambda rerun: self.version)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def run_query(self, sql, shared={}):
+        runs = []
+
+        def run():
+            runs.append(1)
+            return {'value': 42}
+
+        self.assertEqual(self.cache.run(sql, shared, run), {'value': 42})
+        return len(runs)
+
+    def test_hit(self):
+        self.assertEqual(self.run_query('SELECT COUNT(*) FROM pdr2_dud'), 1)
+        self.assertEqual(self.run_query('select  count(*)\nFROM pdr2_dud'), 0)
+        self.assertEqual(self.cache.stats['hits'], 1)
+
+    def test_shared(self):
+        sql = 'SELECT COUNT(*) FROM pdr2_dud WHERE shared.a > 0'
+        self.assertEqual(self.run_query(sql, {'a': numpy.arange(10)}), 1)
+        self.assertEqual(self.run_query(sql, {'a': numpy.arange(10)}), 0)
+        self.assertEqual(self.run_query(sql, {'a': numpy.arange(11)}), 1)
+
+    def test_redeploy(self):
+        sql = 'SELECT COUNT(*) FROM pdr2_dud'
+        self.assertEqual(self.run_query(sql), 1)
+        self.version = 'v2'
+        self.assertEqual(self.run_query(sql), 1)
+
+    def test_no_version(self):
+        sql = 'SELECT COUNT(*) FROM pdr2_dud'
+        self.version = None
+        self.assertEqual(self.run_query(sql), 1)
+        self.assertEqual(self.run_query(sql), 1)
+        self.assertEqual(self.cache.stats['uncached'], 2)
+
+
+class TestNormalizeSql(unittest.TestCase):
+    def test_normalize_sql(self):
+        self.assertEqual(normalize_sql('SELECT object_id FROM pdr2_dud'), normalize_sql('select object_id -- comment\n from pdr2_dud'))
+        self.assertNotEqual(normalize_sql("SELECT object_id FROM pdr2_dud WHERE a = 'A'"), normalize_sql("SELECT object_id FROM pdr2_dud WHERE a = 'a'"))
+
+    def test_cache_key(self):
+        self.assertNotEqual(cache_key('SELECT 1 FROM a', {}, 'v1'), cache_key('SELECT 1 FROM a', {}, 'v2'))
+
+    def test_cache_key_with_code_version(self):
+        from . import resultcache
+        key = cache_key('SELECT 1 FROM a', {}, 'v1')
+        resultcache.code_version, code_version = (lambda: 'updated'), resultcache.code_version
+        try:
+            self.assertNotEqual(cache_key('SELECT 1 FROM a', {}, 'v1'), key)
+        finally:
+            resultcache.code_version = code_version
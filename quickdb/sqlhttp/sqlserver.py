@@ -3,10 +3,11 @@ import queue
 import secrets
 import threading
 import traceback
-from typing import Dict, NamedTuple
+from typing import Dict, NamedTuple, Optional
 
 from flask import Flask, Response, abort, make_response, request
 
+from quickdb.datarake import config as datarake_config
 from quickdb.datarake import master
 from quickdb.datarake.interface import Progress, ProgressCB
 from quickdb.datarake.safeevent import SafeEvent
@@ -15,11 +16,16 @@ from quickdb.sql2mapreduce.sqlast.sqlast import SqlError
 from quickdb.sspcatalog.errors import UserError
 
 from . import jsonnpy
+from .resultcache import ResultCache
 
 app = Flask(__name__)
 
 run_make_env = agg_test.run_make_env if os.environ.get('TEST') else master.run_make_env
 
+result_cache: Optional[ResultCache] = None
+if not os.environ.get('TEST') and getattr(datarake_config, 'result_cache', None) is not None:
+    result_cache = ResultCache(datarake_config.result_cache, master.data_version)
+
 
 jobs: Dict[str, 'Job'] = {}
 
@@ -77,6 +83,13 @@ def streaming_response(req: Dict):
     return Response(g(), mimetype='application/hscssp-jsonnpy')
 
 
+@app.route('/metrics')
+def show_metrics():
+    return jsonnpy_response({
+        'result_cache': result_cache and result_cache.stats,
+    })
+
+
 @app.route('/jobs/<job_id>')
 def show_job(job_id: str):
     job = jobs.get(job_id)
@@ -144,7 +157,9 @@ class Job:
         try:
             with SafeEvent() as interrupt:
                 self.interrupt = interrupt
-                self.result = run_sql(self._sql, run_make_env, shared=self._shared, progress=self._update_progress, interrupt_notifiyer=interrupt)
+                def run():
+                    return run_sql(self._sql, run_make_env, shared=self._shared, progress=self._update_progress, interrupt_notifiyer=interrupt)
+                self.result = run() if result_cache is None else result_cache.run(self._sql, self._shared, run)
         except (UserError, SqlError) as e:
             self.error = str(e)
         except:
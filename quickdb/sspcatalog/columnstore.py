@@ -0,0 +1,198 @@
+'''
+Consolidated column files of a rerun.
+
+Each `.npy` file of patches (e.g. `patches/9813-4,7/forced/HSC-I/psfflux_flux.npy`) is concatenated
+along its last axis over all patches of the rerun into one file (`columns/forced/HSC-I/psfflux_flux.npy`).
+`columns/index.pickle` holds the offset and the size of each patch in the concatenated files.
+A patch reads its rows from the consolidated files through a memory map,
+so a query opens each column file only once per process instead of once per patch.
+
+Usage: ::
+
+    $ python -m quickdb.sspcatalog.columnstore $SOMEWHERE/repo/pdr2_wide
+'''
+import argparse
+import collections
+import glob
+import logging
+import os
+import pickle
+import shutil
+from typing import Dict, List, NamedTuple, Optional, Set, cast
+
+import numpy
+
+COLUMNSTORE_DIR = 'columns'
+INDEX_FILE = 'index.pickle'
+
+
+class PatchEntry(NamedTuple):
+    offset: int
+    size: int
+    dirs: Set[str]  # directories which exist in the patch
+
+
+class ColumnStore:
+    '''
+    Reads columns of patches from consolidated files.
+
+    Example:
+        store = ColumnStore(f'{rerun_dir}/columns')
+        flux = store.read('9813-4,7', 'forced/HSC-I/psfflux_flux.npy')
+    '''
+
+    def __init__(self, dirname: str):
+        self._dirname = dirname
+        with open(f'{dirname}/{INDEX_FILE}', 'rb') as f:
+            index = pickle.load(f)
+        self._patches = {name: PatchEntry(offset, size, set(dirs)) for name, (offset, size, dirs) in index['patches'].items()}
+        self._missing: Dict[str, Set[str]] = {relpath: set(names) for relpath, names in index['columns'].items()}
+        self._arrays: Dict[str, numpy.memmap] = {}
+
+    def has_patch(self, name: str) -> bool:
+        return name in self._patches
+
+    def has_dir(self, name: str, reldir: str) -> bool:
+        return os.path.normpath(reldir) in self._patches[name].dirs
+
+    def read(self, name: str, relpath: str, indices: Optional[numpy.ndarray] = None) -> Optional[numpy.ndarray]:
+        '''
+        Returns rows of the patch `name` in the column file `relpath` (relative to the patch directory).
+        If `indices` (an index vector or a boolean mask) is given, only rows at `indices` are read.
+        None is returned if the column of the patch is not in the store.
+        '''
+        relpath = os.path.normpath(relpath)
+        missing = self._missing.get(relpath)
+        if missing is None or name in missing or name not in self._patches:
+            return None
+        entry = self._patches[name]
+        a = self._array(relpath)
+        if indices is None:
+            return a[..., entry.offset:entry.offset + entry.size]
+        if indices.dtype.kind == 'b':
+            return a[..., entry.offset:entry.offset + entry.size][..., indices]
+        return a[..., entry.offset + indices]
+
+    def prefetch(self, name: str, relpath: str) -> bool:
+        '''
+        Asks the OS to read the rows of the patch `name` in the column file `relpath` ahead of use.
+        False is returned if the column of the patch is not in the store.
+        '''
+        relpath = os.path.normpath(relpath)
+        missing = self._missing.get(relpath)
+        if missing is None or name in missing or name not in self._patches:
+            return False
+        entry = self._patches[name]
+        a = self._array(relpath)
+        total = a.shape[-1]
+        for i in range(int(numpy.prod(a.shape[:-1]))):
+            readahead(f'{self._dirname}/{relpath}', a.offset + (i * total + entry.offset) * a.itemsize, entry.size * a.itemsize)
+        return True
+
+    def _array(self, relpath: str) -> numpy.memmap:
+        a = self._arrays.get(relpath)
+        if a is None:
+            a = self._arrays[relpath] = cast(numpy.memmap, numpy.load(f'{self._dirname}/{relpath}', mmap_mode='r'))
+        return a
+
+
+class _Header(NamedTuple):
+    dtype: numpy.dtype
+    shape: tuple
+
+
+def build(rerun_dir: str, prune: bool = False):
+    '''
+    Builds the consolidated column files of a rerun.
+
+    Args:
+        prune: If True, the column files of patches are removed after being consolidated.
+               Only meta data such as `meta.pickle` are left in the patch directories.
+    '''
+    patch_dirs = sorted(glob.glob(f'{rerun_dir}/patches/*'))
+    patches: Dict[str, tuple] = {}
+    headers: Dict[str, Dict[str, _Header]] = {}
+    offset = 0
+    for patch_dir in patch_dirs:
+        name = os.path.basename(patch_dir)
+        with open(f'{patch_dir}/meta.pickle', 'rb') as f:
+            size = pickle.load(f)['size']
+        dirs = sorted(os.path.normpath(os.path.relpath(d, patch_dir)) for d, _, _ in os.walk(patch_dir))
+        patches[name] = (offset, size, dirs)
+        offset += size
+        for filename in glob.glob(f'{patch_dir}/**/*.npy', recursive=True):
+            a = numpy.load(filename, mmap_mode='r')
+            headers.setdefault(os.path.relpath(filename, patch_dir), {})[name] = _Header(a.dtype, a.shape)
+    total = offset
+
+    tmp_dir = f'{rerun_dir}/{COLUMNSTORE_DIR}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    columns: Dict[str, List[str]] = {}
+    for i, (relpath, by_patch) in enumerate(sorted(headers.items())):
+        if i % 100 == 0:
+            logging.info(f'columnstore {i} / {len(headers)}...')
+        inner_shapes = {h.shape[:-1] for h in by_patch.values()}
+        if len(inner_shapes) != 1:
+            logging.warning(f'{relpath} is not consolidated because of its shape')
+            continue
+        inner_shape, = inner_shapes
+        # patches of another dtype keep their own files; a common type could lose precision (e.g. int64 and uint64)
+        dtype, _ = collections.Counter(h.dtype for h in by_patch.values()).most_common(1)[0]
+        os.makedirs(os.path.dirname(f'{tmp_dir}/{relpath}'), exist_ok=True)
+        out = numpy.lib.format.open_memmap(f'{tmp_dir}/{relpath}', mode='w+', dtype=dtype, shape=(*inner_shape, total))
+        missing = []
+        for name, (offset, size, _) in patches.items():
+            header = by_patch.get(name)
+            if header is None or header.shape[-1] != size or header.dtype != dtype:
+                missing.append(name)  # patch falls back to its own file
+                continue
+            out[..., offset:offset + size] = numpy.load(f'{rerun_dir}/patches/{name}/{relpath}', mmap_mode='r')
+        out.flush()
+        del out
+        columns[os.path.normpath(relpath)] = missing
+
+    with open(f'{tmp_dir}/{INDEX_FILE}', 'wb') as f:
+        pickle.dump({'patches': patches, 'columns': columns}, f)
+    dst_dir = f'{rerun_dir}/{COLUMNSTORE_DIR}'
+    shutil.rmtree(dst_dir, ignore_errors=True)  # processes which have mapped old files can still read them
+    os.rename(tmp_dir, dst_dir)
+
+    if prune:
+        for relpath, missing in columns.items():
+            for name in set(patches) - set(missing):
+                os.unlink(f'{rerun_dir}/patches/{name}/{relpath}')
+
+
+def readahead(filename: str, offset: int = 0, length: int = 0):
+    '''
+    Asks the OS to read `length` bytes from `offset` of `filename` into the page cache (whole file if `length` is 0).
+    '''
+    if not hasattr(os, 'posix_fadvise'):  # pragma: no cover
+        return
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def read_columnstore(rerun_dir: str) -> Optional[ColumnStore]:
+    if os.path.exists(f'{rerun_dir}/{COLUMNSTORE_DIR}/{INDEX_FILE}'):
+        return ColumnStore(f'{rerun_dir}/{COLUMNSTORE_DIR}')
+    return None
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--prune', action='store_true', help='remove column files of patches after consolidation')
+    parser.add_argument('data')
+    args = parser.parse_args()
+    build(args.data, args.prune)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy
+
+from .columnstore import build
+from .patch import Rerun
+
+
+def make_rerun(rerun_dir: str):
+    flags = {'flag_a': (0, 1)}
+    dtype = {'psfflux_flux': (numpy.dtype('float64'), (-1,))}
+    with open(f'{rerun_dir}/meta.pickle', 'wb') as f:
+        pickle.dump({
+            'forced_universal': {'flags': {}, 'dtype': {'coord': (numpy.dtype('float64'), (2, -1))}},
+            'forced_filter': {'flags': flags, 'dtype': dtype},
+            'meas_position': {'flags': {}, 'dtype': {}},
+            'meas_filter': {'flags': flags, 'dtype': dtype},
+        }, f)
+    for name, size, filters in [('0-1,1', 3, ['HSC-G', 'HSC-I']), ('0-1,2', 2, ['HSC-G'])]:
+        patch_dir = f'{rerun_dir}/patches/{name}'
+        os.makedirs(f'{patch_dir}/forced/universal')
+        with open(f'{patch_dir}/meta.pickle', 'wb') as f:
+            pickle.dump({'size': size}, f)
+        numpy.save(f'{patch_dir}/object_id.npy', numpy.arange(size) + 10 * size)
+        numpy.save(f'{patch_dir}/forced/universal/coord.npy', numpy.random.uniform(size=(2, size)))
+        for filtername in filters:
+            os.makedirs(f'{patch_dir}/forced/{filtername}')
+            numpy.save(f'{patch_dir}/forced/{filtername}/psfflux_flux.npy', numpy.random.uniform(size=size))
+            numpy.save(f'{patch_dir}/forced/{filtername}/flags-0.npy', numpy.arange(size))
+
+
+class TestColumnStore(unittest.TestCase):
+    def test_same_columns(self):
+        colpaths = ['object_id', 'forced.coord', 'forced.g.psfflux_flux', 'forced.i.psfflux_mag', 'forced.i.flag_a']
+        with tempfile.TemporaryDirectory() as rerun_dir:
+            make_rerun(rerun_dir)
+            expected = {os.path.basename(p._dirname): [p(c) for c in colpaths] for p in Rerun(rerun_dir).patches}
+            build(rerun_dir, prune=True)
+            self.assertFalse(os.path.exists(f'{rerun_dir}/patches/0-1,1/forced/HSC-G/psfflux_flux.npy'))
+            rerun = Rerun(rerun_dir)
+            self.assertIsNotNone(rerun.column_store)
+            for patch in rerun.patches:
+                for c, e in zip(colpaths, expected[os.path.basename(patch._dirname)]):
+                    numpy.testing.assert_array_equal(patch(c), e)
+                sliced = patch[numpy.array([1, 0])]
+                numpy.testing.assert_array_equal(sliced('object_id'), patch('object_id')[[1, 0]])
+                numpy.testing.assert_array_equal(sliced('forced.i.flag_a'), patch('forced.i.flag_a')[[1, 0]])
+
+    def test_rebuild(self):
+        with tempfile.TemporaryDirectory() as rerun_dir:
+            make_rerun(rerun_dir)
+            build(rerun_dir)
+            rerun = Rerun(rerun_dir)
+            patch = rerun.patches[0]
+            expected = patch('object_id') + 1
+            numpy.save(f'{patch._dirname}/object_id.npy', expected)
+            build(rerun_dir)
+            numpy.testing.assert_array_equal(patch('object_id'), expected)
+
+    def test_mixed_dtypes(self):
+        with tempfile.TemporaryDirectory() as rerun_dir:
+            make_rerun(rerun_dir)
+            object_id = numpy.array([2**62 + 1, 2**62 + 2], dtype=numpy.uint64)
+            numpy.save(f'{rerun_dir}/patches/0-1,2/object_id.npy', object_id)
+            build(rerun_dir, prune=True)
+            self.assertTrue(os.path.exists(f'{rerun_dir}/patches/0-1,2/object_id.npy'))
+            patches = {os.path.basename(p._dirname): p for p in Rerun(rerun_dir).patches}
+            self.assertEqual(patches['0-1,1']('object_id').dtype, numpy.int64)
+            self.assertEqual(patches['0-1,2']('object_id').dtype, numpy.uint64)
+            numpy.testing.assert_array_equal(patches['0-1,2']('object_id'), object_id)
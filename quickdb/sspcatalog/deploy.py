@@ -1,9 +1,11 @@
 from ..datarake import config
+from . import manifest, skyindex, zonemap
 import argparse
 import subprocess
 import glob
 import logging ; logging.basicConfig(level=logging.INFO)
 import os
+import tempfile
 import multiprocessing
 import itertools
 
@@ -12,13 +14,24 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--rerun')
     parser.add_argument('--verbose', '-v', action='store_true')
+    parser.add_argument('--zonemap', action='store_true', help='build zone maps of patches before deploying')
+    parser.add_argument('--skyindex', action='store_true', help='build sky-region index of patches before deploying')
+    parser.add_argument('--columnstore', action='store_true', help='consolidate column files on workers after deploying')
+    parser.add_argument('--prune', action='store_true', help='remove column files of patches on workers after consolidation')
     parser.add_argument('data')
     args = parser.parse_args()
+    if args.prune and not args.columnstore:
+        parser.error('--prune requires --columnstore')
 
     if args.rerun is None:
         args.rerun = os.path.basename(args.data)
     n_workers = len(config.workers)
 
+    if args.zonemap:
+        zonemap.build(args.data)
+    if args.skyindex:
+        skyindex.build(args.data)
+
     allPatches = glob.glob(f'{args.data}/patches/*')
     processes = []
     for i, worker in enumerate(config.workers):
@@ -31,7 +44,7 @@ def main():
         s = len(allPatches) * i // n_workers
         e = len(allPatches) * (i + 1) // n_workers
         files = allPatches[s:e]
-        p = multiprocessing.Process(target=deploy, args=(worker, args.rerun, files, args.verbose))
+        p = multiprocessing.Process(target=deploy, args=(worker, args.data, args.rerun, files, args.verbose, args.columnstore, args.prune))
         p.start()
         processes.append(p)
 
@@ -58,7 +71,7 @@ files_to_deploy = '''
 '''.split()
 
 
-def deploy(worker, rerun, files, verbose):
+def deploy(worker, data, rerun, files, verbose, columnstore=False, prune=False):
     assert len(worker.work_dir) > 0
     remote_patches = set(subprocess.check_output([
         'ssh', worker.host, f'ls {worker.work_dir}/repo/{rerun}/patches',
@@ -77,6 +90,28 @@ def deploy(worker, rerun, files, verbose):
             [ '--exclude', '*' ] +
             batch_files + [f'{worker.host}:{worker.work_dir}/repo/{rerun}/patches']
         )
+    deploy_manifest(worker, data, rerun, files)
+    # consolidated columns of the old data are used until they are rebuilt and swapped in at once,
+    # because column files of patches may have been pruned
+    if columnstore:
+        logging.info(f'consolidating columns on {worker.host}...')
+        subprocess.check_call([
+            'ssh', worker.host,
+            f'cd {worker.work_dir}/python_path && {worker.python_path} -m quickdb.sspcatalog.columnstore {"--prune " if prune else ""}{worker.work_dir}/repo/{rerun}',
+        ])
+    else:
+        # patches have all their column files again
+        subprocess.check_call(['ssh', worker.host, f'rm -rf {worker.work_dir}/repo/{rerun}/columns'])
+
+
+def deploy_manifest(worker, data, rerun, files):
+    '''
+    Sends the manifest of the patches deployed to `worker`
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manifest_file = f'{tmp_dir}/{manifest.MANIFEST_FILE}'
+        manifest.write_manifest(manifest_file, manifest.build_manifest(data, files))
+        subprocess.check_call(['rsync', manifest_file, f'{worker.host}:{worker.work_dir}/repo/{rerun}/{manifest.MANIFEST_FILE}'])
 
 
 def batch(iterable, size):
@@ -0,0 +1,96 @@
+'''
+Manifest of a rerun.
+
+`manifest.pickle` is placed in the rerun directory.
+It lists the patches with their sizes, the directories (tables and filters) they have and their versions,
+so that a rerun is opened without scanning the patch directories.
+Versions are hashes of the sizes and the modification times of the files.
+
+Usage: ::
+
+    $ python -m quickdb.sspcatalog.manifest $SOMEWHERE/repo/pdr2_wide
+'''
+import argparse
+import glob
+import hashlib
+import logging
+import os
+import pickle
+from typing import Dict, FrozenSet, List, NamedTuple
+
+MANIFEST_FILE = 'manifest.pickle'
+
+
+class PatchManifest(NamedTuple):
+    size: int
+    dirs: FrozenSet[str]  # directories which exist in the patch
+    version: str
+
+
+class Manifest(NamedTuple):
+    version: str
+    patches: Dict[str, PatchManifest]
+
+
+def patch_manifest(patch_dir: str) -> PatchManifest:
+    with open(f'{patch_dir}/meta.pickle', 'rb') as f:
+        size = pickle.load(f)['size']
+    dirs = set()
+    h = hashlib.sha1()
+    for dirpath, dirnames, filenames in sorted(os.walk(patch_dir)):
+        reldir = os.path.normpath(os.path.relpath(dirpath, patch_dir))
+        dirs.add(reldir)
+        for filename in sorted(filenames):
+            st = os.stat(f'{dirpath}/{filename}')
+            h.update(f'{reldir}/{filename}:{st.st_size}:{st.st_mtime_ns}\n'.encode())
+    return PatchManifest(size, frozenset(dirs), h.hexdigest())
+
+
+def build_manifest(rerun_dir: str, patch_dirs: List[str]) -> Manifest:
+    patches: Dict[str, PatchManifest] = {}
+    for i, patch_dir in enumerate(patch_dirs):
+        if i % 1000 == 0:
+            logging.info(f'manifest {i} / {len(patch_dirs)}...')
+        patches[os.path.basename(patch_dir)] = patch_manifest(patch_dir)
+    h = hashlib.sha1()
+    with open(f'{rerun_dir}/meta.pickle', 'rb') as f:
+        h.update(f.read())
+    for name in sorted(patches):
+        h.update(f'{name}:{patches[name].version}\n'.encode())
+    return Manifest(h.hexdigest(), patches)
+
+
+def write_manifest(filename: str, manifest: Manifest):
+    # the file is replaced at once because running workers read it again when it changes
+    with open(f'{filename}.tmp', 'wb') as f:
+        # entries are stored as plain tuples not to depend on the module path of the classes
+        pickle.dump({
+            'version': manifest.version,
+            'patches': {name: (p.size, sorted(p.dirs), p.version) for name, p in manifest.patches.items()},
+        }, f)
+    os.replace(f'{filename}.tmp', filename)
+
+
+def read_manifest(filename: str) -> Manifest:
+    with open(filename, 'rb') as f:
+        raw = pickle.load(f)
+    return Manifest(raw['version'], {
+        name: PatchManifest(size, frozenset(dirs), version) for name, (size, dirs, version) in raw['patches'].items()
+    })
+
+
+def build(rerun_dir: str):
+    manifest = build_manifest(rerun_dir, glob.glob(f'{rerun_dir}/patches/*'))
+    write_manifest(f'{rerun_dir}/{MANIFEST_FILE}', manifest)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data')
+    args = parser.parse_args()
+    build(args.data)
+
+
+if __name__ == '__main__':
+    main()
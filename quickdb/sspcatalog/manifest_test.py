@@ -0,0 +1,49 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy
+
+from .columnstore_test import make_rerun
+from .manifest import build
+from .patch import Rerun
+
+
+class TestManifest(unittest.TestCase):
+    def test_rerun_with_manifest(self):
+        with tempfile.TemporaryDirectory() as rerun_dir:
+            make_rerun(rerun_dir)
+            build(rerun_dir)
+            rerun = Rerun(rerun_dir)
+            self.assertIsNotNone(rerun.version)
+            self.assertEqual([os.path.basename(p._dirname) for p in rerun.patches], ['0-1,1', '0-1,2'])
+            self.assertEqual([p.size for p in rerun.patches], [3, 2])
+            self.assertTrue(numpy.isnan(rerun.patches[1]('forced.i.psfflux_flux')).all())
+            self.assertEqual(len(rerun.patches[0]('forced.i.psfflux_flux')), 3)
+
+    def test_version(self):
+        with tempfile.TemporaryDirectory() as rerun_dir:
+            make_rerun(rerun_dir)
+            build(rerun_dir)
+            versions = [p.version for p in Rerun(rerun_dir).patches]
+            numpy.save(f'{rerun_dir}/patches/0-1,2/object_id.npy', numpy.arange(2))
+            os.utime(f'{rerun_dir}/patches/0-1,2/object_id.npy', ns=(0, 0))
+            build(rerun_dir)
+            new_versions = [p.version for p in Rerun(rerun_dir).patches]
+            self.assertEqual(versions[0], new_versions[0])
+            self.assertNotEqual(versions[1], new_versions[1])
+
+    def test_redeploy(self):
+        with tempfile.TemporaryDirectory() as rerun_dir:
+            make_rerun(rerun_dir)
+            build(rerun_dir)
+            rerun = Rerun(rerun_dir)
+            version = rerun.version
+            self.assertEqual([p.size for p in rerun.patches], [3, 2])
+            numpy.save(f'{rerun_dir}/patches/0-1,2/object_id.npy', numpy.arange(4))
+            with open(f'{rerun_dir}/patches/0-1,2/meta.pickle', 'wb') as f:
+                pickle.dump({'size': 4}, f)
+            build(rerun_dir)
+            self.assertNotEqual(rerun.version, version)
+            self.assertEqual([p.size for p in rerun.patches], [3, 4])
@@ -3,12 +3,18 @@ from functools import lru_cache
 import glob
 import os
 import pickle
-from typing import Callable, Dict, List, Tuple, Union
+import shutil
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar, Union, cast
 
 import numpy
 
 from ..utils.cached_property import cached_property
+from ..utils.diskcache import DiskCache
+from .columnstore import COLUMNSTORE_DIR, INDEX_FILE, ColumnStore, readahead
 from .errors import ColumnNotFoundError, UserError
+from .manifest import MANIFEST_FILE, Manifest, PatchManifest, read_manifest
+from .skyindex import SKYINDEX_FILE, SkyRegion, read_skyindex
+from .zonemap import ZONEMAP_FILE, ColumnStats, read_zonemap
 
 FILTER_ALIAS = {
     'g': 'HSC-G',
@@ -21,6 +27,8 @@ FILTER_ALIAS = {
     'n921': 'NB0921',
 }
 
+T = TypeVar('T')
+
 PATCH_META = {
     'flags': {},
     'dtype': {
@@ -30,19 +38,99 @@ PATCH_META = {
 
 
 class Rerun:
-    def __init__(self, dirname: str):
+    def __init__(self, dirname: str, mmap_mode: Optional[str] = None,
+                 column_cache: Optional[DiskCache] = None, partial_cache: Optional[DiskCache] = None):
+        '''
+        Args:
+            dirname: Directory of the rerun.
+            mmap_mode: If given, columns are memory-mapped with this mode (see `numpy.load`)
+                       and only the rows actually used are read from the disk.
+            column_cache: If given, column files are copied into this cache and memory-mapped from there.
+                          The cache lives across queries and is shared by processes.
+            partial_cache: If given, results of `Patch.cached_partial` are kept in this cache.
+        '''
         if not os.path.exists(dirname):
             raise UserError(f'No such rerun: {os.path.basename(dirname)}')  # pragma: no cover
         self._dirname = dirname
+        self._mmap_mode = mmap_mode
+        self._column_cache = column_cache
+        self._partial_cache = partial_cache
+        self._manifest: Optional[Manifest] = None
+        self._manifest_stamp: Optional[Tuple[int, int]] = None
+        self._patches: Optional[List['Patch']] = None
+        self._column_store: Optional[ColumnStore] = None
+        self._sky_index: Optional[Dict[str, SkyRegion]] = None
+        self._sky_index_stamp: Optional[Tuple[int, int]] = None
+        self._column_store_stamp: Optional[Tuple[int, int]] = None
 
     @cached_property
     def meta(self):
         with open(f'{self._dirname}/meta.pickle', 'rb') as f:
             return pickle.load(f)
 
-    @cached_property
+    @property
+    def manifest(self) -> Optional[Manifest]:
+        '''
+        Read again when the rerun is deployed again
+        '''
+        filename = f'{self._dirname}/{MANIFEST_FILE}'
+        stamp = file_stamp(filename)
+        if stamp != self._manifest_stamp:
+            self._manifest = None if stamp is None else read_manifest(filename)
+            self._manifest_stamp = stamp
+            self._patches = None  # listed in the old manifest
+        return self._manifest
+
+    @property
+    def version(self) -> Optional[str]:
+        '''
+        Hash of the contents of the rerun recorded in the manifest
+        '''
+        return None if self.manifest is None else self.manifest.version
+
+    @property
+    def column_store(self) -> Optional[ColumnStore]:
+        '''
+        Opened again when `columns/` is rebuilt
+        '''
+        stamp = file_stamp(f'{self._dirname}/{COLUMNSTORE_DIR}/{INDEX_FILE}')
+        if stamp != self._column_store_stamp:
+            self._column_store = None if stamp is None else ColumnStore(f'{self._dirname}/{COLUMNSTORE_DIR}')
+            self._column_store_stamp = stamp
+        return self._column_store
+
+    @property
+    def sky_index(self) -> Optional[Dict[str, SkyRegion]]:
+        '''
+        Read again when the index is rebuilt
+        '''
+        filename = f'{self._dirname}/{SKYINDEX_FILE}'
+        stamp = file_stamp(filename)
+        if stamp != self._sky_index_stamp:
+            self._sky_index = None if stamp is None else read_skyindex(filename)
+            self._sky_index_stamp = stamp
+        return self._sky_index
+
+    @property
     def patches(self) -> List['Patch']:
-        return [Patch(self, dirname) for dirname in glob.glob(f'{self._dirname}/patches/*')]
+        manifest = self.manifest  # drops the patches of an old manifest
+        if self._patches is None:
+            if manifest is not None:
+                self._patches = [Patch(self, f'{self._dirname}/patches/{name}') for name in sorted(manifest.patches)]
+            else:
+                self._patches = [Patch(self, dirname) for dirname in glob.glob(f'{self._dirname}/patches/*')]
+        return self._patches
+
+
+def file_stamp(filename: str) -> Optional[Tuple[int, int]]:
+    '''
+    Changes when `filename` is replaced or modified. None if it does not exist.
+    '''
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns
 
 
 Colpath = Union[Tuple[str, ...], str]
@@ -61,7 +149,10 @@ class Patch:
     def __init__(self, rerun: Rerun, dirname: str, npy_cache=None):
         self._rerun = rerun
         self._dirname = dirname
-        self._npy_cache: NpyCache = npy_cache or NpyCache()
+        self._npy_cache: NpyCache = npy_cache or NpyCache(rerun._mmap_mode, rerun._column_cache)
+        self._loaders: Dict[Colpath, Callable[[], numpy.ndarray]] = {}
+        self._zonemap: Optional[Dict] = None
+        self._zonemap_stamp: Optional[Tuple[int, int]] = None
 
     @cached_property
     def meta(self):
@@ -70,8 +161,75 @@ class Patch:
 
     @cached_property
     def size(self) -> int:
+        if self._manifest is not None:
+            return self._manifest.size
         return self.meta['size']
 
+    @property
+    def version(self) -> Optional[str]:
+        '''
+        Hash of the files of the patch recorded in the manifest
+        '''
+        return None if self._manifest is None else self._manifest.version
+
+    def cached_partial(self, plan_hash: str, compute: Callable[[], T]) -> T:
+        '''
+        Returns `compute()` for this patch.
+        The value is cached by `plan_hash` and the version of the patch,
+        so it is computed again only for a new plan or after the patch is redeployed with other contents.
+        '''
+        cache = self._rerun._partial_cache
+        if cache is None or self.version is None:
+            return compute()
+        return cache.load_pickle(f'{plan_hash}/{os.path.basename(self._dirname)}/{self.version}', compute)
+
+    @cached_property
+    def _manifest(self) -> Optional[PatchManifest]:
+        if self._rerun.manifest is None:
+            return None
+        return self._rerun.manifest.patches.get(os.path.basename(self._dirname))
+
+    @property
+    def zonemap(self) -> Optional[Dict]:
+        '''
+        Read again when the patch is deployed again
+        '''
+        filename = f'{self._dirname}/{ZONEMAP_FILE}'
+        stamp = file_stamp(filename)
+        if stamp != self._zonemap_stamp:
+            self._zonemap = None if stamp is None else read_zonemap(filename)
+            self._zonemap_stamp = stamp
+        return self._zonemap
+
+    def column_stats(self, colpath: Colpath) -> Optional[ColumnStats]:
+        '''
+        Returns statistics of the column recorded in the zone map.
+        None is returned if they are unknown.
+        Flags are treated as boolean columns.
+        '''
+        zonemap = self.zonemap
+        if zonemap is None:
+            return None
+        dirname, meta, colname = self._resolve_table(colpath)
+        reldir = os.path.relpath(dirname, self._dirname)
+        if colname in meta['flags']:
+            i, j = meta['flags'][colname]
+            stats = zonemap.get(os.path.normpath(f'{reldir}/flags-{i}'))
+            if stats is None:
+                return None
+            return ColumnStats(size=self.size, nan_count=0, min=bool(stats.all_set & (1 << j)), max=bool(stats.any_set & (1 << j)))
+        return zonemap.get(os.path.normpath(f'{reldir}/{colname}'))
+
+    @property
+    def sky_region(self) -> Optional[SkyRegion]:
+        '''
+        Bounding circle of `forced.coord` recorded in the sky index of the rerun.
+        '''
+        sky_index = self._rerun.sky_index
+        if sky_index is None:
+            return None
+        return sky_index.get(os.path.basename(self._dirname))
+
     @cached_property
     def skymap_id(self):
         tract, patch = os.path.basename(self._dirname).split('-')
@@ -86,24 +244,42 @@ class Patch:
         array = self._column_loader(colpath)()
         return array
 
-    def __getitem__(self, where: Union[numpy.ndarray, slice]):
+    def __getitem__(self, where: Union[numpy.ndarray, slice]) -> 'SlicedPatch':
         '''
         Example:
             sliced_patch = patch[patch('forced.i.flag1')]
             assert sliced_patch('forced.i.flag1').all()
         '''
         if isinstance(where, slice):
-            start = 0 if where.start is None else where.start
-            stop = min(self.size,  self.size if where.stop is None else where.stop)
-            indices = numpy.arange(start, stop, where.step)
+            where = numpy.arange(*where.indices(self.size))
+        assert len(where.shape) == 1
+        if where.dtype.kind == 'b':
+            selection = Selection.from_mask(where)
         else:
-            assert len(where.shape) == 1
-            if where.dtype.kind == 'b':
-                indices, = numpy.nonzero(where)
-            else:
-                assert where.dtype.kind == 'i'
-                indices = where
-        return SlicedPatch(self, indices)
+            assert where.dtype.kind == 'i'
+            selection = Selection.from_indices(self.size, where)
+        return SlicedPatch(self, selection)
+
+    def flag_bit(self, colpath: Colpath) -> Optional[Tuple[str, int]]:
+        '''
+        Returns (filename of the packed flag word, bit position) if `colpath` is a flag stored in the patch.
+        None is returned for other columns.
+
+        Example:
+            filename, j = patch.flag_bit('forced.i.pixelflags_edge')
+            edge = patch.flag_word(filename) & (1 << j) != 0
+        '''
+        dirname, meta, colname = self._resolve_table(colpath)
+        if colname not in meta['flags'] or not self._table_exists(dirname):
+            return None
+        i, j = meta['flags'][colname]
+        return f'{dirname}/flags-{i}.npy', j
+
+    def flag_word(self, filename: str) -> numpy.ndarray:
+        '''
+        Returns packed flag words in `filename` returned by `flag_bit`
+        '''
+        return self._read_npy(filename, None)
 
     def __call__(self, colref: str) -> numpy.ndarray:
         '''
@@ -115,25 +291,52 @@ class Patch:
     def clear_cache(self):
         yield self
         self._npy_cache.cache.cache_clear()
+        self._loaders.clear()
 
-    @lru_cache(maxsize=None)
     def _column_loader(self, colpath: Colpath) -> Callable[[], numpy.ndarray]:
         '''
         Loads a npy file specified by colpath
         '''
+        loader = self._loaders.get(colpath)
+        if loader is None:
+            loader = self._loaders[colpath] = self._make_column_loader(colpath)
+        return loader
+
+    def _make_column_loader(self, colpath: Colpath) -> Callable[[], numpy.ndarray]:
         dirname, meta, colname = self._resolve_table(colpath)
-        # apply transforms
-        if colname.endswith('_mag'):
-            flux_col = f'{colname[:-4]}_flux'
-            if flux_col in meta['dtype']:
-                return lambda: flux2mag(self._load_npy(meta, dirname, flux_col))
-        if colname.endswith('coord'):
-            return lambda: self._load_npy(meta, dirname, colname) / (180.0*3600.0 / numpy.pi)
-        if colname.endswith('coord_ra'):
-            return lambda: coord_ra(self._load_npy(meta, dirname, colname[:-3]))
-        if colname.endswith('coord_dec'):
-            return lambda: coord_dec(self._load_npy(meta, dirname, colname[:-4]))
-        return lambda: self._load_npy(meta, dirname, colname)
+        stored_colname, transform = stored_column(meta, colname)
+        if transform is None:
+            return lambda: self._load_npy(meta, dirname, stored_colname)
+        return lambda: transform(self._load_npy(meta, dirname, stored_colname))
+
+    def prefetch(self, colpaths: List[Colpath]):
+        '''
+        Asks the OS to read the files of `colpaths` into the page cache ahead of use.
+        '''
+        store = self._rerun.column_store
+        name = os.path.basename(self._dirname)
+        for colpath in colpaths:
+            try:
+                filename = self._column_file(colpath)
+            except ColumnNotFoundError:
+                continue  # reported when the column is actually loaded
+            if filename is None:
+                continue
+            if store is not None and store.prefetch(name, os.path.relpath(filename, self._dirname)):
+                continue
+            readahead(filename)
+
+    def _column_file(self, colpath: Colpath) -> Optional[str]:
+        dirname, meta, colname = self._resolve_table(colpath)
+        stored_colname, _ = stored_column(meta, colname)
+        if not self._table_exists(dirname):
+            return None
+        if stored_colname in meta['flags']:
+            i, _ = meta['flags'][stored_colname]
+            return f'{dirname}/flags-{i}.npy'
+        if stored_colname in meta['dtype']:
+            return f'{dirname}/{stored_colname}.npy'
+        return None
 
     def _resolve_table(self, colpath: Colpath):
         ref: Tuple[str, ...]
@@ -166,48 +369,180 @@ class Patch:
         colname = ref[-1]
         return dirname, meta, colname
 
-    def _load_npy(self, meta: Dict, dirname: str, colname: str) -> numpy.ndarray:
-        if os.path.exists(dirname):
+    def _load_npy(self, meta: Dict, dirname: str, colname: str, indices: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+        '''
+        Loads a column.
+        If `indices` (an index vector or a boolean mask) is given,
+        only rows at `indices` are picked up before any transformation.
+        '''
+        if self._table_exists(dirname):
             if colname in meta['flags']:
                 i, j = meta['flags'][colname]
-                return self._npy_cache[f'{dirname}/flags-{i}.npy'] & (1 << j) != 0
+                return self._read_npy(f'{dirname}/flags-{i}.npy', indices) & (1 << j) != 0
             else:
                 if colname not in meta['dtype']:  # pragma: no cover
                     raise ColumnNotFoundError(f'No such column: {colname}')
-                return self._npy_cache[f'{dirname}/{colname}.npy']
+                return self._read_npy(f'{dirname}/{colname}.npy', indices)
         else:
+            size = self.size if indices is None else selected_size(indices)
             if colname in meta['flags']:
-                dtype, shape = numpy.dtype('bool'), [self.size]
+                dtype, shape = numpy.dtype('bool'), [size]
             else:
                 if colname not in meta['dtype']:  # pragma: no cover
                     raise ColumnNotFoundError(f'No such column: {colname}')
                 dtype, shape = meta['dtype'][colname]
-                shape = [self.size, *shape[1:]]
+                shape = [size, *shape[1:]]
             return nans(dtype, shape)
 
+    def _table_exists(self, dirname: str) -> bool:
+        if self._manifest is not None:
+            return os.path.normpath(os.path.relpath(dirname, self._dirname)) in self._manifest.dirs
+        store = self._rerun.column_store
+        name = os.path.basename(self._dirname)
+        if store is not None and store.has_patch(name):
+            return store.has_dir(name, os.path.relpath(dirname, self._dirname))
+        return os.path.exists(dirname)
+
+    def _read_npy(self, filename: str, indices: Optional[numpy.ndarray]) -> numpy.ndarray:
+        store = self._rerun.column_store
+        if store is not None:
+            a = store.read(os.path.basename(self._dirname), os.path.relpath(filename, self._dirname), indices)
+            if a is not None:
+                return a
+        if indices is not None and selected_size(indices) == 0:
+            # only the header is read to know dtype and shape
+            return numpy.load(filename, mmap_mode='r')[..., indices]
+        return take(self._npy_cache[filename], indices)
+
 
 class SlicedPatch(Patch):
-    def __init__(self, patch: Patch, indices: numpy.ndarray):
+    def __init__(self, patch: Patch, selection: 'Selection'):
         '''
         Makes a sliced patch.
 
+        Columns are gathered from `patch` only when they are accessed,
+        and each column is gathered only once.
+
         Args:
-            where: numpy.ndarray(dtype=bool)
+            selection: rows of `patch`
         '''
-        assert indices.dtype.kind == 'i' and len(indices.shape) == 1, f'invalid indices: {indices}'
         super().__init__(patch._rerun, patch._dirname, npy_cache=...)
         self._patch = patch
-        self._indices = indices  # indices of objects in the original patch.
+        self._selection = selection
+        self._gathered: Dict[Tuple[str, ...], numpy.ndarray] = {}
 
     def __getitem__(self, where: Union[numpy.ndarray, slice]) -> 'SlicedPatch':
-        return SlicedPatch(self._patch, self._indices[where])
-
-    def _load_npy(self, meta: Dict, dirname: str, colname: str) -> numpy.ndarray:
-        return self._patch._load_npy(meta, dirname, colname)[..., self._indices]  # type: ignore
+        # selections are merged so that columns are always gathered from the original patch
+        return SlicedPatch(self._patch, self._selection[where])
+
+    def _load_npy(self, meta: Dict, dirname: str, colname: str, indices: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+        if indices is not None:
+            return self._patch._load_npy(meta, dirname, colname, self._selection[indices].key)
+        key = (dirname, colname)
+        if key not in self._gathered:
+            self._gathered[key] = self._patch._load_npy(meta, dirname, colname, self._selection.key)
+        return self._gathered[key]
+
+    def flag_word(self, filename: str) -> numpy.ndarray:
+        key = (filename,)
+        if key not in self._gathered:
+            self._gathered[key] = self._patch._read_npy(filename, self._selection.key)
+        return self._gathered[key]
 
     @cached_property
     def size(self):
-        return len(self._indices)
+        return len(self._selection)
+
+
+class Selection:
+    '''
+    Rows selected from a patch of `base_size` rows.
+
+    A dense selection is held as a boolean mask and a sparse one as an index vector,
+    whichever is cheaper to make and to gather with.
+    '''
+
+    DENSE = 1 / 8  # selections having more rows than this fraction of the patch are held as masks
+
+    def __init__(self, base_size: int, mask: Optional[numpy.ndarray] = None, indices: Optional[numpy.ndarray] = None):
+        assert (mask is None) != (indices is None)
+        self.base_size = base_size
+        self._mask = mask
+        self._indices = indices
+
+    @classmethod
+    def from_mask(cls, mask: numpy.ndarray) -> 'Selection':
+        if numpy.count_nonzero(mask) > cls.DENSE * len(mask):
+            return cls(len(mask), mask=mask)
+        return cls(len(mask), indices=numpy.flatnonzero(mask))
+
+    @classmethod
+    def from_indices(cls, base_size: int, indices: numpy.ndarray) -> 'Selection':
+        return cls(base_size, indices=indices)
+
+    @property
+    def key(self) -> numpy.ndarray:
+        '''
+        Boolean mask or index vector to pick up the rows from a column of the patch
+        '''
+        return cast(numpy.ndarray, self._indices) if self._mask is None else self._mask
+
+    @cached_property
+    def indices(self) -> numpy.ndarray:
+        return numpy.flatnonzero(cast(numpy.ndarray, self._mask)) if self._indices is None else self._indices
+
+    def __len__(self):
+        return selected_size(self.key)
+
+    def __getitem__(self, where: Union[numpy.ndarray, slice]) -> 'Selection':
+        '''
+        Returns a selection of rows at `where` in this selection
+        '''
+        if isinstance(where, slice):
+            where = numpy.arange(*where.indices(len(self)))
+        assert len(where.shape) == 1
+        if where.dtype.kind == 'b':
+            if self._mask is not None:
+                mask = self._mask.copy()
+                mask[mask] = where
+                return Selection.from_mask(mask)
+            return Selection.from_indices(self.base_size, self.indices[where])
+        assert where.dtype.kind == 'i'
+        return Selection.from_indices(self.base_size, self.indices[where])
+
+
+def selected_size(indices: numpy.ndarray) -> int:
+    if indices.dtype.kind == 'b':
+        return int(numpy.count_nonzero(indices))
+    return len(indices)
+
+
+def stored_column(meta: Dict, colname: str) -> Tuple[str, Optional[Callable[[numpy.ndarray], numpy.ndarray]]]:
+    '''
+    Returns the name of the column stored in the files for `colname`
+    and the transform to be applied to it.
+    '''
+    if colname.endswith('_mag'):
+        flux_col = f'{colname[:-4]}_flux'
+        if flux_col in meta['dtype']:
+            return flux_col, flux2mag
+    if colname.endswith('coord'):
+        return colname, lambda a: a / (180.0*3600.0 / numpy.pi)
+    if colname.endswith('coord_ra'):
+        return colname[:-3], coord_ra
+    if colname.endswith('coord_dec'):
+        return colname[:-4], coord_dec
+    return colname, None
+
+
+def take(a: numpy.ndarray, indices: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+    '''
+    Picks up elements at `indices` (an index vector or a boolean mask) along the last axis.
+    For a memory-mapped array only the pages including `indices` are read.
+    '''
+    if indices is None:
+        return a
+    return a[..., indices]  # type: ignore
 
 
 def nans(dtype, shape: List[int]) -> numpy.ndarray:
@@ -224,9 +559,21 @@ def nans(dtype, shape: List[int]) -> numpy.ndarray:
 
 
 class NpyCache:
+    def __init__(self, mmap_mode: Optional[str] = None, column_cache: Optional[DiskCache] = None):
+        self._mmap_mode = mmap_mode
+        self._column_cache = column_cache
+
     @lru_cache(maxsize=None)
     def __getitem__(self, filename: str) -> numpy.ndarray:
-        return numpy.load(filename)
+        if self._column_cache:
+            st = os.stat(filename)
+            if self._column_cache.admits(st.st_size):
+                return self._column_cache.load(
+                    f'{os.path.realpath(filename)}:{st.st_mtime_ns}:{st.st_size}',
+                    make=lambda path: shutil.copyfile(filename, path),
+                    load=lambda path: numpy.load(path, mmap_mode='r'),
+                )
+        return numpy.load(filename, mmap_mode=self._mmap_mode)
 
     @property
     def cache(self):
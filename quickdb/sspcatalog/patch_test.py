@@ -1,6 +1,12 @@
-from .patch import Rerun
+from ..utils.diskcache import DiskCache
+from .columnstore_test import make_rerun
+from .manifest import build as build_manifest
+from .patch import Rerun, Selection
+import gc
 import os
+import tempfile
 import unittest
+import weakref
 
 import numpy
 numpy.seterr(all='ignore')
@@ -170,6 +176,19 @@ class TestPatch(unittest.TestCase):
             sliced('forced.i.psfflux_flux')[4::3],
         ))
 
+    def test_mmap_mode(self):
+        rerun = Rerun(self.rerun._dirname, mmap_mode='r')
+        patch = find_by_dirname(rerun, '9813-4,7')
+        self.assertTrue(array_equal(
+            patch('forced.i.psfflux_flux'),
+            self.cosmos_patch('forced.i.psfflux_flux'),
+        ))
+        is_star: numpy.ndarray = patch('forced.i.extendedness_value') < 0.5
+        self.assertTrue(array_equal(
+            patch[is_star]('forced.i.convolvedflux_3_deconv'),
+            self.cosmos_patch('forced.i.convolvedflux_3_deconv')[is_star],
+        ))
+
     def test_nans_float(self):
         patch = self.no_z_patch
         self.assertTrue(numpy.isnan(patch('meas.z.cmodel_flux')).all())
@@ -187,6 +206,68 @@ class TestPatch(unittest.TestCase):
         return find_by_dirname(self.rerun, '10054-3,5')
 
 
+class TestSelection(unittest.TestCase):
+    def test_dense_selection_is_mask(self):
+        mask = numpy.arange(100) % 2 == 0
+        selection = Selection.from_mask(mask)
+        self.assertEqual(selection.key.dtype.kind, 'b')
+        self.assertEqual(len(selection), 50)
+
+    def test_sparse_selection_is_indices(self):
+        mask = numpy.arange(100) == 7
+        selection = Selection.from_mask(mask)
+        self.assertEqual(selection.key.tolist(), [7])
+
+    def test_composition(self):
+        a = numpy.arange(100) * 10
+        selection = Selection.from_mask(a % 20 == 0)
+        for where in [a[selection.key] % 40 == 0, a[selection.key] % 1000 == 0, numpy.array([3, 1]), slice(2, 10, 3)]:
+            composed = selection[where]
+            self.assertEqual(a[composed.key].tolist(), a[selection.key][where].tolist())
+            self.assertEqual(len(composed), len(a[selection.key][where]))
+
+
+class TestSlicedPatch(unittest.TestCase):
+    def test_garbage_collected(self):
+        with tempfile.TemporaryDirectory() as rerun_dir:
+            make_rerun(rerun_dir)
+            patch = Rerun(rerun_dir).patches[0]
+            sliced = patch[numpy.array([True, False, True])]
+            self.assertEqual(sliced('object_id').tolist(), patch('object_id')[[0, 2]].tolist())
+            ref = weakref.ref(sliced)
+            del sliced
+            gc.collect()
+            self.assertIsNone(ref())
+
+
+class TestCachedPartial(unittest.TestCase):
+    def test_cached_partial(self):
+        with tempfile.TemporaryDirectory() as rerun_dir, tempfile.TemporaryDirectory() as cache_dir:
+            make_rerun(rerun_dir)
+            build_manifest(rerun_dir)
+            cache = DiskCache(cache_dir, max_bytes=1024**2)
+            computed = []
+
+            def run(rerun: Rerun, plan_hash='plan'):
+                def compute(patch):
+                    computed.append(os.path.basename(patch._dirname))
+                    return patch.size
+                return [p.cached_partial(plan_hash, lambda: compute(p)) for p in rerun.patches]
+
+            self.assertEqual(run(Rerun(rerun_dir, partial_cache=cache)), [3, 2])
+            self.assertEqual(run(Rerun(rerun_dir, partial_cache=cache)), [3, 2])
+            self.assertEqual(computed, ['0-1,1', '0-1,2'])
+            run(Rerun(rerun_dir, partial_cache=cache), plan_hash='other plan')
+            self.assertEqual(len(computed), 4)
+
+            numpy.save(f'{rerun_dir}/patches/0-1,2/object_id.npy', numpy.arange(2))
+            os.utime(f'{rerun_dir}/patches/0-1,2/object_id.npy', ns=(0, 0))
+            build_manifest(rerun_dir)
+            computed.clear()
+            run(Rerun(rerun_dir, partial_cache=cache))
+            self.assertEqual(computed, ['0-1,2'])
+
+
 def array_equal(a: numpy.ndarray, b: numpy.ndarray):
     return numpy.allclose(a, b, equal_nan=True)
 
@@ -0,0 +1,128 @@
+'''
+Sky-region index of patches.
+
+`skyindex.pickle` is placed in the rerun directory.
+It holds a bounding circle (center unit vector and angular radius) of `forced.coord` for each patch.
+
+Usage: ::
+
+    $ python -m quickdb.sspcatalog.skyindex $SOMEWHERE/releases/pdr2_wide
+'''
+import argparse
+import glob
+import logging
+import math
+import multiprocessing
+import os
+import pickle
+from functools import lru_cache
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import numpy
+
+SKYINDEX_FILE = 'skyindex.pickle'
+SKYINDEX_COLUMN = ('forced', 'coord')
+# 2: regions have `nonfinite`
+SKYINDEX_VERSION = 2
+
+
+class SkyRegion(NamedTuple):
+    x: float
+    y: float
+    z: float
+    radius: float  # radian
+    # number of rows whose coord is not finite, which are outside any circle. None if unknown (an old index)
+    nonfinite: Optional[int] = None
+
+    def separation(self, x: float, y: float, z: float) -> float:
+        '''
+        Angular distance between the center and a unit vector (x, y, z)
+        '''
+        return float(numpy.arccos(numpy.clip(self.x * x + self.y * y + self.z * z, -1., 1.)))
+
+
+def coord2xyz(coord: numpy.ndarray) -> numpy.ndarray:
+    '''
+    Converts `coord` of shape (2, N) (RA and Dec in radian) or (3, N) (unit vectors) into unit vectors.
+    '''
+    n_dim = coord.shape[0]
+    if n_dim == 2:
+        A, D = coord
+        COS_D = numpy.cos(D)
+        return numpy.array([COS_D * numpy.cos(A), COS_D * numpy.sin(A), numpy.sin(D)])
+    elif n_dim == 3:
+        return coord
+    else:
+        raise RuntimeError(f'invalid shape ({coord.shape}) of array for coord')
+
+
+def radec2xyz(ra: float, dec: float) -> Tuple[float, float, float]:
+    return math.cos(dec) * math.cos(ra), math.cos(dec) * math.sin(ra), math.sin(dec)
+
+
+def bounding_region(xyz: numpy.ndarray) -> SkyRegion:
+    finite = numpy.isfinite(xyz).all(axis=0)
+    nonfinite = len(finite) - int(numpy.count_nonzero(finite))
+    xyz = xyz[:, finite]
+    if xyz.shape[1] == 0:
+        return SkyRegion(1., 0., 0., -1., nonfinite)  # matches nothing
+    center = xyz.mean(axis=1)
+    center /= numpy.linalg.norm(center)
+    cos_radius = numpy.clip((center[:, numpy.newaxis] * xyz).sum(axis=0).min(), -1., 1.)
+    x, y, z = center.tolist()
+    return SkyRegion(x, y, z, float(numpy.arccos(cos_radius)), nonfinite)
+
+
+def patch_region(patch) -> SkyRegion:
+    with patch.clear_cache():
+        return bounding_region(coord2xyz(patch.column(SKYINDEX_COLUMN)))
+
+
+def _patch_region1(args):
+    from .patch import Patch
+    rerun_dir, patch_dir = args
+    return os.path.basename(patch_dir), tuple(patch_region(Patch(_rerun(rerun_dir), patch_dir)))
+
+
+@lru_cache(maxsize=None)
+def _rerun(rerun_dir: str):
+    from .patch import Rerun
+    return Rerun(rerun_dir)
+
+
+def build(rerun_dir: str, n_procs: Optional[int] = None):
+    patch_dirs = glob.glob(f'{rerun_dir}/patches/*')
+    regions: Dict[str, tuple] = {}
+    with multiprocessing.Pool(n_procs) as pool:
+        for i, (name, region) in enumerate(pool.imap_unordered(_patch_region1, [(rerun_dir, d) for d in patch_dirs])):
+            regions[name] = region
+            if i % 100 == 0:
+                logging.info(f'skyindex {i} / {len(patch_dirs)}...')
+    # the file is replaced at once because running workers read it again when it changes
+    with open(f'{rerun_dir}/{SKYINDEX_FILE}.tmp', 'wb') as f:
+        # regions are stored as plain tuples not to depend on the module path of SkyRegion
+        pickle.dump({'column': SKYINDEX_COLUMN, 'version': SKYINDEX_VERSION, 'regions': regions}, f)
+    os.replace(f'{rerun_dir}/{SKYINDEX_FILE}.tmp', f'{rerun_dir}/{SKYINDEX_FILE}')
+
+
+def read_skyindex(filename: str) -> Dict[str, SkyRegion]:
+    with open(filename, 'rb') as f:
+        raw = pickle.load(f)
+    assert raw['column'] == SKYINDEX_COLUMN
+    if raw.get('version', 1) < SKYINDEX_VERSION:
+        # non-finite coords were not counted; `nonfinite` is left unknown
+        return {name: SkyRegion(*region[:4]) for name, region in raw['regions'].items()}
+    return {name: SkyRegion(*region) for name, region in raw['regions'].items()}
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--parallel', '-j', type=int)
+    parser.add_argument('data')
+    args = parser.parse_args()
+    build(args.data, args.parallel)
+
+
+if __name__ == '__main__':
+    main()
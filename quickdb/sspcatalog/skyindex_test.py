@@ -0,0 +1,62 @@
+import pickle
+import tempfile
+import unittest
+
+import numpy
+
+from .columnstore_test import make_rerun
+from .patch import Patch, Rerun
+from .skyindex import SKYINDEX_COLUMN, SKYINDEX_FILE, bounding_region, build, coord2xyz, radec2xyz, read_skyindex
+
+
+class TestSkyIndex(unittest.TestCase):
+    def test_bounding_region(self):
+        ra = numpy.array([-0.01, 0.01, 0., 0.])
+        dec = numpy.array([0., 0., -0.01, 0.01])
+        region = bounding_region(coord2xyz(numpy.array([ra, dec])))
+        self.assertAlmostEqual(region.separation(*radec2xyz(0., 0.)), 0.)
+        self.assertAlmostEqual(region.radius, 0.01)
+
+    def test_bounding_region_across_ra_origin(self):
+        ra = numpy.array([2 * numpy.pi - 0.01, 0.01])
+        dec = numpy.array([0., 0.])
+        region = bounding_region(coord2xyz(numpy.array([ra, dec])))
+        self.assertAlmostEqual(region.radius, 0.01)
+
+    def test_bounding_region_without_valid_coord(self):
+        region = bounding_region(coord2xyz(numpy.array([[numpy.nan], [numpy.nan]])))
+        self.assertLess(region.radius, 0)
+        self.assertEqual(region.nonfinite, 1)
+
+    def test_bounding_region_with_nan(self):
+        ra = numpy.array([-0.01, 0.01, numpy.nan])
+        dec = numpy.array([0., 0., numpy.nan])
+        region = bounding_region(coord2xyz(numpy.array([ra, dec])))
+        self.assertAlmostEqual(region.radius, 0.01)
+        self.assertEqual(region.nonfinite, 1)
+
+    def test_old_skyindex(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(f'{tmp_dir}/{SKYINDEX_FILE}', 'wb') as f:
+                pickle.dump({'column': SKYINDEX_COLUMN, 'regions': {'0-1,1': (1., 0., 0., 0.01)}}, f)
+            region = read_skyindex(f'{tmp_dir}/{SKYINDEX_FILE}')['0-1,1']
+        self.assertEqual(region.radius, 0.01)
+        self.assertIsNone(region.nonfinite)
+
+    def test_build(self):
+        with tempfile.TemporaryDirectory() as rerun_dir:
+            make_rerun(rerun_dir)
+            build(rerun_dir, 1)
+            regions = read_skyindex(f'{rerun_dir}/{SKYINDEX_FILE}')
+        self.assertEqual(sorted(regions), ['0-1,1', '0-1,2'])
+        self.assertEqual({region.nonfinite for region in regions.values()}, {0})
+
+    def test_rebuild(self):
+        with tempfile.TemporaryDirectory() as rerun_dir:
+            make_rerun(rerun_dir)
+            with open(f'{rerun_dir}/{SKYINDEX_FILE}', 'wb') as f:
+                pickle.dump({'column': SKYINDEX_COLUMN, 'regions': {'0-1,1': (1., 0., 0., 0.01)}}, f)
+            patch = Patch(Rerun(rerun_dir), f'{rerun_dir}/patches/0-1,1')
+            self.assertIsNone(patch.sky_region.nonfinite)  # type: ignore
+            build(rerun_dir, 1)
+            self.assertEqual(patch.sky_region.nonfinite, 0)  # type: ignore
@@ -0,0 +1,105 @@
+'''
+Per-patch column statistics (zone maps).
+
+`zonemap.pickle` is placed next to `meta.pickle` of each patch.
+It maps the path of each column file relative to the patch directory (without `.npy`)
+to its statistics.
+
+Usage: ::
+
+    $ python -m quickdb.sspcatalog.zonemap $SOMEWHERE/releases/pdr2_wide
+'''
+import argparse
+import glob
+import logging
+import multiprocessing
+import os
+import pickle
+from typing import Any, Dict, NamedTuple, Optional, Union
+
+import numpy
+
+ZONEMAP_FILE = 'zonemap.pickle'
+
+
+class ColumnStats(NamedTuple):
+    size: int
+    nan_count: int
+    min: Any  # None if there is no value other than NaN
+    max: Any
+
+
+class FlagStats(NamedTuple):
+    any_set: int  # bitwise OR of all words
+    all_set: int  # bitwise AND of all words
+
+
+Stats = Union[ColumnStats, FlagStats]
+
+
+def column_stats(a: numpy.ndarray) -> ColumnStats:
+    if a.dtype.kind == 'f':
+        nan_count = int(numpy.isnan(a).sum())
+    else:
+        nan_count = 0
+    if nan_count < len(a):
+        return ColumnStats(size=len(a), nan_count=nan_count, min=numpy.nanmin(a).item(), max=numpy.nanmax(a).item())
+    return ColumnStats(size=len(a), nan_count=nan_count, min=None, max=None)
+
+
+def flag_stats(a: numpy.ndarray) -> FlagStats:
+    return FlagStats(
+        any_set=int(numpy.bitwise_or.reduce(a)),
+        all_set=int(numpy.bitwise_and.reduce(a)) if len(a) > 0 else -1,
+    )
+
+
+def build_zonemap(patch_dir: str) -> Dict[str, Stats]:
+    zonemap: Dict[str, Stats] = {}
+    for filename in glob.glob(f'{patch_dir}/**/*.npy', recursive=True):
+        key = os.path.relpath(filename, patch_dir)[:-len('.npy')]
+        a = numpy.load(filename, mmap_mode='r')
+        if len(a.shape) != 1 or a.dtype.kind not in 'biuf':
+            continue
+        if os.path.basename(key).startswith('flags-'):
+            zonemap[key] = flag_stats(a)
+        else:
+            zonemap[key] = column_stats(a)
+    return zonemap
+
+
+def write_zonemap(patch_dir: str):
+    zonemap = build_zonemap(patch_dir)
+    # the file is replaced at once because running workers read it again when it changes
+    with open(f'{patch_dir}/{ZONEMAP_FILE}.tmp', 'wb') as f:
+        # stats are stored as plain dicts not to depend on the module path of the classes
+        pickle.dump({k: (type(v).__name__, v._asdict()) for k, v in zonemap.items()}, f)
+    os.replace(f'{patch_dir}/{ZONEMAP_FILE}.tmp', f'{patch_dir}/{ZONEMAP_FILE}')
+
+
+def read_zonemap(filename: str) -> Dict[str, Stats]:
+    with open(filename, 'rb') as f:
+        raw = pickle.load(f)
+    types = {'ColumnStats': ColumnStats, 'FlagStats': FlagStats}
+    return {k: types[typename](**v) for k, (typename, v) in raw.items()}
+
+
+def build(rerun_dir: str, n_procs: Optional[int] = None):
+    patch_dirs = glob.glob(f'{rerun_dir}/patches/*')
+    with multiprocessing.Pool(n_procs) as pool:
+        for i, _ in enumerate(pool.imap_unordered(write_zonemap, patch_dirs)):
+            if i % 100 == 0:
+                logging.info(f'zonemap {i} / {len(patch_dirs)}...')
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--parallel', '-j', type=int)
+    parser.add_argument('data')
+    args = parser.parse_args()
+    build(args.data, args.parallel)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+import os
+import tempfile
+import unittest
+
+import numpy
+
+from .columnstore_test import make_rerun
+from .patch import Patch, Rerun
+from .zonemap import ColumnStats, FlagStats, build_zonemap, write_zonemap
+
+
+class TestZonemap(unittest.TestCase):
+    def test_build_zonemap(self):
+        with tempfile.TemporaryDirectory() as patch_dir:
+            os.makedirs(f'{patch_dir}/forced/HSC-I')
+            numpy.save(f'{patch_dir}/object_id.npy', numpy.array([3, 1, 2]))
+            numpy.save(f'{patch_dir}/forced/HSC-I/psfflux_flux.npy', numpy.array([numpy.nan, 1.5, -2.]))
+            numpy.save(f'{patch_dir}/forced/HSC-I/cmodel_flux.npy', numpy.array([numpy.nan, numpy.nan]))
+            numpy.save(f'{patch_dir}/forced/HSC-I/flags-0.npy', numpy.array([0b011, 0b110]))
+            numpy.save(f'{patch_dir}/forced/HSC-I/coord.npy', numpy.zeros((2, 3)))
+            zonemap = build_zonemap(patch_dir)
+        self.assertEqual(zonemap['object_id'], ColumnStats(size=3, nan_count=0, min=1, max=3))
+        self.assertEqual(zonemap['forced/HSC-I/psfflux_flux'], ColumnStats(size=3, nan_count=1, min=-2., max=1.5))
+        self.assertEqual(zonemap['forced/HSC-I/cmodel_flux'], ColumnStats(size=2, nan_count=2, min=None, max=None))
+        self.assertEqual(zonemap['forced/HSC-I/flags-0'], FlagStats(any_set=0b111, all_set=0b010))
+        self.assertNotIn('forced/HSC-I/coord', zonemap)
+
+    def test_redeploy(self):
+        with tempfile.TemporaryDirectory() as rerun_dir:
+            make_rerun(rerun_dir)
+            patch = Patch(Rerun(rerun_dir), f'{rerun_dir}/patches/0-1,1')
+            write_zonemap(patch._dirname)
+            self.assertEqual(patch.column_stats('object_id'), ColumnStats(size=3, nan_count=0, min=30, max=32))
+            numpy.save(f'{patch._dirname}/object_id.npy', numpy.arange(3) + 100)
+            write_zonemap(patch._dirname)
+            self.assertEqual(patch.column_stats('object_id'), ColumnStats(size=3, nan_count=0, min=100, max=102))
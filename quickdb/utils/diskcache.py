@@ -0,0 +1,200 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import pickle
+import secrets
+import struct
+import threading
+import time
+from typing import Any, Callable, NamedTuple, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    bytes: int
+
+
+class DiskCache:
+    '''
+    Byte-bounded LRU cache of files in a directory.
+
+    The cache can be shared by multiple processes.
+    Each entry is a file whose mtime is used as the LRU clock.
+    Counters and eviction are serialized with `flock` on a lock file in the directory.
+    Hits are counted in each process and written to the file every `FLUSH_INTERVAL` seconds,
+    so that reading entries does not take the lock.
+
+    Example:
+        cache = DiskCache('/dev/shm/quickdb-cache', max_bytes=1024**3)
+        array = cache.load(key, make=lambda path: shutil.copyfile(src, path), load=numpy.load)
+    '''
+
+    _STATS = struct.Struct('4q')
+    FLUSH_INTERVAL = 1.  # seconds
+    LOW_WATERMARK = 0.9  # eviction makes room down to this fraction of `max_bytes`
+
+    def __init__(self, directory: str, max_bytes: int, max_entry_bytes: Optional[int] = None):
+        '''
+        Args:
+            directory: Directory where entries are stored.
+            max_bytes: Total size of entries is kept under this value.
+            max_entry_bytes: Entries larger than this are not stored.
+                             Defaults to `max_bytes // 8` so that a huge entry does not flush the others.
+        '''
+        self._directory = directory
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 8 if max_entry_bytes is None else max_entry_bytes
+        self._pending_lock = threading.Lock()
+        self._pending = CacheStats(0, 0, 0, 0)
+        self._pending_pid = os.getpid()
+        self._flushed_at = time.monotonic()
+
+    def admits(self, size: int) -> bool:
+        return size <= self.max_entry_bytes
+
+    def load(self, key: str, make: Callable[[str], Any], load: Callable[[str], T]) -> T:
+        '''
+        Returns `load(path)` for the entry of `key`.
+        If there is no entry for `key`, `make(path)` is called to create the file.
+        '''
+        self._ensure_directory()
+        path = f'{self._directory}/{hashlib.sha1(key.encode()).hexdigest()}'
+        try:
+            value = load(path)
+        except FileNotFoundError:
+            pass
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(path)
+            self._count(hits=1)
+            if time.monotonic() - self._flushed_at >= self.FLUSH_INTERVAL:
+                self._update_stats()
+            return value
+        tmp = f'{path}.{secrets.token_hex(4)}.tmp'
+        try:
+            make(tmp)
+            value = load(tmp)  # the file can be evicted right after `replace`
+            size = os.path.getsize(tmp)
+            if self.admits(size):
+                os.replace(tmp, path)
+                self._count(misses=1, bytes=size)
+                self._evict()
+            else:
+                self._count(misses=1)
+                self._update_stats()
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp)
+        return value
+
+    def load_pickle(self, key: str, compute: Callable[[], T]) -> T:
+        '''
+        Returns `compute()` for `key`, which is pickled in the entry of `key`.
+        '''
+        def make(path: str):
+            with open(path, 'wb') as f:
+                pickle.dump(compute(), f, pickle.HIGHEST_PROTOCOL)
+
+        def load(path: str) -> T:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+
+        return self.load(key, make, load)
+
+    @property
+    def stats(self) -> CacheStats:
+        self._ensure_directory()
+        with self._lock() as f:
+            return self._flush(f)
+
+    def clear(self):
+        self._ensure_directory()
+        with self._lock() as f:
+            for entry in self._entries():
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(entry.path)
+            stats = self._flush(f)
+            self._write_stats(f, stats._replace(bytes=0))
+
+    def _evict(self):
+        with self._lock() as f:
+            stats = self._flush(f)
+            if stats.bytes <= self.max_bytes:
+                return
+            # evicting down to the low watermark lets the following misses skip scanning the directory
+            entries = sorted(self._entries(), key=lambda e: e.stat().st_mtime_ns)
+            total = sum(e.stat().st_size for e in entries)
+            evictions = 0
+            for entry in entries:
+                if total <= self.LOW_WATERMARK * self.max_bytes:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(entry.path)
+                    evictions += 1
+                total -= entry.stat().st_size
+            self._write_stats(f, stats._replace(evictions=stats.evictions + evictions, bytes=total))
+
+    def _entries(self):
+        return [e for e in os.scandir(self._directory) if e.is_file() and not (e.name.startswith('.') or e.name.endswith('.tmp'))]
+
+    def _count(self, hits=0, misses=0, evictions=0, bytes=0):
+        with self._pending_lock:
+            if self._pending_pid != os.getpid():  # counts of the parent are flushed by the parent
+                self._pending = CacheStats(0, 0, 0, 0)
+                self._pending_pid = os.getpid()
+            self._pending = CacheStats(
+                hits=self._pending.hits + hits,
+                misses=self._pending.misses + misses,
+                evictions=self._pending.evictions + evictions,
+                bytes=self._pending.bytes + bytes,
+            )
+
+    def _update_stats(self):
+        with self._lock() as f:
+            self._flush(f)
+
+    def _flush(self, f) -> CacheStats:
+        '''
+        Adds the counts of this process to the stats file locked as `f` and returns the stats
+        '''
+        self._count()  # resets the counts inherited by a forked process
+        with self._pending_lock:
+            pending, self._pending = self._pending, CacheStats(0, 0, 0, 0)
+            self._flushed_at = time.monotonic()
+        stats = self._read_stats(f)
+        if pending == (0, 0, 0, 0):
+            return stats
+        stats = CacheStats(*(a + b for a, b in zip(stats, pending)))
+        self._write_stats(f, stats)
+        return stats
+
+    @contextlib.contextmanager
+    def _lock(self):
+        fd = os.open(f'{self._directory}/.stats', os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield f
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_stats(self, f) -> CacheStats:
+        f.seek(0)
+        b = f.read(self._STATS.size)
+        if len(b) < self._STATS.size:
+            return CacheStats(0, 0, 0, 0)
+        return CacheStats(*self._STATS.unpack(b))
+
+    def _write_stats(self, f, stats: CacheStats):
+        f.seek(0)
+        f.truncate()
+        f.write(self._STATS.pack(*stats))
+        f.flush()
+
+    def _ensure_directory(self):
+        os.makedirs(self._directory, exist_ok=True)
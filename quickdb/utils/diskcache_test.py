@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+
+from quickdb.utils.diskcache import DiskCache
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.directory = self._tmpdir.name
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_hit_and_miss(self):
+        cache = DiskCache(self.directory, max_bytes=1000)
+        made = []
+        for _ in range(3):
+            value = cache.load('a', make=lambda path: made.append(write(path, b'x' * 10)), load=read)
+            self.assertEqual(value, b'x' * 10)
+        self.assertEqual(len(made), 1)
+        self.assertEqual(cache.stats.hits, 2)
+        self.assertEqual(cache.stats.misses, 1)
+        self.assertEqual(cache.stats.bytes, 10)
+
+    def test_load_pickle(self):
+        cache = DiskCache(self.directory, max_bytes=1000)
+        computed = []
+        for _ in range(2):
+            value = cache.load_pickle('a', lambda: computed.append(1) or {'a': [1, 2]})
+            self.assertEqual(value, {'a': [1, 2]})
+        self.assertEqual(computed, [1])
+
+    def test_eviction(self):
+        cache = DiskCache(self.directory, max_bytes=250, max_entry_bytes=100)
+        for key in 'abc':
+            cache.load(key, make=lambda path: write(path, b'x' * 100), load=read)
+        self.assertEqual(cache.stats.evictions, 1)
+        self.assertLessEqual(cache.stats.bytes, 250)
+        made = []
+        cache.load('c', make=lambda path: made.append(write(path, b'c')), load=read)
+        cache.load('a', make=lambda path: made.append(write(path, b'a')), load=read)
+        self.assertEqual(made, [None])
+
+    def test_eviction_to_low_watermark(self):
+        cache = DiskCache(self.directory, max_bytes=1000, max_entry_bytes=100)
+        for key in 'abcdefghijk':
+            cache.load(key, make=lambda path: write(path, b'x' * 100), load=read)
+        self.assertEqual(cache.stats.evictions, 2)
+        self.assertEqual(cache.stats.bytes, 900)
+
+    def test_too_large_entry(self):
+        cache = DiskCache(self.directory, max_bytes=1000, max_entry_bytes=10)
+        value = cache.load('a', make=lambda path: write(path, b'x' * 100), load=read)
+        self.assertEqual(value, b'x' * 100)
+        self.assertEqual(cache.stats.bytes, 0)
+        self.assertEqual(os.listdir(self.directory), ['.stats'])
+
+    def test_clear(self):
+        cache = DiskCache(self.directory, max_bytes=1000)
+        cache.load('a', make=lambda path: write(path, b'x' * 10), load=read)
+        cache.clear()
+        self.assertEqual(cache.stats.bytes, 0)
+        self.assertEqual(os.listdir(self.directory), ['.stats'])
+
+
+def write(path: str, data: bytes):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path: str):
+    with open(path, 'rb') as f:
+        return f.read()
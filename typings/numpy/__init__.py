@@ -1,17 +1,26 @@
-from typing import Any, Iterable, List, Optional, Tuple, Union, overload
+from typing import Any, Iterable, List, Optional, Sequence, Tuple, Union, overload
 
 
-class _dtype:
+class dtype:
     kind: str
+    str: str
+    itemsize: int
+    hasobject: bool
 
+    def __init__(self, typename: Any): ...
 
-def dtype(typename: str) -> _dtype: ...
+
+_dtype = dtype
 
 
 class ndarray:
     @overload
-    def __getitem__(self, slice: Union['ndarray', slice]) -> 'ndarray': ...
-    def __getitem__(self, index: int) -> ...: ...
+    def __getitem__(self, index: int) -> Any: ...
+    @overload
+    def __getitem__(self, slice: Union['ndarray', slice, List[int], Tuple[Any, ...]]) -> 'ndarray': ...
+    def __getitem__(self, index) -> Any: ...
+
+    def __setitem__(self, index, value) -> None: ...
 
     def __len__(self) -> int: ...
 
@@ -28,6 +37,8 @@ class ndarray:
     def __truediv__(self, other) -> 'ndarray': ...
     def __mod__(self, other) -> 'ndarray': ...
     def __and__(self, other) -> 'ndarray': ...
+    def __or__(self, other) -> 'ndarray': ...
+    def __lshift__(self, other) -> 'ndarray': ...
 
     def __radd__(self, other) -> 'ndarray': ...
     def __rsub__(self, other) -> 'ndarray': ...
@@ -35,17 +46,31 @@ class ndarray:
     def __rtruediv__(self, other) -> 'ndarray': ...
     def __rmod__(self, other) -> 'ndarray': ...
     def __rand__(self, other) -> 'ndarray': ...
+    def __ror__(self, other) -> 'ndarray': ...
 
     def __pos__(self) -> 'ndarray': ...
     def __neg__(self) -> 'ndarray': ...
+    def __invert__(self) -> 'ndarray': ...
+    def __float__(self) -> float: ...
+    def __buffer__(self, flags: int) -> memoryview: ...
 
     def fill(self, value) -> None: ...
-    def all(self) -> bool: ...
-    def sum(self, *args, **kwargs): ...
+    def all(self, *args, **kwargs) -> Any: ...
+    def sum(self, *args, **kwargs) -> Any: ...
+    def min(self, *args, **kwargs): ...
+    def max(self, *args, **kwargs): ...
+    def mean(self, *args, **kwargs): ...
+    def astype(self, dtype, copy: bool = True) -> 'ndarray': ...
+    def reshape(self, *shape) -> 'ndarray': ...
+    def copy(self) -> 'ndarray': ...
+    def tolist(self) -> Any: ...
 
     def __iter__(self) -> ...: ...
 
     shape: Tuple[int, ...]
+    nbytes: int
+    itemsize: int
+    flags: Any
 
     dtype: _dtype
 
@@ -53,22 +78,104 @@ class ndarray:
     def T(self) -> 'ndarray': ...
 
 
+class memmap(ndarray):
+    offset: int
+
+    def __init__(self, *args, **kwargs): ...
+
+
+class ufunc:
+    identity: Any
+
+    def __call__(self, *args, **kwargs) -> ndarray: ...
+    def reduce(self, a: ndarray, *args, **kwargs) -> Any: ...
+    def reduceat(self, a: ndarray, indices: ndarray, *args, **kwargs) -> ndarray: ...
+    def at(self, a: ndarray, indices: ndarray, b=None) -> None: ...
+
+
+class iinfo:
+    min: int
+    max: int
+
+    def __init__(self, dtype): ...
+
+
 def array(*args, **kwargs) -> ndarray: ...
 
 
-def concatenate(arrays: Tuple[ndarray, ...]) -> ndarray: ...
+def asarray(*args, **kwargs) -> ndarray: ...
+
+
+def ascontiguousarray(*args, **kwargs) -> ndarray: ...
+
+
+def fromiter(*args, **kwargs) -> ndarray: ...
+
+
+def concatenate(arrays: Sequence[ndarray]) -> ndarray: ...
+
+
+def lexsort(a: Sequence[ndarray]) -> ndarray: ...
+
+
+def argsort(a: ndarray, *args, **kwargs) -> ndarray: ...
+
+
+def argpartition(a: ndarray, kth: int, *args, **kwargs) -> ndarray: ...
+
+
+def searchsorted(a: ndarray, v, side: str = 'left', sorter: ndarray = None) -> ndarray: ...
+
+
+def arange(start: float, stop: float = None, step: float = None, **kwargs) -> ndarray: ...
 
 
-def lexsort(a: List[ndarray]) -> ndarray: ...
+def linspace(*args, **kwargs) -> ndarray: ...
 
 
-def arange(start: int, stop: int = None, step: int = None, **kwargs) -> ndarray: ...
+def flatnonzero(a: ndarray) -> ndarray: ...
+
+
+def count_nonzero(a: ndarray, *args, **kwargs) -> Any: ...
+
+
+def bincount(x: ndarray, weights: ndarray = None, minlength: int = 0) -> ndarray: ...
+
+
+def clip(*args, **kwargs) -> ndarray: ...
+
+
+def any(*args, **kwargs) -> Any: ...
+
+
+def prod(*args, **kwargs) -> Any: ...
+
+
+def ndim(a) -> int: ...
+
+
+def array_equal(a1, a2, equal_nan: bool = False) -> bool: ...
+
+
+def result_type(*arrays_and_dtypes) -> _dtype: ...
+
+
+def issubdtype(arg1, arg2) -> bool: ...
 
 
 def nonzero(a: ndarray) -> Tuple[ndarray, ...]: ...
 
 
-def empty(shape: Iterable[int], dtype: Union[_dtype, str] = None) -> ndarray: ...
+def empty(shape: Union[int, Iterable[int]], dtype: Any = None) -> ndarray: ...
+
+
+def zeros(shape: Union[int, Iterable[int]], dtype: Any = None) -> ndarray: ...
+
+
+def ones(shape: Union[int, Iterable[int]], dtype: Any = None) -> ndarray: ...
+
+
+def full(shape: Union[int, Iterable[int]], fill_value, dtype: Any = None) -> ndarray: ...
 
 
 def load(*args, **kwargs) -> ndarray: ...
@@ -77,7 +184,7 @@ def load(*args, **kwargs) -> ndarray: ...
 def save(*args, **kwargs) -> None: ...
 
 
-def savez(*args, **kwargs): ...
+def savez(*args, **kwargs) -> Any: ...
 
 
 def allclose(a: ndarray, b: ndarray, equal_nan: bool = None) -> bool: ...
@@ -107,10 +214,10 @@ def histogram(a: ndarray, bins=10, range=None, normed=None, weights=None, densit
 def histogram2d(*args, **kwargs) -> Tuple[ndarray, ndarray]: ...
 
 
-def min(*args, **kwargs): ...
+def min(*args, **kwargs) -> Any: ...
 
 
-def max(*args, **kwargs): ...
+def max(*args, **kwargs) -> Any: ...
 
 
 def sin(*args, **kwargs) -> ndarray: ...
@@ -125,13 +232,16 @@ def tan(*args, **kwargs) -> ndarray: ...
 def arctan2(*args, **kwargs) -> ndarray: ...
 
 
+def arccos(*args, **kwargs) -> ndarray: ...
+
+
 def sqrt(*args, **kwargs) -> ndarray: ...
 
 
-def nanmin(*args, **kwargs): ...
+def nanmin(*args, **kwargs) -> Any: ...
 
 
-def nanmax(*args, **kwargs): ...
+def nanmax(*args, **kwargs) -> Any: ...
 
 
 def log10(*args, **kwargs) -> ndarray: ...
@@ -152,12 +262,31 @@ def percentile(a: ndarray, q: float) -> float: ...
 def percentile(a: ndarray, q: ndarray) -> ndarray: ...
 
 
-def seterr(*args, **kwargs): ...
+def seterr(*args, **kwargs) -> Any: ...
+
 
+add: ufunc
+minimum: ufunc
+maximum: ufunc
+bitwise_and: ufunc
+bitwise_or: ufunc
 
+int32: Any
 int64: Any
+uint64: Any
+intp: Any
 float32: Any
+float64: Any
 bool_: Any
+integer: Any
+number: Any
+
+newaxis: None
+r_: Any
+lib: Any
+linalg: Any
+random: Any
+testing: Any
 
 nan: float
 pi: float